@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+#
+# AddressMonitor fed by a fake rtnetlink source: RTM_NEWADDR and
+# RTM_DELADDR messages built like the kernel's are written to a socket
+# pair and parsed by NetlinkAddressSource. Checks that the listeners of
+# the loopback interface follow its primary address, that a lost message
+# overflow (ENOBUFS) reads the interface again, and that any other read
+# error restarts the source instead of ending the monitor. Reports the
+# time from a message to its listener call
+
+import argparse
+import errno
+import os
+import queue
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from address_monitor import AddressMonitor, NetlinkAddressSource, get_interface_addresses  # noqa: E402
+
+INTERFACE = "lo"
+
+
+def address_message(type_, interface, address):
+    """rtnetlink message as sent to RTMGRP_IPV4_IFADDR subscribers"""
+    attribute = NetlinkAddressSource.RTATTR.pack(NetlinkAddressSource.RTATTR.size + 4, NetlinkAddressSource.IFA_LOCAL)
+    body = NetlinkAddressSource.IFADDRMSG.pack(socket.AF_INET, 8, 0, 0, socket.if_nametoindex(interface))
+    body += attribute + socket.inet_aton(address)
+    return NetlinkAddressSource.NLMSGHDR.pack(NetlinkAddressSource.NLMSGHDR.size + len(body), type_, 0, 0, 0) + body
+
+
+class FakeAddressSource(object):
+    """stands for the rtnetlink socket, the next read fails with error once set"""
+
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.error = None
+        self.opened = 0
+
+    def open(self):
+        self.reader, self.writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.opened += 1
+
+    def close(self):
+        if self.reader:
+            self.reader.close()
+            self.writer.close()
+            self.reader = self.writer = None
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def read(self):
+        data = self.reader.recv(65536)
+        if self.error:
+            error, self.error = self.error, None
+            raise OSError(error, os.strerror(error))
+        return NetlinkAddressSource.parse(data)
+
+    def send(self, *messages):
+        self.writer.send(b"".join(messages))
+
+    def fail(self, error):
+        self.error = error
+        self.writer.send(b"\0")
+
+
+def expect(notifications, address, timeout, what):
+    """seconds until the listener is called with address"""
+    started = time.perf_counter()
+    try:
+        notified = notifications.get(timeout=timeout)
+    except queue.Empty:
+        raise Exception("{}: listener not called in {} s".format(what, timeout))
+    if notified != address:
+        raise Exception("{}: listener called with {}, not {}".format(what, notified, address))
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="address monitor on a fake rtnetlink source")
+    parser.add_argument("--rounds", type=int, default=200, help="address changes timed")
+    parser.add_argument("--timeout", type=float, default=2)
+    args = parser.parse_args()
+
+    primary = get_interface_addresses(INTERFACE)[0]
+    other = "10.255.0.1"
+    source = FakeAddressSource()
+    source.open()
+    monitor = AddressMonitor(source)
+    notifications = queue.Queue()
+    monitor.start()
+    try:
+        monitor.add_listener(INTERFACE, notifications.put)
+        expect(notifications, primary, args.timeout, "current address")
+
+        latencies = []
+        for i in range(args.rounds):
+            # the other address becomes primary once the current one is gone, and back
+            source.send(address_message(NetlinkAddressSource.RTM_NEWADDR, INTERFACE, other),
+                        address_message(NetlinkAddressSource.RTM_DELADDR, INTERFACE, primary))
+            latencies.append(expect(notifications, other, args.timeout, "RTM_DELADDR of the primary"))
+            source.send(address_message(NetlinkAddressSource.RTM_NEWADDR, INTERFACE, primary),
+                        address_message(NetlinkAddressSource.RTM_DELADDR, INTERFACE, other))
+            latencies.append(expect(notifications, primary, args.timeout, "RTM_NEWADDR after RTM_DELADDR"))
+        latencies.sort()
+        print("{} address changes: message to listener p50 {:.3f} p99 {:.3f} ms".format(
+            len(latencies), latencies[len(latencies) // 2] * 1e3, latencies[int(len(latencies) * 0.99)] * 1e3))
+
+        # messages the overflow lost would have left the other address primary
+        source.send(address_message(NetlinkAddressSource.RTM_NEWADDR, INTERFACE, other),
+                    address_message(NetlinkAddressSource.RTM_DELADDR, INTERFACE, primary))
+        expect(notifications, other, args.timeout, "RTM_DELADDR before the overflow")
+        source.fail(errno.ENOBUFS)
+        seconds = expect(notifications, primary, args.timeout, "resync after ENOBUFS")
+        print("ENOBUFS: interface read again, primary address back after {:.3f} ms".format(seconds * 1e3))
+
+        source.fail(errno.EIO)
+        deadline = time.monotonic() + args.timeout
+        while source.opened < 2 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        if source.opened < 2 or not monitor.thread.is_alive():
+            raise Exception("EIO: source not restarted, monitor thread {}".format(
+                "running" if monitor.thread.is_alive() else "ended"))
+        source.send(address_message(NetlinkAddressSource.RTM_DELADDR, INTERFACE, primary))
+        expect(notifications, None, args.timeout, "RTM_DELADDR after the restart")
+        print("EIO: source restarted, address changes followed again")
+    finally:
+        monitor.stop()
+        source.close()
+
+
+if __name__ == "__main__":
+    main()
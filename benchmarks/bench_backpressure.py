@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+#
+# slow client on a fast serial port: a pty is written as fast as it takes
+# data while the client reads at a limited rate. For every backpressure
+# policy and I/O engine reports how long the serial side was held up,
+# what the client got and the send buffer counters, and checks that no
+# byte went missing without being counted
+
+import argparse
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+from pty_harness import PtyRFC2217Device
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from backpressure import BackpressurePolicy  # noqa: E402
+from io_engine import IOEngine  # noqa: E402
+
+
+class PtyWriter(object):
+    """writes total bytes to the master side, measuring the time spent
+       waiting because the gateway did not read the slave side"""
+
+    def __init__(self, master, total, chunk):
+        self.master = master
+        self.total = total
+        self.payload = bytes(i % 251 for i in range(chunk))
+        self.blocked = 0
+        self.elapsed = 0
+        self.alive = True
+        self.thread = threading.Thread(target=self.__run)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """give up on the rest, nobody reads the serial port after a disconnection"""
+        self.alive = False
+        self.thread.join()
+
+    def __run(self):
+        os.set_blocking(self.master, False)
+        started = time.perf_counter()
+        remaining = self.total
+        while remaining and self.alive:
+            view = memoryview(self.payload)[:min(remaining, len(self.payload))]
+            while view and self.alive:
+                try:
+                    written = os.write(self.master, view)
+                except BlockingIOError:
+                    waiting = time.perf_counter()
+                    select.select([], [self.master], [], 0.1)
+                    self.blocked += time.perf_counter() - waiting
+                    continue
+                view = view[written:]
+                remaining -= written
+        self.elapsed = time.perf_counter() - started
+
+
+def connect(port):
+    """client with a fixed receive buffer. It has to hold a few loopback
+       segments (64 KB), below that the window opens in persist timer steps"""
+    client = socket.create_connection(("127.0.0.1", port))
+    client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 262144)
+    # telnet negotiation sent on connection
+    while select.select([client], [], [], 0.1)[0]:
+        client.recv(65536)
+    return client
+
+
+def receive_slowly(client, total, rate, chunk, idle_timeout):
+    """read at rate bytes per second until total bytes arrived, the
+       connection is closed or nothing arrives for idle_timeout seconds.
+       Returns the serial bytes received and whether the gateway closed"""
+    received = 0
+    closed = False
+    started = time.perf_counter()
+    while received < total:
+        if not select.select([client], [], [], idle_timeout)[0]:
+            break
+        try:
+            data = client.recv(chunk)
+        except ConnectionResetError:
+            data = b''
+        if not data:
+            closed = True
+            break
+        received += len(data)
+        # sleep until the rate allows the next read
+        delay = started + received / rate - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    client.close()
+    return received, closed
+
+
+def run(engine_name, mode, args, port):
+    engine = None
+    if engine_name == "eventloop":
+        engine = IOEngine()
+        engine.start()
+    policy = BackpressurePolicy(mode, args.high_water, args.low_water)
+    master, slave = os.openpty()
+    device = PtyRFC2217Device(os.ttyname(slave), port, engine, backpressure_policy=policy)
+    device.start()
+    try:
+        client = connect(port)
+        writer = PtyWriter(master, args.size, args.chunk)
+        writer.start()
+        received, closed = receive_slowly(client, args.size, args.rate, args.read_size, args.idle_timeout)
+        writer.stop()
+    finally:
+        device.stop()
+        if engine:
+            engine.stop()
+        os.close(master)
+        os.close(slave)
+
+    metrics = device.metrics
+    if mode == BackpressurePolicy.BLOCK:
+        check = received == args.size
+    elif mode == BackpressurePolicy.DROP_OLDEST:
+        check = received + metrics.send_buffer_dropped_bytes == args.size
+    else:
+        check = closed and metrics.send_buffer_disconnects == 1
+    print("{:<9} {:<11} serial side {:>6.2f} s, blocked {:>6.2f} s, client got {:>8} B{}, "
+          "{:>3} stalls {:>8} B dropped {} disconnects: {}".format(
+              engine_name, mode, writer.elapsed, writer.blocked, received, " (closed)" if closed else "",
+              metrics.send_buffer_stalls, metrics.send_buffer_dropped_bytes, metrics.send_buffer_disconnects,
+              "ok" if check else "UNACCOUNTED BYTES"))
+    return check
+
+
+def main():
+    parser = argparse.ArgumentParser(description="slow client backpressure benchmark")
+    parser.add_argument("--engines", nargs="+", default=["threaded", "eventloop"], choices=["threaded", "eventloop"])
+    parser.add_argument("--policies", nargs="+", default=list(BackpressurePolicy.MODES),
+                        choices=BackpressurePolicy.MODES)
+    parser.add_argument("--size", type=int, default=16 << 20,
+                        help="bytes written to the serial port, more than the kernel socket buffers take")
+    parser.add_argument("--chunk", type=int, default=4096, help="write size on the serial side")
+    parser.add_argument("--rate", type=float, default=4e6, help="client read rate in bytes per second")
+    parser.add_argument("--read-size", type=int, default=4096)
+    parser.add_argument("--high-water", type=int, default=262144)
+    parser.add_argument("--low-water", type=int, default=65536)
+    parser.add_argument("--idle-timeout", type=float, default=1)
+    parser.add_argument("--base-port", type=int, default=17900)
+    args = parser.parse_args()
+
+    results = []
+    port = args.base_port
+    for engine_name in args.engines:
+        for mode in args.policies:
+            results.append(run(engine_name, mode, args, port))
+            port += 1
+    if not all(results):
+        raise Exception("Bytes lost without being counted")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+#
+# end-to-end benchmark of the RFC2217 bridge on pty pairs: round-trip
+# latency, throughput in both directions, gateway CPU per MB, context
+# switches and thread count. Results can be saved as JSON and compared
+# against a previous run.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+from bench_codec import make_payload
+from pty_harness import BridgeConfig, PtyBridge, PtySide
+
+MB = 1e6
+# struct tcp_info: tcpi_data_segs_in, data segments received
+TCP_INFO_SIZE = 256
+TCPI_DATA_SEGS_IN = 152
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def read_exactly(client, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = client.read(size - len(data))
+        if not chunk:
+            raise Exception("Timeout waiting for {} bytes, got {}".format(size, len(data)))
+        data += chunk
+    return bytes(data)
+
+
+def run_parallel(target, count):
+    errors = []
+
+    def wrapper(index):
+        try:
+            target(index)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=wrapper, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def received_segments(bridge):
+    """TCP segments with data the clients received from the gateway"""
+    total = 0
+    for client in bridge.clients:
+        info = client._socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_SIZE)
+        total += struct.unpack_from("I", info, TCPI_DATA_SEGS_IN)[0]
+    return total
+
+
+def measure(bridge, scenario, moved_bytes, function):
+    before = bridge.stats()
+    segments = received_segments(bridge)
+    start = time.perf_counter()
+    result = function() or {}
+    elapsed = time.perf_counter() - start
+    segments = received_segments(bridge) - segments
+    after = bridge.stats()
+    cpu = after["cpu_seconds"] - before["cpu_seconds"]
+    result.update({
+        "scenario": scenario,
+        "seconds": elapsed,
+        "throughput_mb_s": moved_bytes / elapsed / MB,
+        "cpu_seconds_per_mb": cpu / (moved_bytes / MB),
+        "segments": segments,
+        "segments_per_s": segments / elapsed,
+        "context_switches": after["context_switches"] - before["context_switches"],
+        "threads": after["threads"],
+    })
+    if "traced_peak_bytes" in after:
+        result["traced_peak_bytes"] = after["traced_peak_bytes"]
+    return result
+
+
+def round_trip(bridge, payload, messages):
+    bridge.pty_side.reset(PtySide.ECHO)
+    latencies = []
+    lock = threading.Lock()
+
+    def client_loop(index):
+        client = bridge.clients[index]
+        samples = []
+        for i in range(messages):
+            start = time.perf_counter()
+            client.write(payload)
+            if read_exactly(client, len(payload)) != payload:
+                raise Exception("Echoed data differs on device {}".format(index))
+            samples.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(samples)
+
+    run_parallel(client_loop, len(bridge.clients))
+    return {
+        "rtt_p50_ms": percentile(latencies, 0.50) * 1e3,
+        "rtt_p99_ms": percentile(latencies, 0.99) * 1e3,
+        "rtt_p999_ms": percentile(latencies, 0.999) * 1e3,
+    }
+
+
+def serial_to_socket(bridge, payload, total):
+    bridge.pty_side.reset(PtySide.SINK)
+
+    def device_loop(index):
+        master = bridge.masters[index]
+        client = bridge.clients[index]
+        writer = threading.Thread(target=write_master, args=(master, payload, total))
+        writer.start()
+        read_exactly(client, total)
+        writer.join()
+
+    run_parallel(device_loop, len(bridge.clients))
+
+
+def write_master(master, payload, total):
+    sent = 0
+    while sent < total:
+        chunk = payload[:total - sent]
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(master, view):]
+        sent += len(chunk)
+
+
+def socket_to_serial(bridge, payload, total):
+    bridge.pty_side.reset(PtySide.SINK)
+
+    def device_loop(index):
+        client = bridge.clients[index]
+        sent = 0
+        while sent < total:
+            chunk = payload[:total - sent]
+            client.write(chunk)
+            sent += len(chunk)
+        deadline = time.monotonic() + 30
+        while bridge.pty_side.received[index] < total:
+            if time.monotonic() > deadline:
+                raise Exception("Timeout waiting for data on device {}".format(index))
+            time.sleep(0.001)
+
+    run_parallel(device_loop, len(bridge.clients))
+
+
+def run_configuration(config, args):
+    results = []
+    bridge = PtyBridge(config)
+    bridge.start()
+    try:
+        for size in args.sizes:
+            for density in args.iac_densities:
+                payload = make_payload(size, density)
+                base = dict(config.as_dict(), payload_size=size, iac_density=density)
+                moved = 2 * size * args.messages * config.devices
+                result = measure(bridge, "round_trip", moved,
+                                 lambda: round_trip(bridge, payload, args.messages))
+                results.append(dict(base, **result))
+                print_result(results[-1])
+
+        for density in args.iac_densities:
+            payload = make_payload(args.chunk, density)
+            base = dict(config.as_dict(), payload_size=args.chunk, iac_density=density)
+            moved = args.bulk_size * config.devices
+            result = measure(bridge, "serial_to_socket", moved,
+                             lambda: serial_to_socket(bridge, payload, args.bulk_size))
+            results.append(dict(base, **result))
+            print_result(results[-1])
+            result = measure(bridge, "socket_to_serial", moved,
+                             lambda: socket_to_serial(bridge, payload, args.bulk_size))
+            results.append(dict(base, **result))
+            print_result(results[-1])
+    finally:
+        bridge.stop()
+    return results
+
+
+def print_result(result):
+    latency = ""
+    if "rtt_p50_ms" in result:
+        latency = "p50 {:.3f} p99 {:.3f} p999 {:.3f} ms".format(
+            result["rtt_p50_ms"], result["rtt_p99_ms"], result["rtt_p999_ms"])
+    print("{:<17} {:>4} dev {:<7} {:<9} {:<14} {:>6} B IAC {:<5} {:>8.2f} MB/s {:>8.3f} cpu s/MB {:>8} cs {:>4} thr "
+          "{:>8.0f} seg/s {}".format(
+              result["scenario"], result["devices"], result.get("transport", "rfc2217"), result["engine"],
+              result["coalescing"], result["payload_size"], result["iac_density"], result["throughput_mb_s"],
+              result["cpu_seconds_per_mb"], result["context_switches"], result["threads"],
+              result.get("segments_per_s", 0), latency))
+
+
+def print_coalescing_summary(results):
+    """segments and round-trip p99 side by side for every coalescing policy"""
+    print("\ncoalescing policies, serial to socket segments and round trip p99 by payload size")
+    rows = {}
+    for result in results:
+        if result["iac_density"] or result.get("transport", "rfc2217") != "rfc2217":
+            continue
+        row = rows.setdefault((result["devices"], result["engine"], result["coalescing"]), {})
+        if result["scenario"] == "serial_to_socket":
+            row["segments"] = "{:>8.0f} seg/s {:>6.0f} B/seg".format(
+                result["segments_per_s"], result["throughput_mb_s"] * MB / max(result["segments_per_s"], 1))
+        elif result["scenario"] == "round_trip":
+            row.setdefault("p99", []).append("{} B {:.3f} ms".format(result["payload_size"], result["rtt_p99_ms"]))
+    for (devices, engine, coalescing), row in rows.items():
+        print("{:>4} dev {:<9} {:<14} {}  p99 {}".format(devices, engine, coalescing, row.get("segments", ""),
+                                                         ", ".join(row.get("p99", []))))
+
+
+def result_key(result):
+    return (result["scenario"], result["devices"], result.get("transport", "rfc2217"), result["engine"], result["coalescing"],
+            result["tcp_cork"], result["receive_buffer_size"], result["payload_size"], result["iac_density"])
+
+
+def compare(previous_path, results):
+    with open(previous_path) as f:
+        previous = {result_key(r): r for r in json.load(f)["results"]}
+    print("\ncompared with {}".format(previous_path))
+    for result in results:
+        old = previous.get(result_key(result))
+        if not old:
+            continue
+        changes = []
+        for metric in ("throughput_mb_s", "cpu_seconds_per_mb", "rtt_p99_ms", "segments_per_s"):
+            if metric in result and old.get(metric):
+                changes.append("{} {:+.1f}%".format(metric, 100.0 * (result[metric] - old[metric]) / old[metric]))
+        print("{} {}".format(result_key(result), ", ".join(changes)))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pty backed RFC2217 bridge benchmark")
+    parser.add_argument("--devices", type=int, nargs="+", default=[1], help="simultaneous devices, e.g. 1 10 50 200")
+    parser.add_argument("--engines", nargs="+", default=["threaded"], choices=["threaded", "eventloop"])
+    parser.add_argument("--transports", nargs="+", default=["rfc2217"], choices=["rfc2217", "raw"],
+                        help="raw devices are threaded and ignore --engines")
+    parser.add_argument("--coalescing", nargs="+", default=["lowest-latency"],
+                        choices=["lowest-latency", "throughput", "adaptive"])
+    parser.add_argument("--tcp-cork", action="store_true", help="cork the socket while coalescing")
+    parser.add_argument("--receive-buffer-size", type=int, default=16384)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 64, 1024], help="round trip payload sizes")
+    parser.add_argument("--iac-densities", type=float, nargs="+", default=[0.0, 0.01])
+    parser.add_argument("--messages", type=int, default=200, help="round trips per device and payload")
+    parser.add_argument("--bulk-size", type=int, default=1 << 20, help="bytes per device in the throughput runs")
+    parser.add_argument("--chunk", type=int, default=4096, help="write size in the throughput runs")
+    parser.add_argument("--base-port", type=int, default=17100)
+    parser.add_argument("--trace-malloc", action="store_true", help="report traced memory peaks of the gateway")
+    parser.add_argument("--output", help="save the results as JSON")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    args = parser.parse_args()
+
+    results = []
+    for devices in args.devices:
+        for transport in args.transports:
+            # raw mode has neither an engine nor coalescing to choose
+            engines = args.engines if transport == "rfc2217" else ["threaded"]
+            policies = args.coalescing if transport == "rfc2217" else ["lowest-latency"]
+            for engine in engines:
+                for coalescing in policies:
+                    config = BridgeConfig(devices, engine, coalescing, args.tcp_cork, args.receive_buffer_size,
+                                          args.base_port, args.trace_malloc, transport)
+                    results.extend(run_configuration(config, args))
+    if len(args.coalescing) > 1:
+        print_coalescing_summary(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"commit": git_commit(), "date": datetime.datetime.now().isoformat(),
+                       "python": platform.python_version(), "platform": platform.platform(),
+                       "results": results}, f, indent=2)
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+#
+# adaptive coalescing on a steady stream: a pty is written with small
+# chunks at a fixed interval below the adaptive gap, through a device on
+# each I/O engine, while a client drains the socket. Every decision of the
+# policy is recorded; a steady stream must keep opening coalescing windows
+# instead of alternating with single reads. Reports the share of batched
+# decisions and the chunks sent per serial read
+
+import argparse
+import os
+import select
+import socket
+import sys
+import threading
+import time
+import tty
+
+from pty_harness import PtyRFC2217Device
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from coalescing_policy import CoalescingPolicy  # noqa: E402
+from io_engine import IOEngine  # noqa: E402
+
+
+class RecordingPolicy(CoalescingPolicy):
+    """adaptive policy keeping each of its decisions"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.decisions = []
+
+    def should_batch(self):
+        batch = super().should_batch()
+        self.decisions.append(batch)
+        return batch
+
+
+def write_steadily(master, chunk, interval, duration):
+    deadline = time.monotonic() + duration
+    due = time.monotonic()
+    while due < deadline:
+        os.write(master, chunk)
+        due += interval
+        time.sleep(max(0, due - time.monotonic()))
+
+
+def drain(client, stop):
+    while not stop.is_set():
+        if select.select([client], [], [], 0.1)[0] and not client.recv(65536):
+            break
+
+
+def run(engine_name, args, port):
+    engine = None
+    if engine_name == "eventloop":
+        engine = IOEngine()
+        engine.start()
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    policy = RecordingPolicy(CoalescingPolicy.ADAPTIVE, max_delay_us=args.max_delay_us,
+                             adaptive_gap_us=args.adaptive_gap_us)
+    device = PtyRFC2217Device(os.ttyname(slave), port, engine, policy)
+    device.start()
+    client = socket.create_connection(("127.0.0.1", port))
+    stop = threading.Event()
+    drainer = threading.Thread(target=drain, args=(client, stop))
+    drainer.start()
+    try:
+        # the client's session is up once the device answers the telnet negotiation
+        time.sleep(0.3)
+        reads = device.metrics.serial_reads
+        chunks = device.metrics.serial_to_socket_chunks
+        write_steadily(master, bytes(args.chunk), args.interval_us / 1e6, args.duration)
+        time.sleep(0.1)
+        reads = device.metrics.serial_reads - reads
+        chunks = device.metrics.serial_to_socket_chunks - chunks
+    finally:
+        stop.set()
+        drainer.join()
+        client.close()
+        device.stop()
+        if engine:
+            engine.stop()
+        os.close(master)
+        os.close(slave)
+    # the first read of the stream has no gap to go by
+    decisions = policy.decisions[1:]
+    batched = sum(decisions) / len(decisions) if decisions else 0
+    print("{:<9} {} B every {} us: {} window decisions, {:>5.1f}% batched, {:.2f} chunks sent per read".format(
+        engine_name, args.chunk, args.interval_us, len(decisions), batched * 100, chunks / reads if reads else 0))
+    return batched >= args.min_batched
+
+
+def main():
+    parser = argparse.ArgumentParser(description="adaptive coalescing on a steady stream")
+    parser.add_argument("--engines", nargs="+", default=["threaded", "eventloop"], choices=["threaded", "eventloop"])
+    parser.add_argument("--chunk", type=int, default=32)
+    parser.add_argument("--interval-us", type=int, default=300, help="below the adaptive gap")
+    parser.add_argument("--duration", type=float, default=2)
+    parser.add_argument("--max-delay-us", type=int, default=2000)
+    parser.add_argument("--adaptive-gap-us", type=int, default=1000)
+    parser.add_argument("--min-batched", type=float, default=0.9, help="share of decisions that must batch")
+    parser.add_argument("--base-port", type=int, default=18800)
+    args = parser.parse_args()
+
+    results = [run(engine, args, args.base_port + i) for i, engine in enumerate(args.engines)]
+    if not all(results):
+        raise Exception("A steady stream wasn't kept batched")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+#
+# throughput of the bulk IAC codec against pyserial's PortManager generators,
+# checking on the way that both produce exactly the same bytes
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import serial.rfc2217  # noqa: E402
+
+import rfc2217_codec  # noqa: E402
+
+IAC = 0xff
+TELNET_COMMANDS = [
+    b'\xff\xff',                    # doubled IAC
+    b'\xff\xf1',                    # NOP
+    b'\xff\xfb\x00',                # WILL BINARY
+    b'\xff\xfd\x03',                # DO SGA
+    b'\xff\xfa\x18\x01\xff\xff\x02\xff\xf0',  # subnegotiation with escaped IAC
+]
+
+
+class NullConnection(object):
+    def write(self, data):
+        pass
+
+
+def new_port_manager():
+    return serial.rfc2217.PortManager(None, NullConnection())
+
+
+def make_payload(size, iac_density, seed=0):
+    """raw serial data, as read from the port"""
+    rng = random.Random(seed)
+    payload = bytearray(rng.randrange(0, 255) for _ in range(size))
+    for i in range(int(size * iac_density)):
+        payload[rng.randrange(size)] = IAC
+    return bytes(payload)
+
+
+def make_wire_data(payload, commands, seed=0):
+    """escaped data as sent by a client, optionally mixed with telnet commands"""
+    if not commands:
+        return payload.replace(b'\xff', b'\xff\xff')
+    rng = random.Random(seed)
+    wire = []
+    for segment in chunks(payload, 4096):
+        wire.append(segment.replace(b'\xff', b'\xff\xff'))
+        wire.append(rng.choice(TELNET_COMMANDS))
+    return b''.join(wire)
+
+
+def chunks(data, chunk_size):
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+
+def check_equivalence(payload, wire, chunk_size):
+    reference_manager = new_port_manager()
+    bulk_manager = new_port_manager()
+    for chunk in chunks(payload, chunk_size):
+        if b''.join(reference_manager.escape(chunk)) != rfc2217_codec.escape(chunk):
+            raise AssertionError("escape output differs from pyserial")
+    for chunk in chunks(wire, chunk_size):
+        expected = b''.join(reference_manager.filter(chunk))
+        if rfc2217_codec.filter(bulk_manager, chunk) != expected:
+            raise AssertionError("filter output differs from pyserial")
+
+
+def measure(function, data_chunks, total_size, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for chunk in data_chunks:
+            function(chunk)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return total_size / best / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=1 << 20, help="payload size in bytes")
+    parser.add_argument("--chunk", type=int, default=4096, help="chunk size in bytes")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print("{:>8} {:>8} {:>12} {:>12} {:>12} {:>12}".format(
+        "IAC", "telnet", "escape MB/s", "bulk MB/s", "filter MB/s", "bulk MB/s"))
+    for density in (0.0, 0.001, 0.01, 0.1):
+        for commands in (False, True):
+            payload = make_payload(args.size, density)
+            wire = make_wire_data(payload, commands)
+            for chunk_size in (1, 7, args.chunk):
+                check_equivalence(payload[:64 * 1024], wire[:64 * 1024], chunk_size)
+            payload_chunks = chunks(payload, args.chunk)
+            wire_chunks = chunks(wire, args.chunk)
+            reference_manager = new_port_manager()
+            bulk_manager = new_port_manager()
+            results = (
+                measure(lambda c: b''.join(reference_manager.escape(c)), payload_chunks, len(payload), args.repeat),
+                measure(rfc2217_codec.escape, payload_chunks, len(payload), args.repeat),
+                measure(lambda c: b''.join(reference_manager.filter(c)), wire_chunks, len(wire), args.repeat),
+                measure(lambda c: rfc2217_codec.filter(bulk_manager, c), wire_chunks, len(wire), args.repeat),
+            )
+            print("{:>8} {:>8} {:>12.2f} {:>12.2f} {:>12.2f} {:>12.2f}".format(
+                density, "yes" if commands else "no", *results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+#
+# fan-out of a serial port to read-only subscribers: time until every
+# subscriber got the whole stream, gateway threads and chunks dropped,
+# for 1 to 100 subscribers, optionally with subscribers that never read or
+# with a primary client that never reads
+
+import argparse
+import os
+import selectors
+import socket
+import threading
+import time
+
+from pty_harness import PtyRFC2217Device
+from bench_bridge import percentile, write_master
+
+
+def connect(port):
+    client = socket.create_connection(("127.0.0.1", port))
+    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return client
+
+
+def drain_negotiation(clients, quiet=0.1):
+    """read the telnet negotiation sent on connection until the line is quiet"""
+    selector = selectors.DefaultSelector()
+    for client in clients:
+        selector.register(client, selectors.EVENT_READ)
+    while selector.select(quiet):
+        for key, mask in selector.select(0):
+            key.fileobj.recv(65536)
+    selector.close()
+
+
+def receive_all(clients, total, timeout):
+    """seconds until each client received total bytes, None for those that did not"""
+    selector = selectors.DefaultSelector()
+    received = {}
+    done = {}
+    for client in clients:
+        selector.register(client, selectors.EVENT_READ)
+        received[client] = 0
+    started = time.perf_counter()
+    deadline = time.monotonic() + timeout
+    while len(done) < len(clients) and time.monotonic() < deadline:
+        for key, mask in selector.select(0.5):
+            data = key.fileobj.recv(262144)
+            received[key.fileobj] += len(data)
+            if received[key.fileobj] >= total and key.fileobj not in done:
+                done[key.fileobj] = time.perf_counter() - started
+                selector.unregister(key.fileobj)
+    selector.close()
+    return [done.get(client) for client in clients]
+
+
+def run(subscribers, args, port):
+    master, slave = os.openpty()
+    device = PtyRFC2217Device(os.ttyname(slave), port, max_subscribers=subscribers + args.slow,
+                              subscriber_queue_size=args.queue_size)
+    device.start()
+    try:
+        primary = connect(port)
+        while not device.metrics.connected:
+            time.sleep(0.001)
+        clients = [connect(port) for _ in range(subscribers)]
+        stalled = [connect(port) for _ in range(args.slow)]
+        while device.metrics.subscriber_connections < subscribers + args.slow:
+            time.sleep(0.001)
+        drain_negotiation([primary] + clients)
+        receivers = clients if args.stalled_primary else [primary] + clients
+
+        payload = bytes(i % 251 for i in range(args.chunk))
+        cpu_before = time.process_time()
+        writer = threading.Thread(target=write_master, args=(master, payload, args.size))
+        writer.start()
+        times = receive_all(receivers, args.size, args.timeout)
+        if args.stalled_primary:
+            times = [None] + times
+        writer.join()
+        cpu = time.process_time() - cpu_before
+        threads = threading.active_count()
+        for client in [primary] + clients + stalled:
+            client.close()
+    finally:
+        device.stop()
+        os.close(master)
+        os.close(slave)
+
+    missing = len([t for t in times[1:] if t is None]) + (0 if args.stalled_primary or times[0] else 1)
+    completed = [t for t in times[1:] if t is not None]
+    if not completed:
+        print("{:>4} subscribers {:>2} stalled: no subscriber received the whole stream in {} s".format(
+            subscribers, args.slow, args.timeout))
+        return False
+    print("{:>4} subscribers {:>2} stalled: primary {:>7.1f} ms, subscribers p50 {:>7.1f} p99 {:>7.1f} ms, "
+          "{:>5.1f} MB/s per subscriber, {:>6.3f} process cpu s, {:>3} threads, {:>5} chunks dropped{}{}".format(
+              subscribers, args.slow, times[0] * 1e3 if times[0] else float("nan"),
+              percentile(completed, 0.5) * 1e3, percentile(completed, 0.99) * 1e3,
+              args.size / max(completed) / 1e6, cpu, threads, device.metrics.subscriber_dropped_chunks,
+              ", primary stalled, {} B dropped for it".format(device.metrics.send_buffer_dropped_bytes)
+              if args.stalled_primary else "",
+              ", {} incomplete".format(missing) if missing else ""))
+    return not missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description="serial fan-out benchmark")
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[1, 10, 50, 100])
+    parser.add_argument("--slow", type=int, default=0, help="extra subscribers that never read")
+    parser.add_argument("--stalled-primary", action="store_true",
+                        help="the primary client never reads, the subscribers must still get everything")
+    parser.add_argument("--size", type=int, default=1 << 20, help="bytes written to the serial port")
+    parser.add_argument("--chunk", type=int, default=4096, help="write size on the serial side")
+    parser.add_argument("--queue-size", type=int, default=1024,
+                        help="chunks per subscriber, the single threaded clients of the benchmark need some slack")
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--base-port", type=int, default=17800)
+    args = parser.parse_args()
+
+    results = [run(subscribers, args, args.base_port + i) for i, subscribers in enumerate(args.subscribers)]
+    if args.stalled_primary and not all(results):
+        raise Exception("A stalled primary client held up the subscribers")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+#
+# round trips through an FTDI adapter model: the board on the master side
+# of a pty echoes every request, and like an FT232R the adapter holds
+# replies shorter than a USB packet until its latency timer expires. The
+# timer is read from a fake sysfs tree, so the device's latency profile is
+# applied there and must be restored when the device stops
+
+import argparse
+import os
+import select
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from bench_bridge import percentile
+from pty_harness import PtyRFC2217Device
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from latency_tuning import LatencyProfile  # noqa: E402
+
+USB_PACKET = 62  # payload of a full-speed FTDI packet, sent without waiting for the timer
+
+
+class FtdiBoard(object):
+    """echoes what the gateway writes, delaying replies by the latency
+       timer found in sysfs unless a full packet is pending"""
+
+    def __init__(self, master, latency_timer_path):
+        self.master = master
+        self.latency_timer_path = latency_timer_path
+        self.alive = True
+        self.thread = threading.Thread(target=self.__run)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.alive = False
+        self.thread.join()
+
+    def __run(self):
+        while self.alive:
+            if not select.select([self.master], [], [], 0.1)[0]:
+                continue
+            data = os.read(self.master, 4096)
+            if len(data) < USB_PACKET:
+                with open(self.latency_timer_path) as f:
+                    time.sleep(int(f.read()) / 1e3)
+            os.write(self.master, data)
+
+
+def fake_sysfs(root, slave_path, latency_timer):
+    """class/tty/<tty>/device/latency_timer as ftdi_sio exposes it"""
+    device = os.path.join(root, "class", "tty", os.path.basename(slave_path), "device")
+    os.makedirs(device)
+    path = os.path.join(device, "latency_timer")
+    with open(path, "w") as f:
+        f.write("{}\n".format(latency_timer))
+    return path
+
+
+def run(profile, args, port):
+    master, slave = os.openpty()
+    slave_path = os.ttyname(slave)
+    with tempfile.TemporaryDirectory() as sysfs_root:
+        latency_timer_path = fake_sysfs(sysfs_root, slave_path, args.default_timer)
+        board = FtdiBoard(master, latency_timer_path)
+        device = PtyRFC2217Device(slave_path, port, latency_profile=profile, sysfs_root=sysfs_root)
+        board.start()
+        device.start()
+        samples = []
+        try:
+            with open(latency_timer_path) as f:
+                applied = int(f.read())
+            client = socket.create_connection(("127.0.0.1", port))
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # telnet negotiation sent on connection
+            while select.select([client], [], [], 0.1)[0]:
+                client.recv(65536)
+            payload = bytes(range(args.size))
+            for i in range(args.messages):
+                started = time.perf_counter()
+                client.sendall(payload)
+                received = b""
+                while len(received) < len(payload):
+                    received += client.recv(len(payload) - len(received))
+                samples.append(time.perf_counter() - started)
+            client.close()
+        finally:
+            device.stop()
+            board.stop()
+            os.close(master)
+            os.close(slave)
+        with open(latency_timer_path) as f:
+            restored = int(f.read())
+    print("{:<22} latency_timer {:>3} ms while open, {:>3} ms after stop: {:>3} B round trip p50 {:>7.3f} "
+          "p99 {:>7.3f} ms".format(
+              "latency timer {} ms".format(profile.latency_timer) if profile else "no profile", applied, restored,
+              args.size, percentile(samples, 0.5) * 1e3, percentile(samples, 0.99) * 1e3))
+    return restored == args.default_timer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="USB-serial latency tuning benchmark")
+    parser.add_argument("--timers", type=int, nargs="+", default=[1, 2, 4], help="latency timers of the profile")
+    parser.add_argument("--default-timer", type=int, default=16)
+    parser.add_argument("--size", type=int, default=8, help="request size, below a USB packet")
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--base-port", type=int, default=18300)
+    args = parser.parse_args()
+
+    results = [run(None, args, args.base_port)]
+    for i, timer in enumerate(args.timers):
+        results.append(run(LatencyProfile(timer, low_latency=True), args, args.base_port + 1 + i))
+    if not all(results):
+        raise Exception("Latency timer not restored")
+
+
+if __name__ == "__main__":
+    main()
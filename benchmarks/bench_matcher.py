@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+#
+# cost of telling whether a tty udev event is a supported gateway device:
+# replays synthetic events through the DeviceMatcher index and through the
+# former SHA-224 lookup, after checking that both agree
+
+import argparse
+import hashlib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import gateway_devices  # noqa: E402
+from device_matcher import DeviceMatcher  # noqa: E402
+
+# tty devices found on a typical gateway host besides the sticks
+OTHER_DEVICES = [
+    {"ID_VENDOR_ID": "0403", "ID_MODEL_ID": "6001", "ID_VENDOR_ENC": "FTDI"},
+    {"ID_VENDOR_ID": "067b", "ID_MODEL_ID": "2303", "ID_VENDOR_ENC": "Prolific\\x20Technology\\x20Inc."},
+    {"ID_VENDOR_ID": "1a86", "ID_MODEL_ID": "7523", "ID_VENDOR_ENC": "1a86"},
+    {},  # virtual consoles and built-in UARTs have no USB properties
+]
+
+
+def sha224_identifier(model_id, vendor_id, vendor_enc):
+    return hashlib.sha224((model_id + vendor_id + vendor_enc).encode('utf-8')).hexdigest()
+
+
+class Sha224Matcher(object):
+    """the lookup used before the index, hashing every event"""
+
+    def __init__(self, device_classes):
+        self.valid_gateways = {sha224_identifier(c.ID_MODEL_ID, c.ID_VENDOR_ID, c.ID_VENDOR_ENC): c
+                               for c in device_classes}
+
+    def match(self, device):
+        id_model = device.get("ID_MODEL_ID")
+        id_vendor = device.get("ID_VENDOR_ID")
+        enc_vendor = device.get("ID_VENDOR_ENC")
+        if not id_model or not id_vendor or not enc_vendor:
+            return None
+        return self.valid_gateways.get(sha224_identifier(id_model, id_vendor, enc_vendor))
+
+
+def make_events(count, supported_ratio, seed=1):
+    random.seed(seed)
+    supported = [{"ID_VENDOR_ID": c.ID_VENDOR_ID, "ID_MODEL_ID": c.ID_MODEL_ID, "ID_VENDOR_ENC": c.ID_VENDOR_ENC}
+                 for c in gateway_devices.load_device_classes()]
+    events = []
+    for i in range(count):
+        template = random.choice(supported if random.random() < supported_ratio else OTHER_DEVICES)
+        event = dict(template, DEVNAME="/dev/ttyUSB{}".format(i % 32), ID_SERIAL="serial-{}".format(i),
+                     ID_PATH="pci-0000:00:14.0-usb-0:{}:1.0".format(i % 8 + 1))
+        events.append(event)
+    return events
+
+
+def replay(matcher, events, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for event in events:
+            # is_valid_device followed by create_usb_device, as done for every add
+            if matcher.match(event):
+                matcher.match(event)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="udev device matching benchmark")
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--supported-ratio", type=float, default=0.3, help="share of events from gateway sticks")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    events = make_events(args.events, args.supported_ratio)
+    device_classes = gateway_devices.load_device_classes()
+    index = DeviceMatcher(device_classes)
+    sha224 = Sha224Matcher(device_classes)
+    for event in events:
+        if index.match(event) is not sha224.match(event):
+            raise Exception("Matchers disagree on {}".format(event))
+
+    for name, matcher in (("sha224", sha224), ("index", index)):
+        elapsed = replay(matcher, events, args.repeat)
+        print("{:<7} {} events in {:.2f} ms, {:.2f} us/event".format(
+            name, args.events, elapsed * 1e3, elapsed / args.events * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+#
+# mDNS advertising cost with many devices: threads, open file descriptors
+# and time until every service is announced, with the shared batching
+# MDNSService against one Zeroconf instance per service as before. Checks
+# that two identical devices get distinct names and that a name already
+# in use on the network is registered again under the next one
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from zeroconf import ServiceInfo, Zeroconf  # noqa: E402
+
+from mdns_advertiser import MDNSAdvertiser  # noqa: E402
+from mdns_service import MDNSService  # noqa: E402
+
+
+def open_fds():
+    return len(os.listdir("/proc/self/fd"))
+
+
+def make_infos(count, base_port, properties_size):
+    infos = []
+    for i in range(count):
+        properties = {"HOME_ID": "{:08x}".format(i), "PADDING": "x" * properties_size}
+        infos.append(ServiceInfo("_rfc2217._tcp.local.", "bench {} {}._rfc2217._tcp.local.".format(os.getpid(), i),
+                                 socket.inet_aton("127.0.0.1"), base_port + i, 0, 0, properties,
+                                 "{}.local.".format(socket.gethostname())))
+    return infos
+
+
+def run_shared(infos):
+    service = MDNSService()
+    started = time.perf_counter()
+    service.start()
+    done = threading.Semaphore(0)
+    for info in infos:
+        service.register(info, done.release)
+    for info in infos:
+        done.acquire()
+    announced = time.perf_counter() - started
+    result = {"announce_seconds": announced, "threads": threading.active_count(), "fds": open_fds()}
+
+    started = time.perf_counter()
+    for info in infos:
+        service.unregister(info)
+    service.stop()
+    result["withdraw_seconds"] = time.perf_counter() - started
+    return result
+
+
+def run_per_service(infos):
+    instances = []
+    lock = threading.Lock()
+
+    def register(info):
+        zeroconf = Zeroconf()
+        zeroconf.register_service(info)
+        with lock:
+            instances.append((zeroconf, info))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=register, args=(info,)) for info in infos]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    announced = time.perf_counter() - started
+    result = {"announce_seconds": announced, "threads": threading.active_count(), "fds": open_fds()}
+
+    def unregister(zeroconf, info):
+        zeroconf.unregister_service(info)
+        zeroconf.close()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=unregister, args=instance) for instance in instances]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result["withdraw_seconds"] = time.perf_counter() - started
+    return result
+
+
+def check_conflicts(base_port, timeout):
+    service = MDNSService()
+    service.start()
+    # another host's service, seen through multicast loopback
+    other_host = Zeroconf()
+    taken = "bench taken {}".format(os.getpid())
+    other_host.register_service(ServiceInfo("_rfc2217._tcp.local.", "{}._rfc2217._tcp.local.".format(taken),
+                                            socket.inet_aton("127.0.0.1"), base_port, 0, 0, {},
+                                            "other-{}.local.".format(os.getpid())))
+    same = "bench stick {}".format(os.getpid())
+    advertisers = [MDNSAdvertiser("_rfc2217", name, base_port + 1 + i, {}, None, "lo", service)
+                   for i, name in enumerate((same, same, taken))]
+    try:
+        started = time.perf_counter()
+        for advertiser in advertisers:
+            advertiser.start()
+        for advertiser in advertisers:
+            if not advertiser.registered.wait(timeout):
+                raise Exception("mDNS name '{}' not registered in {} s".format(advertiser.name, timeout))
+        names = [advertiser.service.name for advertiser in advertisers]
+        print("conflicts: registered as {} in {:.3f} s".format(
+            ", ".join("'{}'".format(name.split(".")[0]) for name in names), time.perf_counter() - started))
+        if len(set(names)) != len(names) or advertisers[2].instance_name == taken:
+            raise Exception("mDNS names not made unique: {}".format(names))
+    finally:
+        for advertiser in advertisers:
+            advertiser.stop()
+        service.stop()
+        other_host.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mDNS advertising benchmark")
+    parser.add_argument("--services", type=int, default=50)
+    parser.add_argument("--modes", nargs="+", default=["shared", "per-service"], choices=["shared", "per-service"])
+    parser.add_argument("--base-port", type=int, default=17500)
+    parser.add_argument("--properties-size", type=int, default=32, help="bytes of padding in each TXT record")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds for a conflicting name to be registered")
+    args = parser.parse_args()
+
+    print("baseline: {} threads, {} fds".format(threading.active_count(), open_fds()))
+    for mode in args.modes:
+        infos = make_infos(args.services, args.base_port, args.properties_size)
+        function = run_shared if mode == "shared" else run_per_service
+        result = function(infos)
+        print("{:<12} {:>4} services: announced in {:>7.3f} s, withdrawn in {:>7.3f} s, {:>4} threads, {:>5} fds".format(
+            mode, args.services, result["announce_seconds"], result["withdraw_seconds"], result["threads"],
+            result["fds"]))
+    check_conflicts(args.base_port + args.services, args.timeout)
+
+
+if __name__ == "__main__":
+    main()
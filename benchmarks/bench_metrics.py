@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+#
+# cost of the per-device I/O counters on the data path, compared with the
+# work done for every chunk anyway: escaping it, and reading it from a pty
+# and sending it to a socket. Checks that counters updated from several
+# threads at once add up, and measures the cost of rendering the endpoint
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import timeit
+import tty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import rfc2217_codec  # noqa: E402
+from metrics import DeviceMetrics, MetricsRegistry  # noqa: E402
+
+
+def check_threads(threads, updates):
+    """every thread counts the same counters, none of the updates may be lost"""
+    metrics = DeviceMetrics()
+    barrier = threading.Barrier(threads)
+
+    def count():
+        barrier.wait()
+        for i in range(updates):
+            metrics.local().serial_settings_skipped += 1
+
+    workers = [threading.Thread(target=count) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    counted = metrics.serial_settings_skipped
+    print("{} threads x {} updates: {} counted".format(threads, updates, counted))
+    if counted != threads * updates:
+        raise Exception("{} counter updates lost".format(threads * updates - counted))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=1000000)
+    parser.add_argument("--chunk", type=int, default=64)
+    parser.add_argument("--devices", type=int, default=50)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    metrics = DeviceMetrics({"device": "/dev/ttyUSB0"})
+    data = bytes(args.chunk)
+    length = len(data)
+    # the reader loops fetch the counters of their thread once
+    counters = metrics.local()
+
+    def counted():
+        counters.serial_reads += 1
+        counters.serial_to_socket_bytes += length
+        counters.serial_to_socket_chunks += 1
+
+    def escape():
+        rfc2217_codec.escape(data)
+
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    sender, receiver = socket.socketpair()
+
+    def forward():
+        # the pty is written to and the socket drained here, the chunk is
+        # read, escaped and sent like the redirector does
+        os.write(master, data)
+        sender.send(rfc2217_codec.escape(os.read(slave, 65536)))
+        receiver.recv(65536)
+
+    updates = min(timeit.repeat(counted, number=args.number, repeat=3)) / args.number
+    lookup = min(timeit.repeat(metrics.local, number=args.number, repeat=3)) / args.number
+    baseline = min(timeit.repeat(escape, number=args.number, repeat=3)) / args.number
+    forwarded = min(timeit.repeat(forward, number=args.number // 10, repeat=3)) / (args.number // 10)
+    for fd in (master, slave):
+        os.close(fd)
+    sender.close()
+    receiver.close()
+    print("counter updates per chunk: {:.1f} ns".format(updates * 1e9))
+    print("counters lookup of the thread: {:.1f} ns".format(lookup * 1e9))
+    print("escape of a {} byte chunk: {:.1f} ns".format(args.chunk, baseline * 1e9))
+    print("pty to socket of a {} byte chunk: {:.1f} ns, counter updates are {:.1f}% of it".format(
+        args.chunk, forwarded * 1e9, updates / forwarded * 100))
+
+    check_threads(args.threads, args.number // args.threads)
+
+    registry = MetricsRegistry()
+    for i in range(args.devices):
+        registry.add(DeviceMetrics({"device": "/dev/ttyUSB{}".format(i), "port": 5000 + i}))
+    render = min(timeit.repeat(registry.to_prometheus, number=100, repeat=3)) / 100
+    print("rendering {} devices: {:.2f} ms".format(args.devices, render * 1e3))
+
+
+if __name__ == "__main__":
+    main()
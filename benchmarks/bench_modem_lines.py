@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+#
+# modem line changes reaching serial.rfc2217 clients: the gateway's
+# ModemLinesWatcher, which falls back to the shared poller on ptys, against
+# the former status line poller thread of every connection. CTS of a pty
+# port is modelled in Python and toggled at random times; reports the
+# time until the client gets NOTIFY_MODEMSTATE, the wakeups per second of
+# the modem line threads while idle, and the threads left after stopping.
+# --uart checks that stopping wakes a watcher blocked in TIOCMIWAIT on a
+# real port, which ptys don't implement
+
+import argparse
+import os
+import random
+import socket
+import sys
+import threading
+import time
+import tty
+
+import serial
+import serial.rfc2217
+
+from bench_bridge import percentile
+from pty_harness import PtySerial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import modem_lines_monitor  # noqa: E402
+from io_engine import IOEngine  # noqa: E402
+from rfc2217_device import RFC2217Device, accept_client  # noqa: E402
+from rfc2217_redirector import Redirector  # noqa: E402
+
+MODEM_LINE_THREADS = ("modem lines poll", "modem lines wait", "status line poll")
+
+
+class LinesSerial(PtySerial):
+    """pty whose CTS line is set by the benchmark"""
+
+    cts_state = False
+
+    @property
+    def cts(self):
+        return self.cts_state
+
+
+def open_lines_serial(port_path):
+    ser = LinesSerial(None)
+    ser.port = port_path
+    ser.timeout = 3
+    ser.open()
+    return ser
+
+
+class LinesDevice(RFC2217Device):
+    def connect_serial_port(self, port_path):
+        return open_lines_serial(port_path)
+
+
+class PollingRedirector(Redirector):
+    """the status line poller every connection had before the watcher"""
+
+    def __init__(self, serial_instance, socket, interval):
+        self.interval = interval
+        super().__init__(serial_instance, socket, poll_modem_lines=True)
+
+    def statusline_poller(self):
+        while self.alive:
+            time.sleep(self.interval)
+            try:
+                self.rfc2217.check_modem_lines()
+            except OSError:
+                break
+
+
+class PollingDevice(object):
+    """one client per device, served with a polling redirector"""
+
+    def __init__(self, device_path, tcp_port, interval):
+        self.s_port = open_lines_serial(device_path)
+        self.interval = interval
+        self.server = socket.create_server(("", tcp_port))
+        self.redirector = None
+        self.thread = threading.Thread(target=self.__serve)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        if self.redirector:
+            self.redirector.stop()
+        self.thread.join()
+        self.s_port.close()
+        self.server.close()
+
+    def __serve(self):
+        client_socket, peer = accept_client(self.server)
+        self.redirector = PollingRedirector(self.s_port, client_socket, self.interval)
+        self.redirector.shortcircuit()
+
+
+class NotifiedClient(serial.rfc2217.Serial):
+    """keeps the arrival time of every modem state notification"""
+
+    def __init__(self, *args, **kwargs):
+        self.notifications = []
+        super().__init__(*args, **kwargs)
+
+    def _telnet_process_subnegotiation(self, suboption):
+        if suboption[1:2] == serial.rfc2217.SERVER_NOTIFY_MODEMSTATE:
+            self.notifications.append(time.perf_counter())
+        super()._telnet_process_subnegotiation(suboption)
+
+
+def modem_line_wakeups():
+    """context switches of the threads handling modem lines"""
+    switches = 0
+    for thread in threading.enumerate():
+        if thread.name not in MODEM_LINE_THREADS:
+            continue
+        try:
+            with open("/proc/self/task/{}/status".format(thread.native_id)) as status:
+                for line in status:
+                    if line.startswith(("voluntary_ctxt_switches", "nonvoluntary_ctxt_switches")):
+                        switches += int(line.split()[1])
+        except FileNotFoundError:
+            pass
+    return switches
+
+
+def modem_line_threads():
+    return len([thread for thread in threading.enumerate() if thread.name in MODEM_LINE_THREADS])
+
+
+def run(mode, args, base_port):
+    engine = None
+    if mode == "watcher eventloop":
+        engine = IOEngine()
+        engine.start()
+    ptys = []
+    devices = []
+    clients = []
+    try:
+        for i in range(args.devices):
+            master, slave = os.openpty()
+            tty.setraw(master)
+            tty.setraw(slave)
+            ptys += [master, slave]
+            if mode.startswith("poll "):
+                device = PollingDevice(os.ttyname(slave), base_port + i, float(mode.split()[1]))
+            else:
+                device = LinesDevice(os.ttyname(slave), base_port + i, engine)
+            device.start()
+            devices.append(device)
+        clients = [NotifiedClient("rfc2217://127.0.0.1:{}".format(base_port + i), timeout=1)
+                   for i in range(args.devices)]
+        time.sleep(0.5)
+
+        before = modem_line_wakeups()
+        time.sleep(args.idle)
+        wakeups = (modem_line_wakeups() - before) / args.idle
+        threads = modem_line_threads()
+
+        latencies = []
+        port = devices[0].s_port
+        for i in range(args.toggles):
+            time.sleep(random.uniform(0.1, 0.6))
+            received = len(clients[0].notifications)
+            toggled = time.perf_counter()
+            port.cts_state = not port.cts_state
+            deadline = time.monotonic() + args.timeout
+            while len(clients[0].notifications) == received and time.monotonic() < deadline:
+                time.sleep(0.001)
+            if len(clients[0].notifications) == received:
+                raise Exception("No NOTIFY_MODEMSTATE {} s after CTS changed".format(args.timeout))
+            latencies.append(clients[0].notifications[received] - toggled)
+    finally:
+        for client in clients:
+            client.close()
+        for device in devices:
+            device.stop()
+        if engine:
+            engine.stop()
+        for fd in ptys:
+            os.close(fd)
+    # the shared poller exits at its next round once it has no ports left
+    time.sleep(modem_lines_monitor.ModemLinesPoller.INTERVAL + 0.2)
+    left = modem_line_threads()
+    print("{:<18} {:>3} dev  CTS to client p50 {:>6.1f} p99 {:>6.1f} max {:>6.1f} ms, idle {:>5.1f} wakeups/s "
+          "in {:>3} modem line threads, {} left after stop".format(
+              mode, args.devices, percentile(latencies, 0.5) * 1e3, percentile(latencies, 0.99) * 1e3,
+              max(latencies) * 1e3, wakeups, threads, left))
+    return left == 0
+
+
+def check_uart(path):
+    """a watcher blocked in TIOCMIWAIT on a real port ends when stopped"""
+    port = serial.Serial(path)
+    watcher = modem_lines_monitor.ModemLinesWatcher(port, lambda: None)
+    watcher.start()
+    time.sleep(0.2)
+    if watcher.polling:
+        print("{}: TIOCMIWAIT not supported, nothing to check".format(path))
+        port.close()
+        return True
+    blocked = watcher.thread.is_alive()
+    started = time.perf_counter()
+    watcher.stop()
+    stopped = time.perf_counter() - started
+    ended = not watcher.thread.is_alive()
+    port.close()
+    print("{}: watcher {} in TIOCMIWAIT, {} {:.1f} ms after stop()".format(
+        path, "blocked" if blocked else "not blocked", "ended" if ended else "still running", stopped * 1e3))
+    return ended
+
+
+def main():
+    parser = argparse.ArgumentParser(description="modem line notification latency and idle wakeups")
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--modes", nargs="+", default=["watcher", "watcher eventloop", "poll 0.5", "poll 1"],
+                        help="'poll <seconds>' is a status line poller per connection")
+    parser.add_argument("--toggles", type=int, default=20, help="CTS changes timed per mode")
+    parser.add_argument("--idle", type=float, default=5, help="seconds the idle wakeups are counted over")
+    parser.add_argument("--timeout", type=float, default=3)
+    parser.add_argument("--uart", help="real serial port to check the TIOCMIWAIT wakeup on, e.g. /dev/ttyS0")
+    parser.add_argument("--base-port", type=int, default=18700)
+    args = parser.parse_args()
+
+    results = []
+    for i, mode in enumerate(args.modes):
+        results.append(run(mode, args, args.base_port + i * args.devices))
+    if args.uart:
+        results.append(check_uart(args.uart))
+    if not all(results):
+        raise Exception("Modem line threads left running")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+#
+# probe and bridge sharing one serial port: a Z-Wave stick model on the
+# master side of a pty streams numbered records and answers the home id
+# request, the Z-Wave probe borrows the port through the broker while a
+# client already waits on the socket, then the port is handed over. Checks
+# that every record went to exactly one of them, the probe's before the
+# bridge's, and that the stick saw the probe's bytes before the client's
+
+import argparse
+import os
+import re
+import select
+import socket
+import sys
+import threading
+import time
+
+from pty_harness import PtyRFC2217Device
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from gateway_devices.zwave_serial_api import ZWaveFrameDecoder, ZWaveHomeIdHandler  # noqa: E402
+from io_engine import IOEngine  # noqa: E402
+from port_broker import PortBroker  # noqa: E402
+
+RECORD = re.compile(rb"R(\d{8})\n")
+BRIDGE_BYTE = b"B"
+
+
+def home_id_response(home_id):
+    frame = bytearray([ZWaveFrameDecoder.SOF, 8, ZWaveFrameDecoder.RESPONSE, ZWaveHomeIdHandler.FUNC_ID_MEMORY_GET_ID])
+    frame += bytes.fromhex(home_id) + b"\x01"
+    frame.append(ZWaveFrameDecoder.checksum(frame[1:]))
+    return b"\x06" + bytes(frame)
+
+
+class Stick(object):
+    """streams records at rate per second with blocking writes, nothing is
+       dropped on this side, and answers the home id request if asked to"""
+
+    def __init__(self, master, rate, answer):
+        self.master = master
+        self.rate = rate
+        self.answer = answer
+        self.records = 0
+        self.received = bytearray()
+        self.alive = True
+        self._lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.__stream), threading.Thread(target=self.__listen)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.alive = False
+        for thread in self.threads:
+            thread.join()
+
+    def __write(self, data):
+        with self._lock:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self.master, view):]
+
+    def __stream(self):
+        started = time.perf_counter()
+        while self.alive:
+            due = int((time.perf_counter() - started) * self.rate)
+            while self.records < due:
+                self.__write(b"R%08d\n" % self.records)
+                self.records += 1
+            time.sleep(0.001)
+
+    def __listen(self):
+        while self.alive:
+            if not select.select([self.master], [], [], 0.1)[0]:
+                continue
+            data = os.read(self.master, 4096)
+            self.received += data
+            if self.answer and ZWaveHomeIdHandler.MEMORY_ID_COMMAND in self.received:
+                self.answer = False
+                self.__write(home_id_response("cafebabe"))
+
+
+class RecordingBroker(PortBroker):
+    """keeps a copy of everything handed to the probes"""
+
+    def __init__(self, serial_instance):
+        super().__init__(serial_instance)
+        self.probe_data = bytearray()
+
+    def subscribe(self, on_data, settings=None):
+        def recording(data):
+            self.probe_data += data
+            on_data(data)
+        return super().subscribe(recording, settings)
+
+
+def run(transport, engine_name, answer, args, port):
+    engine = None
+    if engine_name == "eventloop":
+        engine = IOEngine()
+        engine.start()
+    master, slave = os.openpty()
+    raw_settings = {"baudrate": 115200} if transport == "raw" else None
+    device = PtyRFC2217Device(os.ttyname(slave), port, engine, raw_settings=raw_settings)
+    device.port_broker = RecordingBroker(device.s_port)
+    stick = Stick(master, args.rate, answer)
+    stick.start()
+    client = None
+    try:
+        probe = ZWaveHomeIdHandler(device.port_broker)
+        probe.start()
+        # a client connecting during the probe waits on the socket
+        client = socket.create_connection(("127.0.0.1", port))
+        client.sendall(BRIDGE_BYTE)
+        started = time.perf_counter()
+        home_id = probe.get_home_id(args.probe_timeout)
+        if home_id:
+            probe.stop()
+        device.start()
+        hand_over = time.perf_counter() - started
+        data = bytearray()
+        deadline = time.monotonic() + args.duration
+        while time.monotonic() < deadline:
+            if select.select([client], [], [], 0.05)[0]:
+                data += client.recv(65536)
+            client.sendall(BRIDGE_BYTE)
+        stick.stop()
+        while select.select([client], [], [], 0.5)[0]:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        stick.alive = False
+        if client:
+            client.close()
+        device.stop()
+        if engine:
+            engine.stop()
+        stick.stop()
+        os.close(master)
+        os.close(slave)
+
+    probe_records = [int(n) for n in RECORD.findall(bytes(device.port_broker.probe_data))]
+    bridge_records = [int(n) for n in RECORD.findall(bytes(data))]
+    both = probe_records + bridge_records
+    first_bridge_byte = stick.received.find(BRIDGE_BYTE)
+    checks = {
+        "no duplicates": len(set(both)) == len(both),
+        "no loss": both == list(range(stick.records)),
+        "probe first": not probe_records or not bridge_records or probe_records[-1] < bridge_records[0],
+        "probe writes first": first_bridge_byte >= 0 and ZWaveHomeIdHandler.MEMORY_ID_COMMAND in
+        stick.received[:first_bridge_byte],
+    }
+    print("{:<7} {:<9} {:<17} home id {:<8} port to the bridge after {:>6.1f} ms, {:>5} records to the probe, "
+          "{:>5} to the bridge of {:>5}: {}".format(
+              transport, engine_name, "stick answers" if answer else "stick silent", str(home_id), hand_over * 1e3,
+              len(probe_records), len(bridge_records), stick.records,
+              ", ".join(name for name, ok in checks.items() if not ok) or "ok"))
+    return all(checks.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="probe to bridge hand over of a shared serial port")
+    parser.add_argument("--rate", type=float, default=2000, help="records per second from the stick")
+    parser.add_argument("--duration", type=float, default=1, help="seconds the bridge client reads")
+    parser.add_argument("--probe-timeout", type=float, default=1)
+    parser.add_argument("--base-port", type=int, default=18400)
+    args = parser.parse_args()
+
+    results = []
+    port = args.base_port
+    for transport, engine_name in (("rfc2217", "threaded"), ("rfc2217", "eventloop"), ("raw", "threaded")):
+        for answer in (True, False):
+            results.append(run(transport, engine_name, answer, args, port))
+            port += 1
+    if not all(results):
+        raise Exception("Probe and bridge traffic mixed up")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+#
+# client reconnections on a device that keeps talking: a pty is written
+# with numbered lines at a fixed rate, like a UART that overruns when
+# nobody reads it. Reports the lines lost while no client was connected
+# with and without session mode, the replay age limit, how fast a new
+# client gets data while a stale one is still connected and the dead peer
+# socket options. Reconnecting is also run with subscribers allowed, where
+# the fan out reader replays the session to the next client
+
+import argparse
+import os
+import re
+import select
+import socket
+import sys
+import threading
+import time
+
+from pty_harness import PtyRFC2217Device
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from session import SessionPolicy, set_dead_peer_timeout  # noqa: E402
+
+LINE = re.compile(rb"(\d{8})\n")
+
+
+class LineWriter(object):
+    """writes numbered lines to the master side at rate bytes per second,
+       lines that don't fit in the pty are lost like on an overrun UART"""
+
+    def __init__(self, master, rate):
+        self.master = master
+        self.rate = rate
+        self.lines = 0
+        self.overruns = 0
+        self.alive = True
+        self.thread = threading.Thread(target=self.__run)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.alive = False
+        self.thread.join()
+
+    def __run(self):
+        os.set_blocking(self.master, False)
+        started = time.perf_counter()
+        while self.alive:
+            due = int((time.perf_counter() - started) * self.rate / 9)
+            while self.lines < due:
+                try:
+                    os.write(self.master, b"%08d\n" % self.lines)
+                except BlockingIOError:
+                    self.overruns += 1
+                self.lines += 1
+            time.sleep(0.01)
+
+
+def connect(port):
+    client = socket.create_connection(("127.0.0.1", port))
+    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return client
+
+
+def receive(client, duration):
+    """everything received for duration seconds, telnet negotiation included"""
+    data = bytearray()
+    deadline = time.monotonic() + duration
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not select.select([client], [], [], remaining)[0]:
+            break
+        chunk = client.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def start_device(transport, port, session_policy, max_subscribers=0):
+    master, slave = os.openpty()
+    raw_settings = {"baudrate": 115200} if transport == "raw" else None
+    device = PtyRFC2217Device(os.ttyname(slave), port, raw_settings=raw_settings, session_policy=session_policy,
+                              max_subscribers=max_subscribers)
+    device.start()
+    return device, master, slave
+
+
+def stop_device(device, master, slave):
+    device.stop()
+    os.close(master)
+    os.close(slave)
+
+
+def reconnect(transport, port, session_policy, args, max_subscribers=0):
+    """one client, a gap with nobody connected, the next client"""
+    device, master, slave = start_device(transport, port, session_policy, max_subscribers)
+    writer = LineWriter(master, args.rate)
+    try:
+        writer.start()
+        first = connect(port)
+        data = receive(first, args.connected)
+        first.close()
+        time.sleep(args.gap)
+        second = connect(port)
+        second_data = receive(second, args.connected)
+        data += second_data
+        writer.stop()
+        data += receive(second, 0.5)
+        second.close()
+    finally:
+        writer.stop()
+        stop_device(device, master, slave)
+    received = set(int(number) for number in LINE.findall(bytes(data)))
+    metrics = device.metrics
+    print("{:<7} {:<34} {:>7} lines written, {:>7} lost ({:>7} overrun in the pty), "
+          "{:>8} B replayed {:>8} B dropped".format(
+              transport, describe(session_policy, max_subscribers), writer.lines, writer.lines - len(received),
+              writer.overruns, metrics.session_replayed_bytes, metrics.session_dropped_bytes))
+    if session_policy and not LINE.search(bytes(second_data)):
+        raise Exception("The client reconnecting to '{}' got no data".format(describe(session_policy,
+                                                                                      max_subscribers)))
+
+
+def takeover(transport, port, session_policy, args):
+    """a client that stopped reading without closing, then a new client"""
+    device, master, slave = start_device(transport, port, session_policy)
+    writer = LineWriter(master, args.rate)
+    clients = []
+    try:
+        writer.start()
+        clients.append(connect(port))
+        receive(clients[0], 0.2)
+        started = time.perf_counter()
+        clients.append(connect(port))
+        result = "no data after {} s".format(args.timeout)
+        deadline = time.monotonic() + args.timeout
+        data = bytearray()
+        while time.monotonic() < deadline:
+            if not select.select([clients[1]], [], [], deadline - time.monotonic())[0]:
+                break
+            chunk = clients[1].recv(65536)
+            if not chunk:
+                result = "closed by the gateway after {:.3f} ms".format((time.perf_counter() - started) * 1e3)
+                break
+            data += chunk
+            if LINE.search(bytes(data)):
+                result = "first line after {:.3f} ms".format((time.perf_counter() - started) * 1e3)
+                break
+    finally:
+        writer.stop()
+        for client in clients:
+            client.close()
+        stop_device(device, master, slave)
+    print("{:<7} {:<34} second client: {}, {} takeovers".format(
+        transport, describe(session_policy), result, device.metrics.session_takeovers))
+
+
+def dead_peer_options(timeout):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    client = socket.create_connection(server.getsockname())
+    accepted, _ = server.accept()
+    try:
+        set_dead_peer_timeout(accepted, timeout)
+        options = [(name, accepted.getsockopt(level, option)) for name, level, option in (
+            ("SO_KEEPALIVE", socket.SOL_SOCKET, socket.SO_KEEPALIVE),
+            ("TCP_KEEPIDLE", socket.IPPROTO_TCP, socket.TCP_KEEPIDLE),
+            ("TCP_KEEPINTVL", socket.IPPROTO_TCP, socket.TCP_KEEPINTVL),
+            ("TCP_KEEPCNT", socket.IPPROTO_TCP, socket.TCP_KEEPCNT),
+            ("TCP_USER_TIMEOUT", socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT))]
+    finally:
+        accepted.close()
+        client.close()
+        server.close()
+    idle, interval, count = options[1][1], options[2][1], options[3][1]
+    # a loopback peer can't vanish, the worst case follows from the options
+    print("dead peer timeout {} s: {}, an idle dead peer is dropped after {} s".format(
+        timeout, " ".join("{}={}".format(name, value) for name, value in options), idle + interval * count))
+
+
+def describe(session_policy, max_subscribers=0):
+    if not session_policy:
+        return "no session"
+    return "session{} max age {} s{}".format("" if session_policy.takeover else " no takeover",
+                                            session_policy.replay_max_age, " fan out" if max_subscribers else "")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="client reconnection benchmark")
+    parser.add_argument("--transports", nargs="+", default=["rfc2217", "raw"], choices=["rfc2217", "raw"])
+    parser.add_argument("--rate", type=float, default=100000, help="serial bytes per second")
+    parser.add_argument("--connected", type=float, default=1, help="seconds each client stays connected")
+    parser.add_argument("--gap", type=float, default=2, help="seconds without a client")
+    parser.add_argument("--replay-buffer-size", type=int, default=1 << 20)
+    parser.add_argument("--max-age", type=float, default=30)
+    parser.add_argument("--short-max-age", type=float, default=1, help="replay age limit below the gap")
+    parser.add_argument("--timeout", type=float, default=2, help="seconds to wait for the second client's data")
+    parser.add_argument("--dead-peer-timeout", type=int, default=10)
+    parser.add_argument("--base-port", type=int, default=18000)
+    args = parser.parse_args()
+
+    port = args.base_port
+    for transport in args.transports:
+        for policy in (None, SessionPolicy(args.replay_buffer_size, args.max_age, args.dead_peer_timeout),
+                       SessionPolicy(args.replay_buffer_size, args.short_max_age, args.dead_peer_timeout)):
+            reconnect(transport, port, policy, args)
+            port += 1
+    if "rfc2217" in args.transports:
+        # raw clients don't go with subscribers
+        reconnect("rfc2217", port, SessionPolicy(args.replay_buffer_size, args.max_age, args.dead_peer_timeout),
+                  args, max_subscribers=1)
+        port += 1
+    for transport in args.transports:
+        for policy in (None, SessionPolicy(args.replay_buffer_size, args.max_age, args.dead_peer_timeout),
+                       SessionPolicy(args.replay_buffer_size, args.max_age, args.dead_peer_timeout, False)):
+            takeover(transport, port, policy, args)
+            port += 1
+    dead_peer_options(args.dead_peer_timeout)
+
+
+if __name__ == "__main__":
+    main()
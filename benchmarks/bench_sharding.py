@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+#
+# per-device round-trip latency while another device streams as fast as it
+# can, with every device in one process and spread over shard workers. The
+# first pty is written to without pause and its client only drains the
+# socket, the other devices run 64 byte round trips over plain sockets.
+# Sharded runs then kill the worker of the second device and time until a
+# new client of that device gets its echo, and check that the metrics kept
+# counting from where the dead worker stopped. Workers must serve the ports
+# on the gateway's open file, before and after the restart, and devices
+# started concurrently must be spread evenly over the shards
+
+import argparse
+import os
+import select
+import threading
+import time
+
+from bench_bridge import percentile, read_exactly, run_parallel
+from bench_uds import SocketReader, connect
+from pty_harness import BridgeConfig, PtyBridge, PtySide
+
+
+class Load(object):
+    """writes to the pty of the first device without pause, drains its client"""
+
+    CHUNK = bytes(i % 255 for i in range(16384))
+
+    def __init__(self, master, client):
+        self.master = master
+        self.client = client
+        self.sent = 0
+        self.received = 0
+        self.alive = False
+        self.threads = [threading.Thread(target=self.__write), threading.Thread(target=self.__read)]
+
+    def start(self):
+        self.alive = True
+        self.started = time.perf_counter()
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.alive = False
+        for thread in self.threads:
+            thread.join()
+        return self.received / (time.perf_counter() - self.started)
+
+    def __write(self):
+        while self.alive:
+            if select.select([], [self.master], [], 0.1)[1]:
+                self.sent += os.write(self.master, self.CHUNK)
+
+    def __read(self):
+        while self.alive:
+            if select.select([self.client], [], [], 0.1)[0]:
+                self.received += len(self.client.recv(65536))
+
+
+def round_trips(clients, payload, messages):
+    latencies = []
+    lock = threading.Lock()
+
+    def client_loop(index):
+        reader = SocketReader(clients[index], 5)
+        samples = []
+        for i in range(messages):
+            start = time.perf_counter()
+            clients[index].sendall(payload)
+            if read_exactly(reader, len(payload)) != payload:
+                raise Exception("Echoed data differs on device {}".format(index + 1))
+            samples.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(samples)
+
+    run_parallel(client_loop, len(clients))
+    return latencies
+
+
+def recover(bridge, config, payload, timeout):
+    """kill the worker of the second device, seconds until a new client of it gets its echo"""
+    killed = time.perf_counter()
+    shard = bridge.kill_shard()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            # the listening socket stays in the gateway process, the connection
+            # waits in its backlog until the restarted worker accepts it
+            client = connect("tcp", config, 1)
+        except OSError:
+            time.sleep(0.01)
+            continue
+        try:
+            client.sendall(payload)
+            data = bytearray()
+            # the telnet negotiation of the new worker comes first
+            while not data.endswith(payload) and time.monotonic() < deadline:
+                if not select.select([client], [], [], 0.1)[0]:
+                    continue
+                chunk = client.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            if data.endswith(payload):
+                return shard, time.perf_counter() - killed
+        except OSError:
+            pass
+        finally:
+            client.close()
+    raise Exception("Device 1 not back {} s after its worker was killed".format(timeout))
+
+
+def check_tty_handles(stats, devices, when):
+    print("{:<13} {}: {} worker tty descriptors share the gateway's open file, {} opened by the workers".format(
+        "", when, stats["worker_tty_shared"], stats["worker_tty_opened"]))
+    if stats["worker_tty_opened"] or stats["worker_tty_shared"] != devices:
+        raise Exception("Workers don't serve the ports on the gateway's handles {}".format(when))
+
+
+def run(shards, args):
+    config = BridgeConfig(args.devices, args.engine, base_port=args.base_port, shards=shards)
+    bridge = PtyBridge(config, connect_clients=False)
+    bridge.start()
+    clients = []
+    load_client = None
+    try:
+        load_client = connect("tcp", config, 0)
+        clients = [connect("tcp", config, i) for i in range(1, args.devices)]
+        bridge.pty_side.reset(PtySide.ECHO)
+        # no 0xff, nothing is escaped and the echo comes back unchanged
+        payload = bytes(i % 255 for i in range(64))
+        idle = round_trips(clients, payload, args.messages)
+        load = Load(bridge.masters[0], load_client)
+        before = bridge.stats()
+        load.start()
+        loaded = round_trips(clients, payload, args.messages)
+        rate = load.stop()
+        # the workers report their counters every ShardPool.STATS_INTERVAL
+        time.sleep(args.stats_wait if shards else 0)
+        after = bridge.stats()
+        print("{:<13} {} dev {:<9} idle p50 {:>6.3f} p99 {:>6.3f} ms, loaded p50 {:>6.3f} p99 {:>6.3f} ms, "
+              "load {:>6.1f} MB/s, gateway cpu {:>5.2f} s, {:>5.1f} MB counted, {:>5.1f} MB received".format(
+                  "{} shards".format(shards) if shards else "single process", args.devices, args.engine,
+                  percentile(idle, 0.5) * 1e3, percentile(idle, 0.99) * 1e3,
+                  percentile(loaded, 0.5) * 1e3, percentile(loaded, 0.99) * 1e3, rate / 1e6,
+                  after["cpu_seconds"] - before["cpu_seconds"],
+                  (after["serial_to_socket_bytes"] - before["serial_to_socket_bytes"]) / 1e6, load.received / 1e6))
+        if shards:
+            print("{:<13} devices per shard: {}".format("", " ".join(str(count) for count in after["shard_devices"])))
+            if max(after["shard_devices"]) - min(after["shard_devices"]) > 1:
+                raise Exception("Devices started concurrently not spread over the shards")
+            check_tty_handles(after, args.devices, "started")
+        if shards and args.crash:
+            shard, seconds = recover(bridge, config, payload, args.recovery_timeout)
+            time.sleep(args.stats_wait)
+            recovered = bridge.stats()
+            print("{:<13} worker of shard {} killed, device 1 echoes again after {:.0f} ms, {} restarts, "
+                  "metrics {}".format("", shard, seconds * 1e3, recovered["shard_restarts"],
+                                      "kept" if recovered["serial_to_socket_bytes"] >= after["serial_to_socket_bytes"]
+                                      else "reset"))
+            check_tty_handles(recovered, args.devices, "restarted")
+    finally:
+        for client in clients + ([load_client] if load_client else []):
+            client.close()
+        bridge.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cross-device latency in one process and sharded over workers")
+    parser.add_argument("--devices", type=int, default=4, help="the first one carries the load")
+    parser.add_argument("--shards", type=int, nargs="+", default=[0, 2], help="0 runs every device in one process")
+    parser.add_argument("--engine", default="threaded", choices=["threaded", "eventloop"])
+    parser.add_argument("--messages", type=int, default=2000, help="round trips per device, idle and loaded")
+    parser.add_argument("--stats-wait", type=float, default=1.5, help="seconds for the workers to report")
+    parser.add_argument("--no-crash", dest="crash", action="store_false", help="don't kill a worker")
+    parser.add_argument("--recovery-timeout", type=float, default=10)
+    parser.add_argument("--base-port", type=int, default=18500)
+    args = parser.parse_args()
+    if args.devices < 2:
+        raise Exception("At least two devices are needed, one loaded and one measured")
+
+    print("{} CPUs".format(os.cpu_count()))
+    for shards in args.shards:
+        run(shards, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+#
+# time to stop every device against the device count, with clients
+# connected to part of them, stopping the devices one after the other or
+# concurrently as UsbDevicesHandler.stop_all_devices does. Checks that a
+# failing call doesn't end the IO engine, and that devices still stop once
+# the engine loop itself failed
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+from pty_harness import PtyRFC2217Device
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from io_engine import IOEngine  # noqa: E402
+
+
+def start_devices(count, base_port, engine, connected_ratio):
+    devices = []
+    masters = []
+    clients = []
+    for i in range(count):
+        master, slave = os.openpty()
+        device = PtyRFC2217Device(os.ttyname(slave), base_port + i, engine)
+        device.start()
+        devices.append(device)
+        masters.append((master, slave))
+    for i in range(int(count * connected_ratio)):
+        clients.append(socket.create_connection(("127.0.0.1", base_port + i)))
+    # wait for the sessions to start, their readers block on the serial ports
+    deadline = time.monotonic() + 5
+    while sum(device.metrics.connected for device in devices) < len(clients):
+        if time.monotonic() > deadline:
+            raise Exception("Sessions did not start")
+        time.sleep(0.01)
+    return devices, masters, clients
+
+
+def stop_sequentially(devices):
+    for device in devices:
+        device.stop()
+
+
+def stop_concurrently(devices):
+    threads = [threading.Thread(target=device.stop) for device in devices]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def check_engine_failures(base_port, timeout):
+    engine = IOEngine()
+    engine.start()
+    devices, masters, clients = start_devices(2, base_port, engine, 0.5)
+    try:
+        def fail():
+            raise Exception("failing call")
+        engine.call_soon(fail)
+        engine.call_and_wait(lambda: None)
+        if not engine.thread.is_alive():
+            raise Exception("A failing call ended the IO engine")
+        stop_sequentially(devices[:1])
+        # the loop fails in select() on the closed selector
+        engine.selector.close()
+        engine.thread.join(timeout)
+        stopping = threading.Thread(target=devices[1].stop)
+        stopping.daemon = True
+        started = time.perf_counter()
+        stopping.start()
+        stopping.join(timeout)
+        if stopping.is_alive():
+            raise Exception("Device not stopped {} s after the IO engine loop failed".format(timeout))
+        print("eventloop failing call logged, engine kept running; device stopped {:.1f} ms after the "
+              "loop failed".format((time.perf_counter() - started) * 1e3))
+    finally:
+        engine.stop()
+        for client in clients:
+            client.close()
+        for master, slave in masters:
+            os.close(master)
+            os.close(slave)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="device shutdown benchmark")
+    parser.add_argument("--devices", type=int, nargs="+", default=[1, 10, 40])
+    parser.add_argument("--engines", nargs="+", default=["threaded", "eventloop"], choices=["threaded", "eventloop"])
+    parser.add_argument("--connected-ratio", type=float, default=0.5, help="share of devices with a client")
+    parser.add_argument("--base-port", type=int, default=17700)
+    parser.add_argument("--timeout", type=float, default=5)
+    args = parser.parse_args()
+
+    for engine_name in args.engines:
+        for count in args.devices:
+            for mode, stop in (("sequential", stop_sequentially), ("concurrent", stop_concurrently)):
+                engine = None
+                if engine_name == "eventloop":
+                    engine = IOEngine()
+                    engine.start()
+                devices, masters, clients = start_devices(count, args.base_port, engine, args.connected_ratio)
+                started = time.perf_counter()
+                stop(devices)
+                elapsed = time.perf_counter() - started
+                if engine:
+                    engine.stop()
+                for client in clients:
+                    client.close()
+                for master, slave in masters:
+                    os.close(master)
+                    os.close(slave)
+                print("{:<9} {:>4} devices {:<10} stopped in {:>8.1f} ms".format(
+                    engine_name, count, mode, elapsed * 1e3))
+    if "eventloop" in args.engines:
+        check_engine_failures(args.base_port, args.timeout)
+
+
+if __name__ == "__main__":
+    main()
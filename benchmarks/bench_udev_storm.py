@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+#
+# udev event storms, as produced by hub resets and flaky cables: replays
+# flapping add/remove sequences from a fake udev source and counts the
+# device creations and destructions with and without the dispatcher,
+# checking that every device ends up in the state of its last event
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from udev_event_dispatcher import UdevEventDispatcher  # noqa: E402
+
+
+class FakeUdevSource(object):
+    """flapping add/remove sequences of several devices, interleaved"""
+
+    def __init__(self, devices, flaps, seed=1):
+        random.seed(seed)
+        self.expected = {}
+        sequences = []
+        for i in range(devices):
+            device = {"DEVNAME": "/dev/ttyUSB{}".format(i), "ID_SERIAL": "stick-{}".format(i)}
+            events = []
+            present = random.random() < 0.5
+            if present:
+                events.append(("add", device))
+            for _ in range(random.randint(flaps // 2, flaps)):
+                present = not present
+                events.append(("add" if present else "remove", device))
+            self.expected[device["DEVNAME"]] = present
+            sequences.append(events)
+        self.events = []
+        while any(sequences):
+            sequence = random.choice([s for s in sequences if s])
+            self.events.append(sequence.pop(0))
+
+    def replay(self, post, interval):
+        for action, device in self.events:
+            post(action, device)
+            if interval:
+                time.sleep(interval)
+
+
+class FakeHandler(object):
+    """stands for UsbDevicesHandler, with the cost of a bring-up and a tear-down"""
+
+    def __init__(self, operation_time):
+        self.operation_time = operation_time
+        self.present = set()
+        self.created = 0
+        self.destroyed = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def create_usb_device(self, device):
+        with self._lock:
+            if device["DEVNAME"] in self.present:
+                self.errors += 1
+                return
+            self.present.add(device["DEVNAME"])
+            self.created += 1
+        time.sleep(self.operation_time)
+
+    def delete_usb_device(self, device):
+        with self._lock:
+            if device["DEVNAME"] not in self.present:
+                self.errors += 1
+                return
+            self.present.discard(device["DEVNAME"])
+            self.destroyed += 1
+        time.sleep(self.operation_time)
+
+    def post(self, action, device):
+        if action == "add":
+            self.create_usb_device(device)
+        else:
+            self.delete_usb_device(device)
+
+
+def run(source, mode, args):
+    handler = FakeHandler(args.operation_time)
+    started = time.perf_counter()
+    if mode == "direct":
+        source.replay(handler.post, args.interval)
+    else:
+        dispatcher = UdevEventDispatcher(handler.create_usb_device, handler.delete_usb_device, args.settle_time)
+        dispatcher.start()
+        source.replay(dispatcher.post, args.interval)
+        while True:
+            with dispatcher._condition:
+                if not dispatcher.pending and not dispatcher.running:
+                    break
+            time.sleep(0.01)
+        dispatcher.stop()
+    elapsed = time.perf_counter() - started
+    expected = {name for name, present in source.expected.items() if present}
+    if handler.present != expected:
+        raise Exception("{}: devices {} present, expected {}".format(mode, sorted(handler.present), sorted(expected)))
+    print("{:<10} {:>5} events: {:>5} created {:>5} destroyed {:>3} invalid, settled in {:.2f} s".format(
+        mode, len(source.events), handler.created, handler.destroyed, handler.errors, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="udev event storm benchmark")
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--flaps", type=int, default=30, help="maximum add/remove events per device")
+    parser.add_argument("--interval", type=float, default=0.001, help="seconds between events")
+    parser.add_argument("--settle-time", type=float, default=0.5)
+    parser.add_argument("--operation-time", type=float, default=0.005, help="cost of a bring-up or tear-down")
+    args = parser.parse_args()
+
+    source = FakeUdevSource(args.devices, args.flaps)
+    for mode in ("direct", "dispatcher"):
+        run(source, mode, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+#
+# round-trip latency of a client on the gateway host over loopback TCP and
+# over the device's unix socket, for RFC2217 and raw devices. The gateway
+# runs in its own process on pty pairs echoing everything back, clients
+# are plain sockets so the figures are not dominated by pyserial
+
+import argparse
+import os
+import select
+import socket
+import tempfile
+import threading
+import time
+
+from bench_bridge import percentile, read_exactly, run_parallel
+from pty_harness import BridgeConfig, PtyBridge, PtySide
+
+
+class SocketReader(object):
+    """read() on top of a socket, as read_exactly expects"""
+
+    def __init__(self, client, timeout):
+        self.client = client
+        self.client.settimeout(timeout)
+
+    def read(self, size):
+        try:
+            return self.client.recv(size)
+        except socket.timeout:
+            return b''
+
+
+def connect(endpoint, config, index):
+    if endpoint == "unix":
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(config.unix_path(index))
+    else:
+        client = socket.create_connection(("127.0.0.1", config.base_port + index))
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # telnet negotiation sent on connection
+    while select.select([client], [], [], 0.1)[0]:
+        client.recv(65536)
+    return client
+
+
+def run(endpoint, transport, engine, args):
+    config = BridgeConfig(args.devices, engine, base_port=args.base_port, transport=transport,
+                          unix_socket_dir=args.unix_socket_dir)
+    bridge = PtyBridge(config, connect_clients=False)
+    bridge.start()
+    clients = []
+    try:
+        clients = [connect(endpoint, config, i) for i in range(args.devices)]
+        bridge.pty_side.reset(PtySide.ECHO)
+        for size in args.sizes:
+            # no 0xff, nothing is escaped and the echo comes back unchanged
+            payload = bytes(i % 255 for i in range(size))
+            latencies = []
+            lock = threading.Lock()
+
+            def client_loop(index):
+                reader = SocketReader(clients[index], 5)
+                samples = []
+                for i in range(args.messages):
+                    start = time.perf_counter()
+                    clients[index].sendall(payload)
+                    if read_exactly(reader, size) != payload:
+                        raise Exception("Echoed data differs on device {}".format(index))
+                    samples.append(time.perf_counter() - start)
+                with lock:
+                    latencies.extend(samples)
+
+            before = bridge.stats()
+            run_parallel(client_loop, args.devices)
+            after = bridge.stats()
+            print("{:<4} {:<7} {:<9} {:>3} dev {:>6} B: p50 {:>7.3f} p99 {:>7.3f} p999 {:>7.3f} ms, "
+                  "{:>6.1f} us gateway cpu per round trip".format(
+                      endpoint, transport, engine, args.devices, size, percentile(latencies, 0.5) * 1e3,
+                      percentile(latencies, 0.99) * 1e3, percentile(latencies, 0.999) * 1e3,
+                      (after["cpu_seconds"] - before["cpu_seconds"]) / len(latencies) * 1e6))
+    finally:
+        for client in clients:
+            client.close()
+        bridge.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="loopback TCP against unix socket latency benchmark")
+    parser.add_argument("--devices", type=int, default=1)
+    parser.add_argument("--transports", nargs="+", default=["rfc2217", "raw"], choices=["rfc2217", "raw"])
+    parser.add_argument("--engines", nargs="+", default=["threaded"], choices=["threaded", "eventloop"],
+                        help="raw devices are always threaded")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 64, 1024])
+    parser.add_argument("--messages", type=int, default=2000, help="round trips per device and payload")
+    parser.add_argument("--base-port", type=int, default=17600)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as unix_socket_dir:
+        args.unix_socket_dir = unix_socket_dir
+        for transport in args.transports:
+            for engine in (args.engines if transport == "rfc2217" else ["threaded"]):
+                for endpoint in ("tcp", "unix"):
+                    run(endpoint, transport, engine, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#
+# connect-to-first-byte latency of repeated client sessions on a board that
+# resets when DTR rises, like Arduino style auto-reset circuits. The board
+# answers pings on the master side of a pty once it has booted. Every tty
+# reconfiguration costs a USB control transfer, modelled with a delay.
+# Compares devices dropping DTR/RTS after every client with warm sessions
+
+import argparse
+import os
+import select
+import threading
+import time
+
+import serial
+
+from bench_bridge import percentile
+from pty_harness import PtyRFC2217Device, PtySerial
+
+
+class Board(object):
+    """answers every ping line with a pong line, stays silent for boot_time
+       seconds after a reset"""
+
+    def __init__(self, master, boot_time):
+        self.master = master
+        self.boot_time = boot_time
+        self.dtr = False
+        self.resets = 0
+        self.ready_at = 0
+        self.alive = True
+        self.thread = threading.Thread(target=self.__run)
+
+    def set_dtr(self, state):
+        if state and not self.dtr:
+            self.resets += 1
+            self.ready_at = time.monotonic() + self.boot_time
+        self.dtr = state
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.alive = False
+        self.thread.join()
+
+    def __run(self):
+        pending = b""
+        while self.alive:
+            if not select.select([self.master], [], [], 0.1)[0]:
+                continue
+            pending += os.read(self.master, 4096)
+            pings = pending.count(b"\n")
+            pending = pending[pending.rfind(b"\n") + 1:]
+            if pings and time.monotonic() >= self.ready_at:
+                os.write(self.master, b"pong\n" * pings)
+
+
+class BoardSerial(PtySerial):
+    """pty whose DTR line reaches the board and whose reconfigurations take
+       as long as a USB control transfer"""
+
+    board = None
+    reconfigure_delay = 0
+    reconfigurations = 0
+
+    def _update_dtr_state(self):
+        if self.board:
+            self.board.set_dtr(self._dtr_state)
+
+    def _reconfigure_port(self, force_update=False):
+        BoardSerial.reconfigurations += 1
+        time.sleep(self.reconfigure_delay)
+        super()._reconfigure_port(force_update)
+
+
+class BoardDevice(PtyRFC2217Device):
+    def connect_serial_port(self, port_path):
+        ser = BoardSerial(None)
+        ser.port = port_path
+        ser.timeout = 3
+        ser.dtr = False
+        ser.rts = False
+        ser.open()
+
+        return ser
+
+
+def first_byte(port, timeout):
+    """seconds from the connection to the first answer of the board"""
+    started = time.perf_counter()
+    client = serial.serial_for_url("rfc2217://127.0.0.1:{}".format(port), baudrate=115200, timeout=0.01)
+    try:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            client.write(b"ping\n")
+            if client.read(5):
+                return time.perf_counter() - started
+        raise Exception("No answer from the board within {} s".format(timeout))
+    finally:
+        client.close()
+
+
+def run(warm, args, port):
+    master, slave = os.openpty()
+    board = Board(master, args.boot_time)
+    BoardSerial.board = board
+    BoardSerial.reconfigure_delay = args.reconfigure_delay
+    device = BoardDevice(os.ttyname(slave), port, warm_sessions=warm)
+    board.start()
+    device.start()
+    samples = []
+    try:
+        # the first session boots the board in both cases
+        first_byte(port, args.timeout)
+        resets, reconfigurations = board.resets, BoardSerial.reconfigurations
+        applied, skipped = device.metrics.serial_settings_applied, device.metrics.serial_settings_skipped
+        for i in range(args.sessions):
+            samples.append(first_byte(port, args.timeout))
+    finally:
+        device.stop()
+        board.stop()
+        BoardSerial.board = None
+        os.close(master)
+        os.close(slave)
+    print("{:<5} sessions: first byte p50 {:>8.1f} p99 {:>8.1f} ms, per session {:>4.1f} board resets, "
+          "{:>4.1f} tty reconfigurations, {:>4.1f} settings applied, {:>4.1f} skipped".format(
+              "warm" if warm else "cold", percentile(samples, 0.5) * 1e3, percentile(samples, 0.99) * 1e3,
+              (board.resets - resets) / args.sessions,
+              (BoardSerial.reconfigurations - reconfigurations) / args.sessions,
+              (device.metrics.serial_settings_applied - applied) / args.sessions,
+              (device.metrics.serial_settings_skipped - skipped) / args.sessions))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="connect-to-first-byte benchmark of warm sessions")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--boot-time", type=float, default=0.5, help="seconds the board needs after a reset")
+    parser.add_argument("--reconfigure-delay", type=float, default=0.002, help="seconds per tty reconfiguration")
+    parser.add_argument("--timeout", type=float, default=5)
+    parser.add_argument("--base-port", type=int, default=18200)
+    args = parser.parse_args()
+
+    run(False, args, args.base_port)
+    run(True, args, args.base_port + 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+#
+# frames/sec of the incremental Z-Wave serial API decoder, after checking it
+# against recorded byte streams with garbage, bad checksums, split frames
+# and stray SOF bytes
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from gateway_devices.zwave_serial_api import ZWaveFrameDecoder, ZWaveFrameReceiver, ZWaveHomeIdHandler  # noqa: E402
+
+# ACK followed by the MEMORY_GET_ID response of a stick with home id cafebabe
+HOME_ID_RESPONSE = bytes.fromhex("06" "01080120cafebabe01") + bytes([0x00])
+# a SendData callback request, as sent unsolicited by controllers
+CALLBACK_REQUEST = bytes.fromhex("0104001301") + bytes([0x00])
+# a request whose checksum got corrupted on the line
+CORRUPTED_REQUEST = bytes.fromhex("0104001302") + bytes([0x00])
+
+
+def with_checksum(frame):
+    frame = bytearray(frame)
+    frame[-1] = ZWaveFrameDecoder.checksum(frame[1:-1])
+    return bytes(frame)
+
+
+HOME_ID_RESPONSE = HOME_ID_RESPONSE[:1] + with_checksum(HOME_ID_RESPONSE[1:])
+CALLBACK_REQUEST = with_checksum(CALLBACK_REQUEST)
+
+RECORDED_STREAMS = [
+    # (stream, expected frames, expected invalid frames)
+    (HOME_ID_RESPONSE, 1, 0),
+    (b"\x00\x42" + HOME_ID_RESPONSE + b"\xfe", 1, 0),
+    (CORRUPTED_REQUEST + HOME_ID_RESPONSE, 1, 1),
+    (b"\x01\x02" + CALLBACK_REQUEST + HOME_ID_RESPONSE, 2, 1),
+    (CALLBACK_REQUEST * 3, 3, 0),
+]
+
+
+def decode(stream, chunk_size):
+    frames = []
+    decoder = ZWaveFrameDecoder(frames.append)
+    for i in range(0, len(stream), chunk_size):
+        decoder.feed(stream[i:i + chunk_size])
+    return frames, decoder
+
+
+def check_recorded_streams():
+    for stream, expected_frames, expected_invalid in RECORDED_STREAMS:
+        for chunk_size in (1, 2, 3, 7, len(stream)):
+            frames, decoder = decode(stream, chunk_size)
+            if len(frames) != expected_frames or decoder.invalid_frames != expected_invalid:
+                raise AssertionError("stream {} in chunks of {}: {} frames, {} invalid".format(
+                    stream.hex(), chunk_size, len(frames), decoder.invalid_frames))
+            home_ids = [ZWaveHomeIdHandler.get_home_id_from_frame(f) for f in frames]
+            if HOME_ID_RESPONSE[1:] in stream and "cafebabe" not in home_ids:
+                raise AssertionError("home id not found in {}".format(stream.hex()))
+    frames, decoder = decode(b"\x01\x08\x00\x20", 1)
+    decoder.expire(time.monotonic() + ZWaveFrameDecoder.FRAME_TIMEOUT + 1)
+    if decoder.buffer or decoder.invalid_frames != 1:
+        raise AssertionError("stale partial frame not discarded")
+    # a stray SOF claiming a long frame only costs its own byte once it expires
+    frames, decoder = decode(b"\x01\x40" + HOME_ID_RESPONSE, 1)
+    decoder.expire(time.monotonic() + ZWaveFrameDecoder.FRAME_TIMEOUT + 1)
+    if len(frames) != 1 or decoder.garbage_bytes != 1:
+        raise AssertionError("frame after a stray SOF lost: {} frames, {} garbage bytes".format(
+            len(frames), decoder.garbage_bytes))
+    # the read timeout of a quiet stick feeds b"", which expires the stray SOF too
+    frames = []
+    receiver = ZWaveFrameReceiver(lambda data: None, frames.append)
+    receiver.decoder.FRAME_TIMEOUT = 0.05
+    receiver.feed(b"\x01\x40" + HOME_ID_RESPONSE)
+    time.sleep(0.1)
+    receiver.feed(b"")
+    if len(frames) != 1:
+        raise AssertionError("partial frame not expired while the stick is quiet")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", type=int, default=100000)
+    args = parser.parse_args()
+
+    check_recorded_streams()
+    print("recorded streams decoded as expected")
+
+    stream = (CALLBACK_REQUEST + HOME_ID_RESPONSE) * (args.frames // 2)
+    for chunk_size in (1, 16, 256, 4096):
+        start = time.perf_counter()
+        frames, decoder = decode(stream, chunk_size)
+        elapsed = time.perf_counter() - start
+        print("chunks of {:>4} bytes: {:>10.0f} frames/s".format(chunk_size, len(frames) / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+#
+# RFC2217Device/Redirector stacks on top of os.openpty() pairs, driven by
+# local serial.rfc2217 clients over loopback. The gateway side runs in a
+# child process so its CPU time, context switches and threads can be
+# measured apart from the clients.
+
+import fcntl
+import logging
+import multiprocessing
+import os
+import resource
+import selectors
+import signal
+import sys
+import threading
+import tracemalloc
+import tty
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import serial  # noqa: E402
+
+from coalescing_policy import CoalescingPolicy  # noqa: E402
+from io_engine import IOEngine  # noqa: E402
+from rfc2217_device import RFC2217Device  # noqa: E402
+from shard_pool import ShardedDevice, ShardPool  # noqa: E402
+
+
+class PtySerial(serial.Serial):
+    """ptys have no modem lines, report them as inactive instead of failing"""
+
+    def _update_dtr_state(self):
+        pass
+
+    def _update_rts_state(self):
+        pass
+
+    def _update_break_state(self):
+        pass
+
+    @property
+    def cts(self):
+        return False
+
+    @property
+    def dsr(self):
+        return False
+
+    @property
+    def ri(self):
+        return False
+
+    @property
+    def cd(self):
+        return False
+
+
+class PtyRFC2217Device(RFC2217Device):
+    SERIAL_CLASS = PtySerial
+
+    def connect_serial_port(self, port_path):
+        ser = PtySerial(None)
+        ser.port = port_path
+        ser.timeout = 3
+        ser.dtr = False
+        ser.rts = False
+        ser.open()
+
+        return ser
+
+
+class PtyShardedDevice(ShardedDevice):
+    connect_serial_port = PtyRFC2217Device.connect_serial_port
+
+
+class BridgeConfig(object):
+    def __init__(self, devices=1, engine="threaded", coalescing=CoalescingPolicy.LOWEST_LATENCY,
+                 tcp_cork=False, receive_buffer_size=16384, base_port=17100, trace_malloc=False,
+                 transport="rfc2217", unix_socket_dir=None, shards=0):
+        self.devices = devices
+        self.engine = engine
+        self.coalescing = coalescing
+        self.tcp_cork = tcp_cork
+        self.receive_buffer_size = receive_buffer_size
+        self.base_port = base_port
+        self.trace_malloc = trace_malloc
+        self.transport = transport
+        self.unix_socket_dir = unix_socket_dir
+        # worker processes running the devices, 0 runs them in the bridge process
+        self.shards = shards
+
+    def unix_path(self, index):
+        if not self.unix_socket_dir:
+            return None
+        return os.path.join(self.unix_socket_dir, "device-{}".format(index))
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+def _worker_cpu_seconds(pid):
+    with open("/proc/{}/stat".format(pid)) as stat:
+        fields = stat.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def _worker_tty_handles(shard_pool, devices):
+    """worker descriptors of the ports, as (using the gateway's open file, opened by the worker)"""
+    shared = opened = 0
+    for device in devices:
+        fd = device.s_port.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        # status flags belong to the open file, a worker descriptor of the
+        # gateway's shows O_APPEND too. Writes to a tty ignore it
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_APPEND)
+        try:
+            for pid in shard_pool.get_worker_pids():
+                try:
+                    worker_fds = os.listdir("/proc/{}/fd".format(pid))
+                except OSError:
+                    continue
+                for worker_fd in worker_fds:
+                    try:
+                        if os.readlink("/proc/{}/fd/{}".format(pid, worker_fd)) != device.device_path:
+                            continue
+                        with open("/proc/{}/fdinfo/{}".format(pid, worker_fd)) as info:
+                            worker_flags = int(info.read().split("flags:")[1].split()[0], 8)
+                    except (OSError, IndexError):
+                        continue
+                    if worker_flags & os.O_APPEND:
+                        shared += 1
+                    else:
+                        opened += 1
+        finally:
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+    return shared, opened
+
+
+def _process_stats(shard_pool=None, devices=()):
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    stats = {
+        "cpu_seconds": usage.ru_utime + usage.ru_stime,
+        "context_switches": usage.ru_nvcsw + usage.ru_nivcsw,
+        "threads": threading.active_count(),
+        "serial_to_socket_bytes": sum(device.metrics.serial_to_socket_bytes for device in devices),
+    }
+    if shard_pool:
+        stats["cpu_seconds"] += sum(_worker_cpu_seconds(pid) for pid in shard_pool.get_worker_pids())
+        stats["shard_restarts"] = shard_pool.restarts
+        stats["shard_devices"] = [len(shard.devices) for shard in shard_pool.shards]
+        stats["worker_tty_shared"], stats["worker_tty_opened"] = _worker_tty_handles(shard_pool, devices)
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        stats["traced_current_bytes"] = current
+        stats["traced_peak_bytes"] = peak
+        tracemalloc.reset_peak()
+    return stats
+
+
+def _bridge_main(slave_paths, config, connection):
+    logging.basicConfig(level=logging.WARNING)
+    if config.trace_malloc:
+        tracemalloc.start()
+    engine = None
+    shard_pool = None
+    if config.shards:
+        shard_pool = ShardPool(config.shards, config.engine, PtyRFC2217Device)
+        shard_pool.start()
+    elif config.engine == "eventloop":
+        engine = IOEngine()
+        engine.start()
+    devices = []
+    for i, path in enumerate(slave_paths):
+        policy = CoalescingPolicy(config.coalescing, tcp_cork=config.tcp_cork)
+        raw_settings = {"baudrate": 115200} if config.transport == "raw" else None
+        if shard_pool:
+            device = PtyShardedDevice(shard_pool, path, config.base_port + i, None, policy, config.receive_buffer_size,
+                                      raw_settings=raw_settings, unix_path=config.unix_path(i))
+        else:
+            device = PtyRFC2217Device(path, config.base_port + i, engine, policy, config.receive_buffer_size,
+                                      raw_settings=raw_settings, unix_path=config.unix_path(i))
+        devices.append(device)
+    if shard_pool:
+        # concurrently, as the bring-up threads of UsbDevicesHandler do
+        starting = [threading.Thread(target=device.start) for device in devices]
+        for thread in starting:
+            thread.start()
+        for thread in starting:
+            thread.join()
+    else:
+        for device in devices:
+            device.start()
+    connection.send("ready")
+    while True:
+        command = connection.recv()
+        if command == "stats":
+            connection.send(_process_stats(shard_pool, devices))
+        elif command == "kill shard":
+            # the shard running the second device, the first one carries the load in bench_sharding
+            shard = shard_pool.assignments[devices[min(1, len(devices) - 1)].device_id]
+            os.kill(shard.process.pid, signal.SIGKILL)
+            connection.send(shard.index)
+        elif command == "stop":
+            for device in devices:
+                device.stop()
+            if engine:
+                engine.stop()
+            if shard_pool:
+                shard_pool.stop()
+            connection.send("stopped")
+            break
+
+
+class PtySide(object):
+    """Single thread serving the master side of every pty, either echoing
+       everything back or counting what arrives"""
+
+    ECHO = "echo"
+    SINK = "sink"
+
+    def __init__(self, masters):
+        self.masters = masters
+        self.mode = self.ECHO
+        self.received = [0] * len(masters)
+        self.alive = False
+        self.selector = selectors.DefaultSelector()
+        for index, master in enumerate(masters):
+            self.selector.register(master, selectors.EVENT_READ, index)
+        self.thread = None
+
+    def start(self):
+        self.alive = True
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.alive = False
+        self.thread.join()
+        self.selector.close()
+
+    def reset(self, mode):
+        self.mode = mode
+        self.received = [0] * len(self.masters)
+
+    def __run(self):
+        while self.alive:
+            for key, mask in self.selector.select(0.2):
+                try:
+                    data = os.read(key.fileobj, 65536)
+                except OSError:
+                    continue
+                self.received[key.data] += len(data)
+                if self.mode == self.ECHO:
+                    view = memoryview(data)
+                    while view:
+                        view = view[os.write(key.fileobj, view):]
+
+
+class PtyBridge(object):
+    """config.devices pty backed gateway devices with one client each,
+       unless connect_clients is False"""
+
+    def __init__(self, config, client_timeout=5, connect_clients=True):
+        self.config = config
+        self.client_timeout = client_timeout
+        self.connect_clients = connect_clients
+        self.masters = []
+        self.clients = []
+        self.process = None
+        self.connection = None
+        self.pty_side = None
+
+    def start(self):
+        slave_paths = []
+        self.slaves = []
+        for i in range(self.config.devices):
+            master, slave = os.openpty()
+            tty.setraw(master)
+            tty.setraw(slave)
+            self.masters.append(master)
+            self.slaves.append(slave)
+            slave_paths.append(os.ttyname(slave))
+        context = multiprocessing.get_context("fork")
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_bridge_main, args=(slave_paths, self.config, child_connection))
+        self.process.start()
+        if self.connection.recv() != "ready":
+            raise Exception("Bridge process failed to start")
+        self.pty_side = PtySide(self.masters)
+        self.pty_side.start()
+        for i in range(self.config.devices if self.connect_clients else 0):
+            # pyserial's socket:// client is a plain TCP byte pipe
+            url = "{}://127.0.0.1:{}".format("socket" if self.config.transport == "raw" else "rfc2217",
+                                             self.config.base_port + i)
+            self.clients.append(serial.serial_for_url(url, timeout=self.client_timeout))
+
+    def stats(self):
+        self.connection.send("stats")
+        return self.connection.recv()
+
+    def kill_shard(self):
+        """SIGKILL the worker running the second device, returns its shard index"""
+        self.connection.send("kill shard")
+        return self.connection.recv()
+
+    def stop(self):
+        for client in self.clients:
+            client.close()
+        self.connection.send("stop")
+        self.connection.recv()
+        self.process.join()
+        self.pty_side.stop()
+        for fd in self.masters + self.slaves:
+            os.close(fd)
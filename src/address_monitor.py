@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+import errno
+import logging
+import selectors
+import socket
+import struct
+import threading
+import netifaces as ni
+
+logger = logging.getLogger(__name__)
+
+
+def get_interface_addresses(interface):
+    """IPv4 addresses of a network interface, primary address first"""
+    if interface not in ni.interfaces():
+        return []
+    return [entry['addr'] for entry in ni.ifaddresses(interface).get(ni.AF_INET, []) if 'addr' in entry]
+
+
+class NetlinkAddressSource(object):
+    """rtnetlink socket subscribed to IPv4 address changes. read() returns
+       (interface, address, present) tuples for every RTM_NEWADDR and
+       RTM_DELADDR message received"""
+
+    RTMGRP_IPV4_IFADDR = 0x10
+    RTM_NEWADDR = 20
+    RTM_DELADDR = 21
+    IFA_ADDRESS = 1
+    IFA_LOCAL = 2
+    IFA_LABEL = 3
+
+    NLMSGHDR = struct.Struct("=IHHII")
+    IFADDRMSG = struct.Struct("=BBBBI")
+    RTATTR = struct.Struct("=HH")
+
+    def __init__(self):
+        self.socket = None
+
+    def open(self):
+        self.socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self.socket.bind((0, self.RTMGRP_IPV4_IFADDR))
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def read(self):
+        return self.parse(self.socket.recv(65536))
+
+    @classmethod
+    def parse(cls, data):
+        changes = []
+        offset = 0
+        while offset + cls.NLMSGHDR.size <= len(data):
+            length, type_, flags, seq, pid = cls.NLMSGHDR.unpack_from(data, offset)
+            if length < cls.NLMSGHDR.size:
+                break
+            if type_ in (cls.RTM_NEWADDR, cls.RTM_DELADDR):
+                change = cls.__parse_address(data, offset + cls.NLMSGHDR.size, offset + length,
+                                             type_ == cls.RTM_NEWADDR)
+                if change:
+                    changes.append(change)
+            offset += (length + 3) & ~3
+        return changes
+
+    @classmethod
+    def __parse_address(cls, data, offset, end, present):
+        if offset + cls.IFADDRMSG.size > min(end, len(data)):
+            return None
+        family, prefix_length, flags, scope, index = cls.IFADDRMSG.unpack_from(data, offset)
+        if family != socket.AF_INET:
+            return None
+        attributes = {}
+        offset += cls.IFADDRMSG.size
+        while offset + cls.RTATTR.size <= end:
+            length, type_ = cls.RTATTR.unpack_from(data, offset)
+            if length < cls.RTATTR.size:
+                break
+            attributes[type_] = data[offset + cls.RTATTR.size:offset + length]
+            offset += (length + 3) & ~3
+        # IFA_LOCAL is the interface address, IFA_ADDRESS the peer on point to point links
+        address = attributes.get(cls.IFA_LOCAL, attributes.get(cls.IFA_ADDRESS))
+        if not address or len(address) != 4:
+            return None
+        try:
+            interface = socket.if_indextoname(index)
+        except OSError:
+            label = attributes.get(cls.IFA_LABEL)
+            if not label:
+                return None
+            interface = label.rstrip(b'\0').decode().split(':')[0]
+        return interface, socket.inet_ntoa(address), present
+
+
+class AddressMonitor(object):
+    """Tracks the IPv4 address of network interfaces for all advertisers
+       with a single thread. Listeners are called with the new primary
+       address, or None when the interface lost it. Changes come from
+       source, rtnetlink by default, any object with fileno() and read()
+       will do, and open() and close() to restart it after a read error.
+       Without netlink, interfaces are polled with netifaces"""
+
+    POLL_INTERVAL = 1
+
+    def __init__(self, source=None):
+        self.source = source
+        self.addresses = {}
+        self.listeners = {}
+        self.polling = False
+        self.thread = None
+        self.alive = None
+        self._lock = threading.Lock()
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+
+    def start(self):
+        if self.source is None:
+            self.source = NetlinkAddressSource()
+            try:
+                self.source.open()
+            except OSError as e:
+                logger.warning("Netlink not available, polling network interfaces: {}".format(e))
+                self.source = None
+                self.polling = True
+        self.alive = True
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.name = 'address monitor'
+        self.thread.start()
+
+    def stop(self):
+        if self.alive:
+            self.alive = False
+            self._wakeup_sender.send(b'\0')
+            self.thread.join()
+            if isinstance(self.source, NetlinkAddressSource):
+                self.source.close()
+        logger.debug("Address monitor stopped")
+
+    def get_address(self, interface):
+        with self._lock:
+            addresses = self.addresses.get(interface)
+            return addresses[0] if addresses else None
+
+    def add_listener(self, interface, listener):
+        """register listener and call it with the current address, if any"""
+        with self._lock:
+            if interface not in self.addresses:
+                # subscribed to netlink before reading, later changes are not missed
+                self.addresses[interface] = get_interface_addresses(interface)
+            self.listeners.setdefault(interface, []).append(listener)
+            addresses = self.addresses[interface]
+        if addresses:
+            listener(addresses[0])
+
+    def remove_listener(self, interface, listener):
+        with self._lock:
+            listeners = self.listeners.get(interface, [])
+            if listener in listeners:
+                listeners.remove(listener)
+            if not listeners:
+                self.listeners.pop(interface, None)
+                self.addresses.pop(interface, None)
+
+    def __run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._wakeup_receiver, selectors.EVENT_READ)
+        if self.source:
+            selector.register(self.source, selectors.EVENT_READ)
+        logger.debug("Address monitor started{}".format(" (polling)" if self.polling else ""))
+        while self.alive:
+            events = selector.select(self.POLL_INTERVAL if self.polling else None)
+            if self.polling:
+                self.__resync()
+            for key, mask in events:
+                if key.fileobj is self._wakeup_receiver:
+                    self._wakeup_receiver.recv(64)
+                    continue
+                try:
+                    changes = self.source.read()
+                except OSError as e:
+                    if e.errno == errno.ENOBUFS:
+                        logger.warning("Address changes lost, reading interfaces again")
+                    else:
+                        logger.error("Address changes can't be read, restarting: {}".format(e))
+                        self.__restart_source(selector)
+                    self.__resync()
+                    continue
+                for interface, address, present in changes:
+                    self.__apply(interface, address, present)
+        selector.close()
+
+    def __restart_source(self, selector):
+        """reopen the source, or poll the interfaces when it can't be"""
+        selector.unregister(self.source)
+        try:
+            self.source.close()
+            self.source.open()
+        except (AttributeError, OSError) as e:
+            logger.warning("Polling network interfaces, address changes source not available: {}".format(e))
+            self.source = None
+            self.polling = True
+            return
+        selector.register(self.source, selectors.EVENT_READ)
+
+    def __apply(self, interface, address, present):
+        with self._lock:
+            addresses = self.addresses.get(interface)
+            if addresses is None:
+                return
+            previous = addresses[0] if addresses else None
+            if present and address not in addresses:
+                addresses.append(address)
+            elif not present and address in addresses:
+                addresses.remove(address)
+        self.__notify(interface, previous)
+
+    def __resync(self):
+        with self._lock:
+            interfaces = list(self.addresses)
+        for interface in interfaces:
+            addresses = get_interface_addresses(interface)
+            with self._lock:
+                if interface not in self.addresses:
+                    continue
+                previous = self.addresses[interface][0] if self.addresses[interface] else None
+                self.addresses[interface] = addresses
+            self.__notify(interface, previous)
+
+    def __notify(self, interface, previous):
+        with self._lock:
+            addresses = self.addresses.get(interface)
+            current = addresses[0] if addresses else None
+            listeners = list(self.listeners.get(interface, []))
+        if current == previous:
+            return
+        logger.info("Address of interface '{}' changed from {} to {}".format(interface, previous, current))
+        for listener in listeners:
+            try:
+                listener(current)
+            except Exception:
+                logger.exception("Error in address listener")
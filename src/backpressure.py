@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+import collections
+
+
+class BackpressurePolicy(object):
+    """Decides what happens to serial data when the client reads slower
+       than the serial port produces it. Data waits in a send buffer; once
+       the buffer goes above high_water bytes:
+
+       block: the serial reader waits until the buffer is back to low_water
+       drop-oldest: the oldest serial chunks are dropped down to low_water
+       disconnect: the client is disconnected
+    """
+
+    BLOCK = "block"
+    DROP_OLDEST = "drop-oldest"
+    DISCONNECT = "disconnect"
+
+    MODES = (BLOCK, DROP_OLDEST, DISCONNECT)
+
+    def __init__(self, mode=BLOCK, high_water=262144, low_water=65536):
+        if mode not in self.MODES:
+            raise Exception("Unknown backpressure policy '{}'".format(mode))
+        if not 0 <= low_water <= high_water:
+            raise Exception("Backpressure low water must be between 0 and the high water")
+        self.mode = mode
+        self.high_water = high_water
+        self.low_water = low_water
+
+
+class SendBuffer(object):
+    """Escaped chunks waiting for the client socket. Chunks are only dropped
+       whole so the telnet stream stays valid; telnet replies and a chunk
+       that is already being sent are never dropped. Not thread safe"""
+
+    def __init__(self, policy, metrics):
+        self.policy = policy
+        self.metrics = metrics
+        self.chunks = collections.deque()
+        self.size = 0
+        self.throttled = False
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data, length=None):
+        """queue data, length is the number of serial bytes it carries or
+           None for telnet replies. Returns False when the client has to be
+           disconnected"""
+        self.chunks.append([memoryview(data), length])
+        self.size += len(data)
+        if length is None or self.size <= self.policy.high_water:
+            return True
+        if not self.throttled:
+            self.throttled = True
+            self.metrics.local().send_buffer_stalls += 1
+        if self.policy.mode == BackpressurePolicy.DROP_OLDEST:
+            self.__drop()
+        elif self.policy.mode == BackpressurePolicy.DISCONNECT:
+            counters = self.metrics.local()
+            counters.send_buffer_disconnects += 1
+            counters.send_buffer_dropped_bytes += sum(length for view, length in self.chunks if length)
+            self.clear()
+            return False
+        return True
+
+    def is_full(self):
+        """True from the time the buffer goes above the high water until it
+           is back to the low water"""
+        if self.throttled and self.size <= self.policy.low_water:
+            self.throttled = False
+        return self.throttled
+
+    def peek(self):
+        """first chunk to send, it can't be dropped anymore"""
+        head = self.chunks[0]
+        head[1] = None
+        return head[0]
+
+    def consume(self, sent):
+        head = self.chunks[0]
+        if sent < len(head[0]):
+            head[0] = head[0][sent:]
+        else:
+            self.chunks.popleft()
+        self.size -= sent
+
+    def clear(self):
+        self.chunks.clear()
+        self.size = 0
+        self.throttled = False
+
+    def __drop(self):
+        kept = collections.deque()
+        while self.chunks and self.size > self.policy.low_water:
+            chunk = self.chunks.popleft()
+            if chunk[1] is None:
+                kept.append(chunk)
+                continue
+            self.size -= len(chunk[0])
+            self.metrics.local().send_buffer_dropped_bytes += chunk[1]
+        kept.extend(self.chunks)
+        self.chunks = kept
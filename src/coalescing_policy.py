@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+import time
+
+
+class CoalescingPolicy(object):
+    """Decides how data read from the serial port is grouped before being
+       sent to the client.
+
+       lowest-latency: every read is sent right away
+       throughput: reads are batched up to max_bytes or max_delay_us
+       adaptive: batches only while data arrives with gaps below adaptive_gap_us
+    """
+
+    LOWEST_LATENCY = "lowest-latency"
+    THROUGHPUT = "throughput"
+    ADAPTIVE = "adaptive"
+
+    MODES = (LOWEST_LATENCY, THROUGHPUT, ADAPTIVE)
+
+    def __init__(self, mode=LOWEST_LATENCY, max_bytes=4096, max_delay_us=2000,
+                 tcp_cork=False, adaptive_gap_us=1000):
+        if mode not in self.MODES:
+            raise Exception("Unknown coalescing policy '{}'".format(mode))
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay_us / 1e6
+        self.tcp_cork = tcp_cork
+        self.adaptive_gap = adaptive_gap_us / 1e6
+        self.last_read = None
+        self.last_gap = None
+
+    def note_read(self):
+        """called after every serial read that returned data, inside
+           coalescing windows too"""
+        if self.mode != self.ADAPTIVE:
+            return
+        now = time.monotonic()
+        self.last_gap = now - self.last_read if self.last_read is not None else None
+        self.last_read = now
+
+    def should_batch(self):
+        """called after a serial read outside of a coalescing window, True
+           when the read should open one. Adaptive windows open while the
+           last two reads were less than adaptive_gap apart"""
+        if self.mode == self.LOWEST_LATENCY:
+            return False
+        if self.mode == self.THROUGHPUT:
+            return True
+        return self.last_gap is not None and self.last_gap < self.adaptive_gap
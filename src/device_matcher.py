@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+import fnmatch
+import logging
+
+logger = logging.getLogger(__name__)
+
+WILDCARD = "*"
+
+
+class MatchRule(object):
+    """udev properties a gateway device class applies to. A value of '*'
+       matches anything, an empty ID_SERIAL or ID_PATH is not checked and
+       other values containing glob characters are matched with fnmatch"""
+
+    FIELDS = ("ID_VENDOR_ID", "ID_MODEL_ID", "ID_VENDOR_ENC", "ID_SERIAL", "ID_PATH")
+
+    def __init__(self, device_class):
+        self.device_class = device_class
+        self.vendor_id = device_class.ID_VENDOR_ID
+        self.model_id = device_class.ID_MODEL_ID
+        self.priority = device_class.MATCH_PRIORITY
+        self.checks = []
+        for field in self.FIELDS[2:]:
+            value = getattr(device_class, field, "")
+            if not value or value == WILDCARD:
+                continue
+            if any(c in value for c in "*?["):
+                self.checks.append((field, value, True))
+            else:
+                self.checks.append((field, value, False))
+        specific_ids = (self.vendor_id != WILDCARD) + (self.model_id != WILDCARD)
+        self.specificity = specific_ids + len(self.checks)
+
+    def matches(self, device):
+        for field, value, pattern in self.checks:
+            actual = device.get(field)
+            if actual is None:
+                return False
+            if pattern:
+                if not fnmatch.fnmatchcase(actual, value):
+                    return False
+            elif actual != value:
+                return False
+        return True
+
+    def __repr__(self):
+        return "{}({}:{}, priority {})".format(self.device_class.__name__, self.vendor_id, self.model_id,
+                                               self.priority)
+
+
+class DeviceMatcher(object):
+    """Index of the gateway device classes by USB vendor and model id,
+       built once. A udev event costs a couple of dict lookups and the
+       string comparisons of the few rules sharing its ids; rules are
+       tried by priority, then by how many properties they check"""
+
+    def __init__(self, device_classes):
+        self.index = {}
+        self.candidates = {}
+        for device_class in device_classes:
+            self.add(device_class)
+
+    def add(self, device_class):
+        rule = MatchRule(device_class)
+        rules = self.index.setdefault((rule.vendor_id, rule.model_id), [])
+        for other in rules:
+            if other.checks == rule.checks and other.priority == rule.priority:
+                logger.warning("{} and {} match the same devices".format(other, rule))
+        rules.append(rule)
+        self.candidates = {}
+
+    def match(self, device):
+        """the gateway device class for a udev device, None if unsupported"""
+        key = (device.get("ID_VENDOR_ID"), device.get("ID_MODEL_ID"))
+        if key[0] is None or key[1] is None:
+            return None
+        candidates = self.candidates.get(key)
+        if candidates is None:
+            candidates = self.__collect(key)
+        for rule in candidates:
+            if rule.matches(device):
+                return rule.device_class
+        return None
+
+    def __collect(self, key):
+        vendor_id, model_id = key
+        rules = []
+        for index_key in ((vendor_id, model_id), (vendor_id, WILDCARD), (WILDCARD, model_id), (WILDCARD, WILDCARD)):
+            rules.extend(self.index.get(index_key, ()))
+        rules.sort(key=lambda rule: (-rule.priority, -rule.specificity, rule.device_class.__name__))
+        # the ids of devices seen are bounded by the USB devices around
+        self.candidates[key] = rules
+        return rules
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+
+import collections
+import logging
+import selectors
+import socket
+import threading
+
+import serial
+import serial.rfc2217
+
+import rfc2217_codec
+from backpressure import BackpressurePolicy
+from metrics import DeviceMetrics
+
+logger = logging.getLogger(__name__)
+
+
+class ReadOnlySerial(object):
+    """serial port as seen by the port manager of a subscriber: settings
+       and modem lines are read from the port, changes are ignored"""
+
+    def __init__(self, serial_instance):
+        object.__setattr__(self, "_serial", serial_instance)
+
+    def __getattr__(self, name):
+        return getattr(self._serial, name)
+
+    def __setattr__(self, name, value):
+        pass
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+
+class Subscriber(object):
+    """read-only client. Serial data waits in a bounded queue of shared
+       chunks, the oldest chunks are dropped when the client can't keep up"""
+
+    def __init__(self, client_socket, peer, serial_instance, queue_size):
+        self.socket = client_socket
+        self.peer = peer
+        self.queue_size = queue_size
+        self.chunks = collections.deque()
+        self.control = collections.deque()
+        self.current = None
+        self.dropped_chunks = 0
+        self.port_manager = serial.rfc2217.PortManager(ReadOnlySerial(serial_instance), self)
+
+    def write(self, data):
+        """telnet replies of the port manager, never dropped"""
+        self.control.append(data)
+
+    def push(self, chunk):
+        """queue a chunk, returns False if the oldest one had to be dropped"""
+        dropped = len(self.chunks) >= self.queue_size
+        if dropped:
+            self.chunks.popleft()
+            self.dropped_chunks += 1
+        self.chunks.append(chunk)
+        return not dropped
+
+    def has_data(self):
+        return self.current is not None or self.control or self.chunks
+
+    def flush(self):
+        """send as much as the socket takes without blocking, whole chunks
+           are sent before any telnet reply so the stream stays valid"""
+        while True:
+            if self.current is None:
+                if self.control:
+                    self.current = memoryview(self.control.popleft())
+                elif self.chunks:
+                    self.current = memoryview(self.chunks.popleft())
+                else:
+                    return
+            try:
+                sent = self.socket.send(self.current)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.current = self.current[sent:] if sent < len(self.current) else None
+
+
+class FanOut(object):
+    """Reads the serial port once and hands every chunk to the primary
+       client's Redirector and, as the same bytes object, to the queues of
+       the read-only subscribers. A single thread serves all subscribers,
+       a slow one only loses its own oldest chunks"""
+
+    def __init__(self, serial_instance, max_subscribers, queue_size=256, metrics=None, replay_buffer=None):
+        self.serial = serial_instance
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self.metrics = metrics if metrics else DeviceMetrics()
+        self.primary = None
+        self.replay_buffer = replay_buffer
+        self.subscribers = {}
+        self.alive = False
+        self.thread_read = None
+        self.thread_send = None
+        self.selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._primary_lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self._wakeup_pending = False
+
+    def start(self):
+        self.alive = True
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self.thread_read = threading.Thread(target=self.__read)
+        self.thread_read.daemon = True
+        self.thread_read.name = 'serial->fan out'
+        self.thread_read.start()
+        self.thread_send = threading.Thread(target=self.__send)
+        self.thread_send.daemon = True
+        self.thread_send.name = 'fan out->subscribers'
+        self.thread_send.start()
+
+    def stop(self):
+        if not self.alive:
+            return
+        self.alive = False
+        try:
+            self.serial.cancel_read()
+        except (AttributeError, NotImplementedError, OSError, serial.SerialException):
+            pass
+        self.__wakeup()
+        self.thread_read.join()
+        self.thread_send.join()
+        for subscriber in list(self.subscribers.values()):
+            self.__remove(subscriber)
+        self.selector.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+    @staticmethod
+    def get_primary_policy(policy):
+        """backpressure policy of the primary client. The reader serves the
+           subscribers too, instead of blocking it a slow primary loses its
+           oldest chunks"""
+        policy = policy if policy else BackpressurePolicy()
+        if policy.mode != BackpressurePolicy.BLOCK:
+            return policy
+        return BackpressurePolicy(BackpressurePolicy.DROP_OLDEST, policy.high_water, policy.low_water)
+
+    def set_primary(self, redirector):
+        """serve the primary client, after the data kept since the previous one"""
+        counters = self.metrics.local()
+        with self._primary_lock:
+            if self.replay_buffer:
+                for data in self.replay_buffer.take():
+                    self.__send_primary(redirector, rfc2217_codec.escape(data), len(data), counters)
+            self.primary = redirector
+
+    def clear_primary(self, redirector):
+        with self._primary_lock:
+            if self.primary is redirector:
+                self.primary = None
+
+    def add_subscriber(self, client_socket, peer):
+        """serve a read-only client, False if there are too many already"""
+        with self._lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return False
+            client_socket.setblocking(False)
+            subscriber = Subscriber(client_socket, peer, self.serial, self.queue_size)
+            self.subscribers[client_socket] = subscriber
+            self.metrics.local().subscriber_connections += 1
+        logger.debug("Subscriber {} connected".format(peer))
+        self.__wakeup()
+        return True
+
+    def __wakeup(self):
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            try:
+                self._wakeup_w.send(b'\0')
+            except (BlockingIOError, OSError):
+                pass
+
+    def __read(self):
+        logger.debug("Fan out reader started")
+        counters = self.metrics.local()
+        while self.alive:
+            try:
+                data = self.serial.read(self.serial.in_waiting or 1)
+            except serial.SerialException as e:
+                logger.error("Serial port error: {}".format(e))
+                break
+            counters.serial_reads += 1
+            if not data:
+                continue
+            escaped = rfc2217_codec.escape(data)
+            with self._primary_lock:
+                primary = self.primary
+                if not primary and self.replay_buffer:
+                    self.replay_buffer.append(data)
+            # set_primary() has sent the replayed data before the primary shows up here
+            if primary:
+                self.__send_primary(primary, escaped, len(data), counters)
+            if self.subscribers:
+                self.__publish(escaped)
+        logger.debug("Fan out reader stopped")
+
+    def __send_primary(self, redirector, escaped, length, counters):
+        try:
+            redirector.send_serial_data(escaped, length, counters)
+        except OSError:
+            # the primary session sees the error and ends
+            pass
+
+    def __publish(self, chunk):
+        with self._lock:
+            for subscriber in self.subscribers.values():
+                if not subscriber.push(chunk):
+                    self.metrics.local().subscriber_dropped_chunks += 1
+        self.__wakeup()
+
+    def __send(self):
+        logger.debug("Fan out sender started")
+        registered = {}
+        while self.alive:
+            with self._lock:
+                subscribers = list(self.subscribers.values())
+            for subscriber in subscribers:
+                try:
+                    with self._lock:
+                        subscriber.flush()
+                except OSError:
+                    self.__remove(subscriber)
+                    registered.pop(subscriber.socket, None)
+                    continue
+                events = selectors.EVENT_READ | (selectors.EVENT_WRITE if subscriber.has_data() else 0)
+                if registered.get(subscriber.socket) != events:
+                    if subscriber.socket in registered:
+                        self.selector.modify(subscriber.socket, events, subscriber)
+                    else:
+                        self.selector.register(subscriber.socket, events, subscriber)
+                    registered[subscriber.socket] = events
+            for key, mask in self.selector.select():
+                if key.fileobj is self._wakeup_r:
+                    try:
+                        self._wakeup_r.recv(4096)
+                    except BlockingIOError:
+                        pass
+                    # cleared after draining, the next loop flushes whatever was pushed before
+                    self._wakeup_pending = False
+                elif mask & selectors.EVENT_READ:
+                    if not self.__receive(key.data):
+                        registered.pop(key.data.socket, None)
+        logger.debug("Fan out sender stopped")
+
+    def __receive(self, subscriber):
+        try:
+            data = subscriber.socket.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return True
+        except OSError:
+            data = b''
+        if not data:
+            self.__remove(subscriber)
+            return False
+        # answer the telnet negotiation, data written by subscribers is dropped
+        with self._lock:
+            rfc2217_codec.filter(subscriber.port_manager, data)
+        return True
+
+    def __remove(self, subscriber):
+        with self._lock:
+            if self.subscribers.pop(subscriber.socket, None) is None:
+                return
+        try:
+            self.selector.unregister(subscriber.socket)
+        except (KeyError, ValueError):
+            pass
+        subscriber.socket.close()
+        logger.debug("Subscriber {} disconnected, {} chunks dropped".format(
+            subscriber.peer, subscriber.dropped_chunks))
@@ -2,28 +2,102 @@
 
 import logging
 import importlib
+import json
 import os
+import threading
 
 logger = logging.getLogger("gateway_devices")
 
 folder = os.path.dirname(os.path.abspath(__file__))
 
-EXCLUDED_FILE_NAMES = ["__init__.py", "generic_gateway_device.py"]
+EXCLUDED_FILE_NAMES = ["__init__.py", "generic_gateway_device.py", "zwave_serial_api.py"]
+MANIFEST_PATH = os.path.join(folder, "manifest.json")
+MATCH_ATTRIBUTES = ["ID_VENDOR_ID", "ID_MODEL_ID", "ID_VENDOR_ENC", "ID_SERIAL", "ID_PATH", "MATCH_PRIORITY"]
 
-__all__ = {}
 
-for file_name in os.listdir(folder):
-    file_path = "/".join((folder, file_name))
-    if os.path.isfile(file_path):
-        if file_name in EXCLUDED_FILE_NAMES:
-            continue
-        file_base = file_name.replace('.py', '')
-        module_path = "{}.{}".format(__name__, file_base)
+class PluginEntry(object):
+    """Match attributes of a device definition read from the manifest. The
+       module is imported the first time a device is created with it"""
+
+    def __init__(self, module_path, class_name, attributes):
+        self.module_path = module_path
+        self.__name__ = class_name
+        for name in MATCH_ATTRIBUTES:
+            setattr(self, name, attributes[name])
+        self.device_class = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self.device_class is None:
+                logger.debug("Loading device definition at {}".format(self.module_path))
+                self.device_class = importlib.import_module(self.module_path).get_class()
+            return self.device_class
+
+    def __call__(self, device):
+        return self.load()(device)
+
+
+def get_module_files():
+    """{module file name: modification time} of the device definitions"""
+    module_files = {}
+    for entry in os.scandir(folder):
+        if entry.is_file() and entry.name.endswith(".py") and entry.name not in EXCLUDED_FILE_NAMES:
+            module_files[entry.name] = entry.stat().st_mtime
+    return module_files
+
+
+def load_device_classes():
+    """import every device definition"""
+    device_classes = []
+    for file_name in sorted(get_module_files()):
+        module_path = "{}.{}".format(__name__, file_name[:-len(".py")])
         try:
             module = importlib.import_module(module_path)
         except Exception as e:
             logger.error("Error loading device definition at {}: \n{}".format(module_path, e))
+            continue
+        module_class = module.get_class()
+        try:
+            module_class.check_match_rule()
+        except Exception as e:
+            logger.error("Invalid device definition at {}: {}".format(module_path, e))
         else:
-            module_class = module.get_class()
-            module_device_identifier = module_class.get_device_identifier()
-            __all__[module_device_identifier] = module_class
\ No newline at end of file
+            device_classes.append(module_class)
+    return device_classes
+
+
+def load_device_definitions():
+    """device definitions from the manifest, without importing them. The
+       manifest is rebuilt from the modules when missing or out of date"""
+    module_files = get_module_files()
+    try:
+        with open(MANIFEST_PATH) as f:
+            manifest = json.load(f)
+        if manifest["modules"] == module_files:
+            return [PluginEntry(entry["module"], entry["class"], entry["match"]) for entry in manifest["devices"]]
+        logger.info("Device manifest out of date, loading device definitions")
+    except FileNotFoundError:
+        logger.info("No device manifest, loading device definitions")
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning("Could not read device manifest '{}': {}".format(MANIFEST_PATH, e))
+
+    device_classes = load_device_classes()
+    write_manifest(device_classes, module_files)
+    return device_classes
+
+
+def write_manifest(device_classes, module_files):
+    manifest = {
+        "modules": module_files,
+        "devices": [{"module": device_class.__module__, "class": device_class.__name__,
+                     "match": {name: getattr(device_class, name) for name in MATCH_ATTRIBUTES}}
+                    for device_class in device_classes],
+    }
+    temp_path = MANIFEST_PATH + ".tmp"
+    try:
+        with open(temp_path, "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(temp_path, MANIFEST_PATH)
+    except OSError as e:
+        logger.debug("Could not write device manifest '{}': {}".format(MANIFEST_PATH, e))
@@ -14,4 +14,7 @@ class EnoceanGatewayDevice(GenericGatewayDevice):
     ID_MODEL_ID = "6001"
     ID_VENDOR_ID = "0403"
     ID_VENDOR_ENC = "EnOcean\\x20GmbH"
-    PORT = 5558
\ No newline at end of file
+    PORT = 5558
+    MAX_SUBSCRIBERS = 8  # monitoring tools watch the receiver next to the controller
+    LATENCY_TIMER = 1  # FT232R, radio telegrams are a few bytes
+    LOW_LATENCY = True
\ No newline at end of file
@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 
-import hashlib
 import json
 import logging
+import os
+
+from backpressure import BackpressurePolicy
+from coalescing_policy import CoalescingPolicy
+from latency_tuning import LatencyProfile
+from session import SessionPolicy
 
 logger = logging.getLogger(__name__)
 
@@ -13,7 +18,37 @@ class GenericGatewayDevice(object):
     ID_MODEL_ID = ""
     ID_VENDOR_ID = ""
     ID_VENDOR_ENC = ""
+    ID_SERIAL = ""  # optional, e.g. a single stick among identical ones
+    ID_PATH = ""  # optional, physical USB port
+    MATCH_PRIORITY = 0  # the highest priority wins when several classes match
     PORT = ""
+    TCP_SOCKET = True  # False with UNIX_SOCKET serves clients on this host only
+    UNIX_SOCKET = False  # also listen on UNIX_SOCKET_DIR/<ID_SERIAL> for clients on this host
+    UNIX_SOCKET_DIR = "/run/rfc2217"
+    COALESCING_POLICY = CoalescingPolicy.LOWEST_LATENCY
+    COALESCING_MAX_BYTES = 4096
+    COALESCING_MAX_DELAY_US = 2000
+    COALESCING_TCP_CORK = False
+    COALESCING_ADAPTIVE_GAP_US = 1000  # adaptive policy: batch while reads come closer together than this
+    RECEIVE_BUFFER_SIZE = 16384
+    LATENCY_TIMER = None  # ms, FTDI adapters hold partly filled packets 16 ms by default, None leaves it
+    LOW_LATENCY = False  # set ASYNC_LOW_LATENCY on the tty
+    MAX_SUBSCRIBERS = 0  # read-only clients besides the primary one, 0 serves a single client
+    SUBSCRIBER_QUEUE_SIZE = 256  # serial chunks queued per subscriber before dropping the oldest
+    BACKPRESSURE_POLICY = BackpressurePolicy.BLOCK
+    BACKPRESSURE_HIGH_WATER = 262144  # bytes waiting for the client before the policy applies
+    BACKPRESSURE_LOW_WATER = 65536
+    WARM_SESSIONS = False  # keep DTR/RTS up between clients, for boards that reset on a DTR toggle
+    SESSION_MODE = False  # keep reading the port between clients and replay it to the next one
+    SESSION_REPLAY_BUFFER_SIZE = 65536
+    SESSION_REPLAY_MAX_AGE = 30  # seconds
+    SESSION_DEAD_PEER_TIMEOUT = 10  # seconds, keepalive and TCP user timeout
+    SESSION_TAKEOVER = True  # a new client replaces the connected one
+    RAW_MODE = False  # plain TCP byte pipe at the serial settings below instead of RFC2217
+    BAUDRATE = 115200
+    BYTESIZE = 8
+    PARITY = "N"
+    STOPBITS = 1
 
     def __init__(self, device):
         if not self.NAME:
@@ -27,19 +62,103 @@ class GenericGatewayDevice(object):
         if not self.PORT:
             raise Exception("USB device must provide a 'PORT'")
         self.device = device
+        self.properties_listeners = []
+        self.cached_properties = {}
 
     @classmethod
-    def get_device_identifier(cls):
+    def check_match_rule(cls):
+        """ids are required, '*' stands for any value"""
         if not cls.ID_MODEL_ID or not cls.ID_VENDOR_ID or not cls.ID_VENDOR_ENC:
             raise Exception("Undefined required parameters")
-        identifier_string = cls.ID_MODEL_ID + cls.ID_VENDOR_ID + cls.ID_VENDOR_ENC
-        return hashlib.sha224(identifier_string.encode('utf-8')).hexdigest()
+
+    def start_probe(self, port_broker):
+        """start reading the properties that have to be asked to the device itself,
+           through a subscription to port_broker. The port goes to the bridge
+           once the probe completes or after PortBroker.HAND_OVER_TIMEOUT"""
+        pass
+
+    def wait_for_properties(self, timeout=None):
+        """wait until the probe has completed, True if the properties are complete"""
+        return True
+
+    def stop_probe(self):
+        pass
+
+    def get_probed_properties(self):
+        """properties learned from the device itself, worth caching"""
+        return {}
+
+    def set_cached_properties(self, properties):
+        """properties from a previous probe, used until the probe completes"""
+        self.cached_properties = dict(properties)
+
+    def get_cache_key(self):
+        return self.device.get("ID_SERIAL") or self.device.get("ID_SERIAL_SHORT")
+
+    def add_properties_listener(self, listener):
+        self.properties_listeners.append(listener)
+
+    def notify_properties_changed(self):
+        properties = self.get_properties()
+        for listener in self.properties_listeners:
+            listener(properties)
 
     def get_name(self):
         return self.NAME
 
     def get_tcp_port(self):
-        return self.PORT
+        return self.PORT if self.TCP_SOCKET else None
+
+    def get_unix_socket_path(self):
+        if not self.UNIX_SOCKET:
+            return None
+        name = self.device.get("ID_SERIAL") or os.path.basename(self.get_serial_port())
+        return os.path.join(self.UNIX_SOCKET_DIR, name.replace("/", "_"))
+
+    def get_coalescing_policy(self):
+        return CoalescingPolicy(self.COALESCING_POLICY, self.COALESCING_MAX_BYTES,
+                                self.COALESCING_MAX_DELAY_US, self.COALESCING_TCP_CORK,
+                                self.COALESCING_ADAPTIVE_GAP_US)
+
+    def get_receive_buffer_size(self):
+        return self.RECEIVE_BUFFER_SIZE
+
+    def get_latency_profile(self):
+        if self.LATENCY_TIMER is None and not self.LOW_LATENCY:
+            return None
+        return LatencyProfile(self.LATENCY_TIMER, self.LOW_LATENCY)
+
+    def get_backpressure_policy(self):
+        return BackpressurePolicy(self.BACKPRESSURE_POLICY, self.BACKPRESSURE_HIGH_WATER,
+                                  self.BACKPRESSURE_LOW_WATER)
+
+    def get_warm_sessions(self):
+        return self.WARM_SESSIONS
+
+    def get_session_policy(self):
+        if not self.SESSION_MODE:
+            return None
+        return SessionPolicy(self.SESSION_REPLAY_BUFFER_SIZE, self.SESSION_REPLAY_MAX_AGE,
+                             self.SESSION_DEAD_PEER_TIMEOUT, self.SESSION_TAKEOVER)
+
+    def get_raw_settings(self):
+        """fixed serial settings of raw mode, None for RFC2217"""
+        if not self.RAW_MODE:
+            return None
+        return {"baudrate": self.BAUDRATE, "bytesize": self.BYTESIZE, "parity": self.PARITY,
+                "stopbits": self.STOPBITS}
+
+    def get_service_type(self):
+        return "_raw-serial" if self.RAW_MODE else "_rfc2217"
+
+    def get_service_name(self):
+        return "{} ({}:{})".format("Raw serial" if self.RAW_MODE else "RFC2217", self.get_id_vendor(), self.get_id_model())
+
+    def get_max_subscribers(self):
+        return self.MAX_SUBSCRIBERS
+
+    def get_subscriber_queue_size(self):
+        return self.SUBSCRIBER_QUEUE_SIZE
 
     def get_serial_port(self):
         return self.device.get("DEVNAME")
@@ -67,5 +186,6 @@ class GenericGatewayDevice(object):
                     "VENDOR_ID": vendor_id, "VENDOR": vendor,
                     "VENDOR_ENC": vendor_enc, "VENDOR_DB": vendor_db,
                     "SERIAL": serial, "SERIAL_SHORT": serial_short }
+        properties.update(self.cached_properties)
 
         return properties
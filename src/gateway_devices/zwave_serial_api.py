@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+import collections
+import logging
+import serial
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+ZWaveFrame = collections.namedtuple("ZWaveFrame", ["type", "function", "payload"])
+
+
+class ZWaveFrameDecoder(object):
+    """Incremental decoder of Z-Wave serial API frames. Bytes are fed in
+       any chunk size, complete frames with a valid length and checksum
+       are delivered to on_frame. Garbage and bad frames are skipped by
+       resyncing on the next SOF"""
+
+    SOF = 0x01
+    ACK = 0x06
+    NAK = 0x15
+    CAN = 0x18
+
+    REQUEST = 0x00
+    RESPONSE = 0x01
+
+    MIN_LENGTH = 3  # type, function and checksum
+    FRAME_TIMEOUT = 1.5  # maximum time to receive a whole frame, from the serial API spec
+
+    def __init__(self, on_frame, on_control=None, on_invalid_frame=None):
+        self.on_frame = on_frame
+        self.on_control = on_control
+        self.on_invalid_frame = on_invalid_frame
+        self.buffer = bytearray()
+        self.frame_started = None
+        self.frames = 0
+        self.invalid_frames = 0
+        self.garbage_bytes = 0
+
+    @staticmethod
+    def checksum(data):
+        checksum = 0xff
+        for byte in data:
+            checksum ^= byte
+        return checksum
+
+    def reset(self):
+        if self.buffer:
+            self.garbage_bytes += len(self.buffer)
+        self.buffer.clear()
+        self.frame_started = None
+
+    def expire(self, now=None):
+        """give up on a partial frame that has not completed in FRAME_TIMEOUT.
+           Its SOF was most likely a stray byte claiming a length that never
+           comes, only that byte is dropped and the rest is decoded again"""
+        now = time.monotonic() if now is None else now
+        if self.buffer and self.frame_started is not None and now - self.frame_started > self.FRAME_TIMEOUT:
+            logger.debug("Incomplete Z-Wave frame discarded, resyncing")
+            self.invalid_frames += 1
+            rest = bytes(self.buffer[1:])
+            self.buffer.clear()
+            self.frame_started = None
+            self.feed(rest, now)
+
+    def feed(self, data, now=None):
+        self.buffer += data
+        buffer = self.buffer
+        position = 0
+        while position < len(buffer):
+            byte = buffer[position]
+            if byte == self.SOF:
+                if len(buffer) - position < 2:
+                    break
+                length = buffer[position + 1]
+                if length < self.MIN_LENGTH:
+                    self.__invalid_frame()
+                    position += 1
+                    continue
+                end = position + 2 + length
+                if len(buffer) < end:
+                    break
+                if self.checksum(buffer[position + 1:end - 1]) != buffer[end - 1]:
+                    self.__invalid_frame()
+                    position += 1
+                    continue
+                self.frames += 1
+                self.on_frame(ZWaveFrame(buffer[position + 2], buffer[position + 3], bytes(buffer[position + 4:end - 1])))
+                position = end
+            elif byte in (self.ACK, self.NAK, self.CAN):
+                if self.on_control:
+                    self.on_control(byte)
+                position += 1
+            else:
+                self.garbage_bytes += 1
+                position += 1
+        del buffer[:position]
+        if buffer:
+            if position or self.frame_started is None:
+                self.frame_started = time.monotonic() if now is None else now
+        else:
+            self.frame_started = None
+
+    def __invalid_frame(self):
+        logger.debug("Invalid Z-Wave frame, resyncing")
+        self.invalid_frames += 1
+        if self.on_invalid_frame:
+            self.on_invalid_frame()
+
+
+class ZWaveFrameReceiver(object):
+    """Feeds the bytes of the serial port to a ZWaveFrameDecoder,
+       acknowledging every valid frame as the serial API requires. Feeding
+       b'' on a read timeout expires a partial frame while the stick is quiet"""
+
+    ACK = b'\x06'
+    NAK = b'\x15'
+
+    def __init__(self, write, on_frame):
+        self.write = write
+        self.on_frame = on_frame
+        self.decoder = ZWaveFrameDecoder(self.__on_frame, on_invalid_frame=self.__on_invalid_frame)
+
+    def feed(self, data):
+        self.decoder.expire()
+        self.decoder.feed(data)
+
+    def __on_frame(self, frame):
+        self.__write(self.ACK)
+        self.on_frame(frame)
+
+    def __on_invalid_frame(self):
+        self.__write(self.NAK)
+
+    def __write(self, data):
+        try:
+            self.write(data)
+        except (serial.SerialException, TypeError, OSError):
+            pass
+
+
+class ZWaveHomeIdHandler(object):
+
+    NAK = b'\x15'
+    MEMORY_ID_COMMAND = b'\x01\x03\x00\x20\xdc'
+    FUNC_ID_MEMORY_GET_ID = 0x20
+
+    SERIAL_SETTINGS = {"baudrate": 115200}
+
+    def __init__(self, port_broker, on_home_id_received=None):
+        self.home_id = None
+        self.home_id_received = threading.Event()
+        self.on_home_id_received = on_home_id_received
+        self.zwave_receiver = ZWaveFrameReceiver(self.__write, self.__on_frame)
+        self.subscription = port_broker.subscribe(self.zwave_receiver.feed, self.SERIAL_SETTINGS)
+
+    def start(self):
+        self.subscription.write(self.NAK)
+        self.subscription.write(self.MEMORY_ID_COMMAND)
+
+    def stop(self):
+        self.subscription.close()
+
+    def __write(self, data):
+        self.subscription.write(data)
+
+    def get_home_id(self, timeout=None):
+        self.home_id_received.wait(timeout)
+        return self.home_id
+
+    def __on_frame(self, frame):
+        if self.home_id_received.is_set():
+            return
+        home_id = self.get_home_id_from_frame(frame)
+        if home_id is None:
+            logger.debug("Ignoring Z-Wave frame {}".format(frame))
+            return
+        logger.info("Home ID: {}".format(home_id))
+        self.home_id = home_id
+        self.home_id_received.set()
+        # stop() waits for the thread delivering this frame
+        thread = threading.Thread(target=self.__on_home_id_received, args=[home_id])
+        thread.daemon = True
+        thread.name = 'zwave home id'
+        thread.start()
+
+    def __on_home_id_received(self, home_id):
+        self.stop()
+        if self.on_home_id_received:
+            self.on_home_id_received(home_id)
+
+    @classmethod
+    def get_home_id_from_frame(cls, frame):
+        if frame.type != ZWaveFrameDecoder.RESPONSE or frame.function != cls.FUNC_ID_MEMORY_GET_ID:
+            return None
+        if len(frame.payload) != 5 or frame.payload[4] != 1:  # home id and node id, which must be 1
+            return None
+        return frame.payload[:4].hex()
@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+
+import heapq
+import itertools
+import logging
+import os
+import queue
+import selectors
+import socket
+import threading
+import time
+
+import serial
+
+import rfc2217_codec
+from rfc2217_device import accept_client
+from rfc2217_redirector import Redirector
+
+logger = logging.getLogger(__name__)
+
+
+class EventLoopRedirector(Redirector):
+    """Redirector driven by an IOEngine instead of its own threads. Neither
+       the socket nor the serial port is ever written to with a blocking
+       call, a port that doesn't drain only holds up its own client"""
+
+    def __init__(self, serial_instance, socket, engine, debug=False, poll_modem_lines=False, coalescing_policy=None,
+                 receive_buffer_size=Redirector.RECEIVE_BUFFER_SIZE, metrics=None, backpressure_policy=None):
+        self.engine = engine
+        self.alive = True
+        # serial data the port did not take yet, the client is not read meanwhile
+        self.serial_buffer = bytearray()
+        # serial reads stopped by the block policy until the client catches up
+        self.serial_paused = False
+        self.on_socket_event = None
+        self.on_serial_event = None
+        self.on_coalescing_timeout = None
+        # open coalescing window: its timer, the data gathered, or its size when corked
+        self.coalescing_timer = None
+        self.coalescing_buffer = bytearray()
+        self.coalescing_size = 0
+        self.coalescing_cork = False
+        super().__init__(serial_instance, socket, debug, poll_modem_lines, coalescing_policy=coalescing_policy,
+                         receive_buffer_size=receive_buffer_size, metrics=metrics,
+                         backpressure_policy=backpressure_policy)
+        # created on the engine thread, the only one counting for this redirector
+        self.counters = self.metrics.local()
+        self.socket.setblocking(False)
+        os.set_blocking(self.serial.fileno(), False)
+
+    def queue(self, data, length=None):
+        """buffered socket write, flushed by the engine when the socket is writable.
+           The block policy is applied by the engine, which stops reading the
+           serial port while the buffer is full"""
+        if not self.send_buffer.append(data, length):
+            raise ConnectionAbortedError('send buffer overflow')
+        self.flush()
+
+    def flush(self):
+        while self.send_buffer:
+            data = self.send_buffer.peek()
+            try:
+                sent = self.socket.send(data)
+            except (BlockingIOError, InterruptedError):
+                break
+            self.send_buffer.consume(sent)
+            if sent < len(data):
+                break
+        if self.send_buffer:
+            self.counters.socket_send_stalls += 1
+        self.engine.update_events(self)
+
+    def handle_socket_data(self, length, counters=None):
+        """forward the first length bytes of the receive buffer to the serial
+           port, what the port doesn't take right away waits in the serial buffer"""
+        self.counters.socket_to_serial_bytes += length
+        self.counters.socket_to_serial_chunks += 1
+        data = rfc2217_codec.filter_buffer(self.rfc2217, self._rx_buffer, length)
+        if not len(data):
+            return
+        if not self.serial_buffer:
+            written = self.__write_serial(data)
+            if written == len(data):
+                return
+            data = data[written:]
+        # the receive buffer is reused, keep a copy
+        self.serial_buffer += data
+        self.engine.update_events(self)
+
+    def flush_serial(self):
+        """write the serial buffer once the port is writable again"""
+        if self.serial_buffer:
+            del self.serial_buffer[:self.__write_serial(self.serial_buffer)]
+        self.engine.update_events(self)
+
+    def coalesce(self, data, counters=None):
+        """Redirector.coalesce for the engine: the window is closed by an
+           engine timer or by max_bytes instead of a blocking wait on the port"""
+        policy = self.coalescing
+        policy.note_read()
+        if self.coalescing_timer is None:
+            if not policy.should_batch():
+                self.handle_serial_data(data, self.counters)
+                return
+            # unix sockets have no cork
+            self.coalescing_cork = policy.tcp_cork and self.socket.family != socket.AF_UNIX
+            if self.coalescing_cork:
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+            self.coalescing_size = 0
+            self.coalescing_timer = self.engine.call_later(policy.max_delay, self.on_coalescing_timeout)
+        self.coalescing_size += len(data)
+        if self.coalescing_cork:
+            self.handle_serial_data(data, self.counters)
+        else:
+            self.coalescing_buffer += data
+        if self.coalescing_size >= policy.max_bytes:
+            self.close_coalescing_window()
+
+    def close_coalescing_window(self):
+        """send what the open coalescing window gathered"""
+        if self.coalescing_timer is None:
+            return
+        self.engine.cancel_timer(self.coalescing_timer)
+        self.coalescing_timer = None
+        if self.coalescing_cork:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+        elif self.coalescing_buffer:
+            data = bytes(self.coalescing_buffer)
+            self.coalescing_buffer.clear()
+            self.handle_serial_data(data, self.counters)
+
+    def stop(self):
+        self.alive = False
+        if self.coalescing_timer is not None:
+            self.engine.cancel_timer(self.coalescing_timer)
+            self.coalescing_timer = None
+
+    def __write_serial(self, data):
+        try:
+            written = os.write(self.serial.fileno(), data)
+        except (BlockingIOError, InterruptedError):
+            return 0
+        except OSError as e:
+            raise serial.SerialException("write failed: {}".format(e))
+        self.counters.serial_writes += 1
+        return written
+
+
+class IOEngine(object):
+    """Single thread multiplexing the listening sockets, client sockets and
+       serial ports of every RFC2217Device with a selector"""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.sessions = {}
+        self.alive = False
+        self.thread = None
+        self._calls = queue.Queue()
+        # events of the call_and_wait() callers, released when the loop ends
+        self._waiters = set()
+        self._waiters_lock = threading.Lock()
+        # heap of [deadline, sequence, callback], a cancelled timer has no callback
+        self._timers = []
+        self._timer_sequence = itertools.count()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ, self.__on_wakeup)
+
+    def start(self):
+        self.alive = True
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.name = 'io engine'
+        self.thread.start()
+
+    def stop(self):
+        if self.alive:
+            self.alive = False
+            self.__wakeup()
+            self.thread.join()
+        self.selector.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+        logger.debug("IO engine stopped")
+
+    def call_soon(self, callback, *args):
+        """run callback on the engine thread"""
+        self._calls.put((callback, args))
+        self.__wakeup()
+
+    def call_and_wait(self, callback, *args):
+        """run callback on the engine thread and wait until it has completed.
+           When the engine isn't running, or ends before getting to it, the
+           callback runs on the calling thread"""
+        if threading.current_thread() is self.thread:
+            callback(*args)
+            return
+        done = threading.Event()
+        started = []
+
+        def wrapper():
+            started.append(True)
+            try:
+                callback(*args)
+            finally:
+                done.set()
+        with self._waiters_lock:
+            running = self.alive
+            if running:
+                self._waiters.add(done)
+        if running:
+            self.call_soon(wrapper)
+            done.wait()
+            with self._waiters_lock:
+                self._waiters.discard(done)
+        if not started:
+            callback(*args)
+
+    def add_device(self, device):
+        self.call_soon(self.__listen, device)
+
+    def remove_device(self, device):
+        self.call_and_wait(self.__remove_device, device)
+
+    def call_later(self, delay, callback):
+        """run callback on the engine thread after delay seconds, only called
+           from the engine thread. Returns the timer for cancel_timer"""
+        timer = [time.monotonic() + delay, next(self._timer_sequence), callback]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel_timer(self, timer):
+        timer[2] = None
+
+    def update_events(self, redirector):
+        """watch the client socket and the serial port of a session for what
+           its buffers need: the client is read while the serial buffer is
+           empty and written while the send buffer is not, the serial port
+           is read unless paused and written while the serial buffer is not"""
+        if redirector.on_socket_event is None:
+            # not registered yet, the engine updates the events after registering
+            return
+        self.__set_events(redirector.socket, redirector.on_socket_event,
+                          not redirector.serial_buffer, bool(redirector.send_buffer))
+        self.__set_events(redirector.serial.fileno(), redirector.on_serial_event,
+                          not redirector.serial_paused, bool(redirector.serial_buffer))
+
+    def __set_events(self, fileobj, callback, read, write):
+        events = (selectors.EVENT_READ if read else 0) | (selectors.EVENT_WRITE if write else 0)
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            key = None
+        if not events:
+            if key:
+                self.selector.unregister(fileobj)
+        elif not key:
+            self.selector.register(fileobj, events, callback)
+        elif key.events != events:
+            self.selector.modify(fileobj, events, callback)
+
+    def __wakeup(self):
+        try:
+            self._wakeup_w.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def __on_wakeup(self, mask):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def __run(self):
+        logger.debug("IO engine loop started")
+        try:
+            self.__loop()
+        except Exception:
+            logger.exception("IO engine loop failed, its devices are no longer served")
+        try:
+            for device in list(self.sessions):
+                self.__close_session(device, relisten=False)
+        except Exception:
+            logger.exception("Sessions not closed by the IO engine")
+        finally:
+            # calls still queued never run, their callers run them themselves
+            with self._waiters_lock:
+                self.alive = False
+                waiters = list(self._waiters)
+            for done in waiters:
+                done.set()
+        logger.debug("IO engine loop stopped")
+
+    def __loop(self):
+        while self.alive:
+            timeout = max(0, self._timers[0][0] - time.monotonic()) if self._timers else None
+            for key, mask in self.selector.select(timeout):
+                try:
+                    key.data(mask)
+                except Exception:
+                    logger.exception("Unhandled error in IO engine callback")
+            while True:
+                try:
+                    callback, args = self._calls.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    callback(*args)
+                except Exception:
+                    logger.exception("Unhandled error in IO engine call")
+            self.__run_timers()
+
+    def __run_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            deadline, sequence, callback = heapq.heappop(self._timers)
+            if not callback:
+                continue
+            try:
+                callback()
+            except Exception:
+                logger.exception("Unhandled error in IO engine timer")
+
+    def check_modem_lines(self, device):
+        """notify the client of the device about modem line changes, called
+           on the engine thread by the device's ModemLinesWatcher"""
+        redirector = self.sessions.get(device)
+        if not redirector:
+            return
+        try:
+            redirector.rfc2217.check_modem_lines()
+        except (OSError, serial.SerialException) as e:
+            # the client event closes the session, the watcher stays for the next client
+            logger.debug("Modem lines not sent to the client of '{}': {}".format(device.device_path, e))
+
+    def __listen(self, device):
+        for listening_socket in device.get_listening_sockets():
+            self.selector.register(listening_socket, selectors.EVENT_READ,
+                                   lambda mask, listening_socket=listening_socket: self.__accept(device, listening_socket))
+        logger.debug("RFCDevice ('{}') registered in IO engine".format(device.device_path))
+
+    def __remove_device(self, device):
+        if device in self.sessions:
+            self.__close_session(device, relisten=False)
+        else:
+            self.__unlisten(device)
+        logger.debug("RFCDevice ('{}') removed from IO engine".format(device.device_path))
+
+    def __unlisten(self, device):
+        for listening_socket in device.get_listening_sockets():
+            try:
+                self.selector.unregister(listening_socket)
+            except (KeyError, ValueError):
+                pass
+
+    def __accept(self, device, listening_socket):
+        try:
+            client_socket, peer = accept_client(listening_socket)
+        except BlockingIOError:
+            return
+        logger.debug('Connected by {}'.format(peer))
+        # serve a single client per device, like the threaded engine does
+        self.__unlisten(device)
+        device.raise_lines()
+        redirector = EventLoopRedirector(device.s_port, client_socket, self, poll_modem_lines=False,
+                                         coalescing_policy=device.coalescing_policy,
+                                         receive_buffer_size=device.receive_buffer_size,
+                                         metrics=device.metrics, backpressure_policy=device.backpressure_policy)
+        device.metrics.connection_opened()
+        device.s_redirector = redirector
+        self.sessions[device] = redirector
+        redirector.on_socket_event = lambda mask: self.__on_client_event(device, mask)
+        redirector.on_serial_event = lambda mask: self.__on_serial_event(device, mask)
+        redirector.on_coalescing_timeout = lambda: self.__on_coalescing_timeout(device)
+        # the registration may have queued data before the client socket was registered
+        redirector.flush()
+
+    def __on_client_event(self, device, mask):
+        redirector = self.sessions.get(device)
+        if not redirector:
+            return
+        try:
+            if mask & selectors.EVENT_WRITE:
+                redirector.flush()
+                if redirector.serial_paused and not redirector.send_buffer.is_full():
+                    redirector.serial_paused = False
+                    self.update_events(redirector)
+            if mask & selectors.EVENT_READ and not redirector.serial_buffer:
+                received = redirector.receive()
+                if not received:
+                    self.__close_session(device)
+                    return
+                redirector.handle_socket_data(received)
+        except BlockingIOError:
+            pass
+        except (socket.error, serial.SerialException) as msg:
+            logger.error('Client error: {}'.format(msg))
+            self.__close_session(device)
+
+    def __on_serial_event(self, device, mask):
+        redirector = self.sessions.get(device)
+        if not redirector:
+            return
+        try:
+            if mask & selectors.EVENT_WRITE:
+                redirector.flush_serial()
+            if mask & selectors.EVENT_READ and not redirector.serial_paused:
+                data = device.s_port.read(device.s_port.in_waiting or 1)
+                redirector.counters.serial_reads += 1
+                if data:
+                    redirector.coalesce(data)
+                self.__pause_if_full(redirector)
+        except (socket.error, serial.SerialException) as msg:
+            logger.error('{}'.format(msg))
+            self.__close_session(device)
+
+    def __on_coalescing_timeout(self, device):
+        redirector = self.sessions.get(device)
+        if not redirector:
+            return
+        try:
+            redirector.close_coalescing_window()
+            self.__pause_if_full(redirector)
+        except (socket.error, serial.SerialException) as msg:
+            logger.error('{}'.format(msg))
+            self.__close_session(device)
+
+    def __pause_if_full(self, redirector):
+        if redirector.send_buffer.is_full() and not redirector.serial_paused:
+            # block policy, leave the data in the serial port until the client catches up
+            redirector.serial_paused = True
+            self.update_events(redirector)
+
+    def __close_session(self, device, relisten=True):
+        redirector = self.sessions.pop(device, None)
+        if not redirector:
+            return
+        redirector.stop()
+        device.metrics.connection_closed()
+        device.s_redirector = None
+        for fileobj in (redirector.socket, device.s_port.fileno()):
+            try:
+                self.selector.unregister(fileobj)
+            except (KeyError, ValueError):
+                pass
+        try:
+            redirector.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            logger.warn("socket shutdown error")
+        redirector.socket.close()
+        device.drop_lines()
+        if relisten:
+            self.__listen(device)
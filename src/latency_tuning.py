@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import array
+import errno
+import fcntl
+import logging
+import os
+import termios
+
+logger = logging.getLogger(__name__)
+
+SYSFS_ROOT = "/sys"
+ASYNC_LOW_LATENCY = 0x2000
+# serial_struct, read and written as ints like pyserial does, flags is the fifth
+SERIAL_STRUCT_INTS = 32
+SERIAL_STRUCT_FLAGS = 4
+# errors returned for ttys without serial_struct, e.g. ptys and CDC ACM on old kernels
+UNSUPPORTED_ERRNOS = (errno.EINVAL, errno.ENOTTY, errno.ENOSYS, 515)
+
+
+class LatencyProfile(object):
+    """USB-serial adapter settings applied when the port is opened.
+
+       latency_timer: ms the adapter waits before sending a partly filled
+                      USB packet to the host (FTDI defaults to 16), None
+                      leaves it alone
+       low_latency: sets ASYNC_LOW_LATENCY on the tty
+    """
+
+    def __init__(self, latency_timer=None, low_latency=False):
+        if latency_timer is not None and not 1 <= latency_timer <= 255:
+            raise Exception("Latency timer must be between 1 and 255 ms, not {}".format(latency_timer))
+        self.latency_timer = latency_timer
+        self.low_latency = low_latency
+
+
+class LatencyTuner(object):
+    """Applies a LatencyProfile to an open port and puts the previous values
+       back, so other users of a stick that stays plugged find it unchanged"""
+
+    def __init__(self, serial_instance, profile, sysfs_root=SYSFS_ROOT):
+        self.serial = serial_instance
+        self.profile = profile
+        tty = os.path.basename(os.path.realpath(serial_instance.port))
+        self.latency_timer_path = os.path.join(sysfs_root, "class", "tty", tty, "device", "latency_timer")
+        self.original_latency_timer = None
+        self.original_low_latency = None
+
+    def apply(self):
+        if self.profile.latency_timer is not None:
+            self.original_latency_timer = self.__read_latency_timer()
+            if self.original_latency_timer is not None and self.original_latency_timer != self.profile.latency_timer:
+                self.__write_latency_timer(self.profile.latency_timer)
+        if self.profile.low_latency:
+            self.original_low_latency = self.__set_low_latency(True)
+        logger.debug("Latency of '{}': timer {} ms (was {}), low latency flag was {}".format(
+            self.serial.port, self.profile.latency_timer, self.original_latency_timer, self.original_low_latency))
+
+    def restore(self):
+        """best effort, the adapter is gone when this runs after an unplug"""
+        if self.original_latency_timer is not None and self.original_latency_timer != self.profile.latency_timer:
+            self.__write_latency_timer(self.original_latency_timer)
+        if self.original_low_latency is False:
+            self.__set_low_latency(False)
+        self.original_latency_timer = None
+        self.original_low_latency = None
+
+    def __read_latency_timer(self):
+        try:
+            with open(self.latency_timer_path) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            logger.debug("'{}' has no latency timer".format(self.serial.port))
+        except (OSError, ValueError) as e:
+            logger.warning("Can't read the latency timer of '{}': {}".format(self.serial.port, e))
+        return None
+
+    def __write_latency_timer(self, value):
+        try:
+            with open(self.latency_timer_path, "w") as f:
+                f.write("{}\n".format(value))
+        except OSError as e:
+            logger.warning("Can't set the latency timer of '{}': {}".format(self.serial.port, e))
+
+    def __set_low_latency(self, enabled):
+        """returns whether the flag was set before, None if the tty has no serial_struct"""
+        buf = array.array('i', [0] * SERIAL_STRUCT_INTS)
+        try:
+            fcntl.ioctl(self.serial.fileno(), termios.TIOCGSERIAL, buf)
+            previous = bool(buf[SERIAL_STRUCT_FLAGS] & ASYNC_LOW_LATENCY)
+            if previous != enabled:
+                buf[SERIAL_STRUCT_FLAGS] ^= ASYNC_LOW_LATENCY
+                fcntl.ioctl(self.serial.fileno(), termios.TIOCSSERIAL, buf)
+            return previous
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRNOS:
+                logger.warning("Can't change the low latency flag of '{}': {}".format(self.serial.port, e))
+            return None
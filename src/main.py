@@ -1,16 +1,48 @@
 #!/usr/bin/env python3
 
-import logging
-import pyudev
-import signal
 import time
+STARTED = time.perf_counter()
 
-from usb_devices_handler import UsbDevicesHandler
+import argparse  # noqa: E402
+import logging  # noqa: E402
+import pyudev  # noqa: E402
+import signal  # noqa: E402
+
+from metadata_cache import MetadataCache  # noqa: E402
+from metrics import MetricsRegistry, MetricsServer  # noqa: E402
+from modem_lines_monitor import install_wakeup_handler  # noqa: E402
+from udev_event_dispatcher import UdevEventDispatcher  # noqa: E402
+from usb_devices_handler import UsbDevicesHandler  # noqa: E402
 
 logging.basicConfig(format='%(asctime)s %(levelname)-6s - %(name)-16s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 INTERFACE = "wlp2s0"
+IO_ENGINE = "threaded"  # "threaded" or "eventloop"
+METRICS_PORT = None  # e.g. 9817 to serve Prometheus metrics on localhost
+METADATA_CACHE_PATH = "/var/cache/rfc2217-gateway/metadata.json"  # None disables the cache
+SYSFS_ROOT = "/sys"  # where USB-serial adapter latency timers are tuned
+SHARDS = 0  # worker processes the devices are spread over, 0 runs them all in this process
+UDEV_SETTLE_TIME = 0.5  # seconds a device must stay quiet before its udev events are applied
+
+
+class StartupProfile(object):
+    """time spent in each startup phase"""
+
+    def __init__(self, started):
+        self.phases = []
+        self.last = started
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        total = sum(seconds for phase, seconds in self.phases)
+        lines = ["{:<20} {:>8.1f} ms".format(phase, seconds * 1e3) for phase, seconds in self.phases]
+        lines.append("{:<20} {:>8.1f} ms".format("total", total * 1e3))
+        return "\n".join(lines)
 
 
 def usb_device_event(action, device):
@@ -24,25 +56,61 @@ def usb_device_event(action, device):
         devices_handler.delete_usb_device(device)
 
 
+def udev_monitor_event(action, device):
+    if not devices_handler.is_valid_device(device):
+        return
+    udev_dispatcher.post(action, device)
+
+
 def signal_handler(signal, frame):
+    udev_dispatcher.stop()
     devices_handler.stop_all_devices()
+    if metrics_server:
+        metrics_server.stop()
     logger.info("RFC2217 Gateway stopped")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RFC2217 Gateway")
+    parser.add_argument("--startup-profile", action="store_true", help="log the time spent in each startup phase")
+    args = parser.parse_args()
+    profile = StartupProfile(STARTED)
+    profile.mark("imports")
     logger.info("RFC2217 Gateway started")
+    # devices start their modem line watchers on bring-up threads, which can't install it
+    install_wakeup_handler()
 
-    devices_handler = UsbDevicesHandler(INTERFACE)
+    metrics_registry = MetricsRegistry()
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = MetricsServer(metrics_registry, METRICS_PORT)
+        metrics_server.start()
+    profile.mark("metrics")
 
+    metadata_cache = MetadataCache(METADATA_CACHE_PATH) if METADATA_CACHE_PATH else None
+    profile.mark("metadata cache")
+
+    devices_handler = UsbDevicesHandler(INTERFACE, IO_ENGINE, metrics_registry, metadata_cache, SYSFS_ROOT, SHARDS)
+    profile.mark("device definitions")
+
+    # only USB ttys can be gateway sticks, consoles and builtin UARTs are filtered out by udev
     context = pyudev.Context()
-    for device in context.list_devices(subsystem='tty'):
+    for device in context.list_devices(subsystem='tty', ID_BUS='usb'):
         usb_device_event("add", device)
+    profile.mark("udev enumeration")
 
+    udev_dispatcher = UdevEventDispatcher(devices_handler.create_usb_device, devices_handler.delete_usb_device,
+                                          UDEV_SETTLE_TIME)
+    udev_dispatcher.start()
     monitor = pyudev.Monitor.from_netlink(context)
     monitor.filter_by('tty')
 
-    usb_stick_observer = pyudev.MonitorObserver(monitor, usb_device_event)
+    usb_stick_observer = pyudev.MonitorObserver(monitor, udev_monitor_event)
     usb_stick_observer.start()
+    profile.mark("udev monitor")
+
+    if args.startup_profile:
+        logger.info("Startup profile:\n{}".format(profile.report()))
 
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
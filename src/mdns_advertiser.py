@@ -2,27 +2,59 @@
 
 import logging
 import socket
-import time
 import threading
 import netifaces as ni
 
-from zeroconf import ServiceInfo, Zeroconf
+from zeroconf import ServiceInfo
+
+from address_monitor import AddressMonitor
+from mdns_service import MDNSService
 
 logger = logging.getLogger(__name__)
 
 
+_default_service = None
+_default_address_monitor = None
+_defaults_lock = threading.Lock()
+
+
+def get_default_service():
+    """the process-wide MDNSService, started on first use"""
+    global _default_service
+    with _defaults_lock:
+        if _default_service is None:
+            _default_service = MDNSService()
+            _default_service.start()
+        return _default_service
+
+
+def get_default_address_monitor():
+    """the process-wide AddressMonitor, started on first use"""
+    global _default_address_monitor
+    with _defaults_lock:
+        if _default_address_monitor is None:
+            _default_address_monitor = AddressMonitor()
+            _default_address_monitor.start()
+        return _default_address_monitor
+
+
 class MDNSAdvertiser(object):
-    def __init__(self, type_, name, port, properties, server, interface):
+    def __init__(self, type_, name, port, properties, server, interface, mdns_service=None, address_monitor=None):
         self.type = type_
         self.name = name
+        # the name advertised, with a suffix when name is taken
+        self.instance_name = None
+        self.claimed_names = []
         self.interface = interface if interface else "eth0"
-        self.address = self.get_network_ip_address(interface)
+        self.address = None
         self.port = port
         self.properties = properties
         self.server = server if server else socket.gethostname()
+        self.mdns_service = mdns_service if mdns_service else get_default_service()
+        self.address_monitor = address_monitor if address_monitor else get_default_address_monitor()
         self.service = None
-        self.advertiser_thread = None
-        self.connectivity_thread = None
+        self.registered = threading.Event()
+        self._lock = threading.Lock()
         self.alive = None
 
     @staticmethod
@@ -44,41 +76,80 @@ class MDNSAdvertiser(object):
 
     def start(self):
         self.alive = True
-        self.connectivity_thread = threading.Thread(target=self.__check_connectivity)
-        self.connectivity_thread.setDaemon(1)
-        self.connectivity_thread.start()
+        self.instance_name = self.__claim_name()
+        if self.instance_name != self.name:
+            logger.info("mDNS name '{}' used by another device, advertising as '{}'".format(
+                self.name, self.instance_name))
+        self.address_monitor.add_listener(self.interface, self.__on_address_changed)
+        if not self.address:
+            logger.info("Waiting for an IPv4 address on interface '{}' to advertise '{}'".format(
+                self.interface, self.name))
 
     def stop(self):
         if self.alive:
             self.alive = False
-            if self.connectivity_thread:
-                self.connectivity_thread.join()
-            if self.advertiser_thread:
-                self.advertiser_thread.join()
+            self.address_monitor.remove_listener(self.interface, self.__on_address_changed)
+            with self._lock:
+                self.registered.clear()
+                if self.service:
+                    self.mdns_service.unregister(self.service)
+                    self.service = None
+                for name in self.claimed_names:
+                    self.mdns_service.release_name(self.type, name)
+                self.claimed_names = []
         logger.debug("mDNS advertiser stopped")
 
-    def __check_connectivity(self):
-        while self.alive and not self.address:
-            self.address = self.get_network_ip_address(self.interface)
-            time.sleep(1)
-
-        if self.alive:
-            self.advertiser_thread = threading.Thread(target=self.__start_advertising)
-            self.advertiser_thread.setDaemon(1)
-            self.advertiser_thread.start()
-            logger.debug("mDNS advertiser started")
+    def update_properties(self, properties):
+        """replace the TXT properties, re-announcing them if already registered"""
+        with self._lock:
+            if properties == self.properties:
+                return
+            self.properties = properties
+            if not self.service or not self.alive:
+                return
+            self.service = self.__create_service_info()
+            self.mdns_service.update(self.service, on_conflict=self.__on_conflict)
+            logger.debug("mDNS properties of '{}' updated".format(self.instance_name))
 
-    def __start_advertising(self):
-        self.service = ServiceInfo("{}._tcp.local.".format(self.type),
-                                   "{}.{}._tcp.local.".format(self.name, self.type),
-                                   socket.inet_aton(self.address), self.port, 0, 0,
-                                   self.properties, "{}.local.".format(self.server))
+    def __claim_name(self):
+        """the conflicting names stay claimed until stop(), they aren't tried again"""
+        name = self.mdns_service.claim_name(self.type, self.name)
+        self.claimed_names.append(name)
+        return name
 
-        zeroconf = Zeroconf()
-        zeroconf.register_service(self.service)
+    def __on_conflict(self, service):
+        """the name is in use on the network, registers the next free one"""
+        with self._lock:
+            if not self.alive or not self.service or self.service.name != service.name:
+                return
+            self.instance_name = self.__claim_name()
+            logger.warning("mDNS name '{}' in use on the network, advertising as '{}'".format(
+                service.name, self.instance_name))
+            self.service = self.__create_service_info()
+            self.mdns_service.register(self.service, self.registered.set, self.__on_conflict)
 
-        while self.alive:
-            time.sleep(.5)
+    def __create_service_info(self):
+        return ServiceInfo("{}._tcp.local.".format(self.type),
+                           "{}.{}._tcp.local.".format(self.instance_name, self.type),
+                           socket.inet_aton(self.address), self.port, 0, 0,
+                           self.properties, "{}.local.".format(self.server))
 
-        zeroconf.unregister_service(self.service)
-        zeroconf.close()
\ No newline at end of file
+    def __on_address_changed(self, address):
+        with self._lock:
+            if not self.alive or address == self.address and self.service:
+                return
+            self.address = address
+            if not address:
+                if self.service:
+                    self.mdns_service.unregister(self.service)
+                    self.service = None
+                    self.registered.clear()
+                    logger.info("mDNS advertisement of '{}' withdrawn, no address".format(self.name))
+            elif self.service:
+                self.service = self.__create_service_info()
+                self.mdns_service.update(self.service, on_conflict=self.__on_conflict)
+                logger.info("mDNS advertisement of '{}' moved to {}".format(self.name, address))
+            else:
+                self.service = self.__create_service_info()
+                self.mdns_service.register(self.service, self.registered.set, self.__on_conflict)
+                logger.debug("mDNS advertiser started")
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+import logging
+import queue
+import threading
+import time
+
+import zeroconf
+from zeroconf import Zeroconf
+
+logger = logging.getLogger(__name__)
+
+
+class BatchingZeroconf(Zeroconf):
+    """Zeroconf able to probe and announce several services with shared
+       packets and a single round of waits, instead of one service at a time"""
+
+    RECORDS_PER_PACKET = 8
+
+    def register_services(self, infos):
+        """registers every service without name conflicts, returns them"""
+        infos = self.__probe(infos)
+        for info in infos:
+            self.services[info.name.lower()] = info
+            self.servicetypes[info.type] = self.servicetypes.get(info.type, 0) + 1
+        self.__announce(infos, zeroconf._REGISTER_TIME)
+        return infos
+
+    def update_services(self, infos):
+        for info in infos:
+            self.services[info.name.lower()] = info
+        self.__announce(infos, zeroconf._REGISTER_TIME)
+
+    def unregister_services(self, infos):
+        for info in infos:
+            self.services.pop(info.name.lower(), None)
+            if self.servicetypes.get(info.type, 0) > 1:
+                self.servicetypes[info.type] -= 1
+            else:
+                self.servicetypes.pop(info.type, None)
+        self.__announce(infos, zeroconf._UNREGISTER_TIME, goodbye=True)
+
+    def __probe(self, infos):
+        for round_ in range(3):
+            unique = []
+            for info in infos:
+                if self.cache.current_entry_with_name_and_alias(info.type, info.name):
+                    logger.debug("mDNS name '{}' already in use".format(info.name))
+                else:
+                    unique.append(info)
+            infos = unique
+            for chunk in self.__chunks(infos):
+                out = zeroconf.DNSOutgoing(zeroconf._FLAGS_QR_QUERY | zeroconf._FLAGS_AA)
+                for info in chunk:
+                    out.add_question(zeroconf.DNSQuestion(info.type, zeroconf._TYPE_PTR, zeroconf._CLASS_IN))
+                    out.add_authorative_answer(zeroconf.DNSPointer(
+                        info.type, zeroconf._TYPE_PTR, zeroconf._CLASS_IN, info.other_ttl, info.name))
+                self.send(out)
+            self.__sleep(zeroconf._CHECK_TIME)
+        return infos
+
+    def __announce(self, infos, interval, goodbye=False):
+        for round_ in range(3):
+            if round_:
+                self.__sleep(interval)
+            for chunk in self.__chunks(infos):
+                out = zeroconf.DNSOutgoing(zeroconf._FLAGS_QR_RESPONSE | zeroconf._FLAGS_AA)
+                for info in chunk:
+                    for record in self.__records(info, goodbye):
+                        out.add_answer_at_time(record, 0)
+                self.send(out)
+
+    def __sleep(self, milliseconds):
+        """wait() returns early whenever a packet arrives, our own included"""
+        deadline = time.monotonic() + milliseconds / 1000.
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self.wait(remaining * 1000.)
+
+    @staticmethod
+    def __records(info, goodbye):
+        host_ttl = 0 if goodbye else info.host_ttl
+        other_ttl = 0 if goodbye else info.other_ttl
+        unique = zeroconf._CLASS_IN | zeroconf._CLASS_UNIQUE
+        records = [
+            zeroconf.DNSPointer(info.type, zeroconf._TYPE_PTR, zeroconf._CLASS_IN, other_ttl, info.name),
+            zeroconf.DNSService(info.name, zeroconf._TYPE_SRV, unique, host_ttl,
+                                info.priority, info.weight, info.port, info.server),
+            zeroconf.DNSText(info.name, zeroconf._TYPE_TXT, unique, other_ttl, info.text),
+        ]
+        for address in info.addresses:
+            records.append(zeroconf.DNSAddress(info.server, zeroconf._TYPE_A, unique, host_ttl, address))
+        return records
+
+    def __chunks(self, infos):
+        return [infos[i:i + self.RECORDS_PER_PACKET] for i in range(0, len(infos), self.RECORDS_PER_PACKET)]
+
+
+class MDNSService(object):
+    """Process-wide owner of the single Zeroconf instance. Registrations,
+       updates and removals are queued and applied in batches: requests
+       arriving within BATCH_WINDOW are reduced to the final state of each
+       service and announced together. A registration whose name is
+       already in use on the network calls its on_conflict with the info"""
+
+    BATCH_WINDOW = 0.2
+
+    def __init__(self):
+        self.zeroconf = None
+        self.registered = {}
+        self.thread = None
+        self.claimed_names = set()
+        self._requests = queue.Queue()
+        self._names_lock = threading.Lock()
+
+    def start(self):
+        self.zeroconf = BatchingZeroconf()
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.name = 'mdns service'
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self._requests.put(None)
+            self.thread.join()
+            self.thread = None
+        logger.debug("mDNS service stopped")
+
+    def claim_name(self, type_, name):
+        """instance name no other service of this type in the process uses:
+           name, else name-2, name-3 and so on. Kept until release_name()"""
+        with self._names_lock:
+            claimed = name
+            suffix = 1
+            while (type_, claimed) in self.claimed_names:
+                suffix += 1
+                claimed = "{}-{}".format(name, suffix)
+            self.claimed_names.add((type_, claimed))
+            return claimed
+
+    def release_name(self, type_, name):
+        with self._names_lock:
+            self.claimed_names.discard((type_, name))
+
+    def register(self, info, on_registered=None, on_conflict=None):
+        self._requests.put((info.name, info, on_registered, on_conflict))
+
+    def update(self, info, on_registered=None, on_conflict=None):
+        self._requests.put((info.name, info, on_registered, on_conflict))
+
+    def unregister(self, info):
+        self._requests.put((info.name, None, None, None))
+
+    def __run(self):
+        logger.debug("mDNS service started")
+        alive = True
+        while alive:
+            request = self._requests.get()
+            if request is None:
+                break
+            requests = [request]
+            deadline = time.monotonic() + self.BATCH_WINDOW
+            while True:
+                try:
+                    request = self._requests.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    alive = False
+                    break
+                requests.append(request)
+            try:
+                self.__apply(requests)
+            except Exception:
+                logger.exception("Error applying mDNS changes")
+        if self.registered:
+            self.__apply([(name, None, None, None) for name in list(self.registered)])
+        self.zeroconf.close()
+
+    def __apply(self, requests):
+        desired = {}
+        callbacks = {}
+        conflict_callbacks = {}
+        for name, info, callback, on_conflict in requests:
+            desired[name] = info
+            if info is None:
+                callbacks.pop(name, None)
+                conflict_callbacks.pop(name, None)
+                continue
+            if callback:
+                callbacks.setdefault(name, []).append(callback)
+            if on_conflict:
+                conflict_callbacks.setdefault(name, []).append(on_conflict)
+
+        to_register = []
+        to_update = []
+        to_unregister = []
+        for name, info in desired.items():
+            current = self.registered.get(name)
+            if info is None:
+                if current:
+                    to_unregister.append(current)
+            elif current is None:
+                to_register.append(info)
+            elif current is not info:
+                to_update.append(info)
+
+        if to_unregister:
+            self.zeroconf.unregister_services(to_unregister)
+            for info in to_unregister:
+                del self.registered[info.name]
+        if to_update:
+            self.zeroconf.update_services(to_update)
+            for info in to_update:
+                self.registered[info.name] = info
+        if to_register:
+            for info in self.zeroconf.register_services(to_register):
+                self.registered[info.name] = info
+        logger.debug("mDNS batch: {} registered, {} updated, {} unregistered".format(
+            len(to_register), len(to_update), len(to_unregister)))
+
+        for name, name_callbacks in callbacks.items():
+            if name in self.registered:
+                for callback in name_callbacks:
+                    callback()
+        for info in to_register:
+            if info.name not in self.registered:
+                for on_conflict in conflict_callbacks.get(info.name, []):
+                    on_conflict(info)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataCache(object):
+    """Probed device properties persisted on disk, keyed by USB serial.
+       Entries older than ttl seconds are ignored and the least recently
+       updated entries are evicted above max_entries"""
+
+    def __init__(self, path, ttl=30 * 24 * 3600, max_entries=256):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read metadata cache '{}': {}".format(self.path, e))
+            return
+        if isinstance(entries, dict):
+            self.entries = entries
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+        if not entry or time.time() - entry.get("updated", 0) > self.ttl:
+            return None
+        return entry.get("properties")
+
+    def put(self, key, properties):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry and entry.get("properties") == properties:
+                entry["updated"] = time.time()
+            else:
+                self.entries[key] = {"properties": properties, "updated": time.time()}
+            self.__evict()
+            self.__save()
+
+    def __evict(self):
+        now = time.time()
+        for key in [key for key, entry in self.entries.items() if now - entry.get("updated", 0) > self.ttl]:
+            del self.entries[key]
+        if len(self.entries) > self.max_entries:
+            ordered = sorted(self.entries, key=lambda key: self.entries[key].get("updated", 0))
+            for key in ordered[:len(self.entries) - self.max_entries]:
+                del self.entries[key]
+
+    def __save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        temp_path = None
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".metadata-")
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.entries, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            temp_path = None
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning("Could not write metadata cache '{}': {}".format(self.path, e))
+        finally:
+            if temp_path:
+                # the write or the rename failed, don't leave the temporary file behind
+                try:
+                    os.unlink(temp_path)
+                except OSError:
+                    pass
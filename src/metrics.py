@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceMetrics(object):
+    """I/O counters of a device. Every thread counts in its own Counters,
+       taken with local(), and only that thread updates them, so the data
+       path needs no lock. Reading a counter returns the sum over threads"""
+
+    COUNTERS = (
+        ("serial_to_socket_bytes", "Bytes read from the serial port and sent to the client"),
+        ("serial_to_socket_chunks", "Chunks sent from the serial port to the client"),
+        ("socket_to_serial_bytes", "Bytes received from the client, telnet commands included"),
+        ("socket_to_serial_chunks", "Chunks received from the client"),
+        ("serial_reads", "Read calls on the serial port"),
+        ("serial_writes", "Write calls on the serial port"),
+        ("socket_send_stalls", "Socket sends that had to wait for the client"),
+        ("connections", "Client connections accepted"),
+        ("connection_seconds", "Time clients have been connected"),
+        ("control_commands", "Telnet and RFC2217 control commands handled"),
+        ("subscriber_connections", "Read-only subscribers accepted"),
+        ("subscriber_dropped_chunks", "Serial chunks dropped for subscribers that could not keep up"),
+        ("send_buffer_stalls", "Times the send buffer to the client went above its high water"),
+        ("send_buffer_dropped_bytes", "Serial bytes dropped because the client could not keep up"),
+        ("send_buffer_disconnects", "Clients disconnected because they could not keep up"),
+        ("session_replayed_bytes", "Serial bytes kept between clients and replayed to the next one"),
+        ("session_dropped_bytes", "Serial bytes kept between clients but too old or too many to replay"),
+        ("session_takeovers", "Clients that replaced a connected client"),
+        ("serial_settings_applied", "Serial settings and modem lines changed on the port"),
+        ("serial_settings_skipped", "Serial settings and modem lines set to the value the port already had"),
+    )
+
+    def __init__(self, labels=None):
+        self.labels = labels if labels else {}
+        self.connected = 0
+        self._connected_since = None
+        # (thread, counters), the counters of finished threads are folded into _finished
+        self._counters = []
+        self._finished = Counters()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        if name in Counters.__slots__:
+            return self.totals()[name]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in Counters.__slots__:
+            raise AttributeError("'{}' is counted in local()".format(name))
+        object.__setattr__(self, name, value)
+
+    def local(self):
+        """counters of the calling thread. Loops fetch them once, the lookup
+           costs more than the updates"""
+        try:
+            return self._local.counters
+        except AttributeError:
+            counters = self._local.counters = self.add_counters(threading.current_thread())
+            return counters
+
+    def add_counters(self, thread=None):
+        """new counters added to the totals. Those of a thread are folded
+           once it has ended, those without one are kept as they are"""
+        counters = Counters()
+        with self._lock:
+            self._counters.append((thread, counters))
+        return counters
+
+    def totals(self):
+        """counter values summed over threads"""
+        with self._lock:
+            counters = []
+            for thread, thread_counters in self._counters:
+                if thread is not None and not thread.is_alive():
+                    self._finished.add(thread_counters)
+                else:
+                    counters.append((thread, thread_counters))
+            self._counters = counters
+            totals = self._finished.to_dict()
+            for thread, thread_counters in counters:
+                for name in Counters.__slots__:
+                    totals[name] += getattr(thread_counters, name)
+        return totals
+
+    def connection_opened(self):
+        self.local().connections += 1
+        self.connected = 1
+        self._connected_since = time.monotonic()
+
+    def connection_closed(self):
+        if self._connected_since is not None:
+            self.local().connection_seconds += time.monotonic() - self._connected_since
+            self._connected_since = None
+        self.connected = 0
+
+
+class Counters(object):
+    """counters updated by a single thread"""
+
+    __slots__ = tuple(name for name, description in DeviceMetrics.COUNTERS)
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+
+    def add(self, other):
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class MetricsRegistry(object):
+    PREFIX = "rfc2217"
+
+    def __init__(self):
+        self.devices = []
+        self._lock = threading.Lock()
+
+    def add(self, metrics):
+        with self._lock:
+            self.devices.append(metrics)
+
+    def remove(self, metrics):
+        with self._lock:
+            if metrics in self.devices:
+                self.devices.remove(metrics)
+
+    def to_prometheus(self):
+        with self._lock:
+            devices = list(self.devices)
+        totals = [device.totals() for device in devices]
+        lines = []
+        for name, description in DeviceMetrics.COUNTERS:
+            metric = "{}_{}_total".format(self.PREFIX, name)
+            lines.append("# HELP {} {}".format(metric, description))
+            lines.append("# TYPE {} counter".format(metric))
+            for device, device_totals in zip(devices, totals):
+                lines.append("{}{} {}".format(metric, self.__labels(device), device_totals[name]))
+        metric = "{}_connected".format(self.PREFIX)
+        lines.append("# HELP {} Whether a client is connected".format(metric))
+        lines.append("# TYPE {} gauge".format(metric))
+        for device in devices:
+            lines.append("{}{} {}".format(metric, self.__labels(device), device.connected))
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def __labels(device):
+        if not device.labels:
+            return ""
+        labels = ",".join('{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for key, value in sorted(device.labels.items()))
+        return "{" + labels + "}"
+
+
+class MetricsServer(object):
+    """Serves the registry in Prometheus text format on /metrics"""
+
+    def __init__(self, registry, port, address="127.0.0.1"):
+        self.registry = registry
+        self.port = port
+        self.address = address
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        # imported here, http.server is costly to import and the endpoint is optional
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self.server = ThreadingHTTPServer((self.address, self.port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.name = 'metrics server'
+        self.thread.start()
+        logger.info("Metrics available at http://{}:{}/metrics".format(self.address, self.port))
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+import errno
+import fcntl
+import logging
+import signal
+import termios
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TIOCMIWAIT = getattr(termios, 'TIOCMIWAIT', 0x545C)
+MODEM_LINES_MASK = termios.TIOCM_CTS | termios.TIOCM_DSR | termios.TIOCM_CD | termios.TIOCM_RNG
+# errors returned by drivers that don't implement TIOCMIWAIT (515 is ENOIOCTLCMD)
+UNSUPPORTED_ERRNOS = (errno.EINVAL, errno.ENOTTY, errno.ENOSYS, 515)
+# sent to a watcher blocked in TIOCMIWAIT, the ioctl returns EINTR
+WAKEUP_SIGNAL = signal.SIGUSR2
+
+
+def on_wakeup(signum, frame):
+    pass
+
+
+def install_wakeup_handler():
+    """without a handler the wakeup signal kills the process. Handlers can
+       only be installed from the main thread: main.py does it at startup,
+       ModemLinesWatcher.start() when it runs there. A handler the process
+       set before is kept, any handler makes TIOCMIWAIT return"""
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(WAKEUP_SIGNAL) == signal.SIG_DFL:
+        signal.signal(WAKEUP_SIGNAL, on_wakeup)
+
+
+def can_wake_up():
+    return signal.getsignal(WAKEUP_SIGNAL) not in (signal.SIG_DFL, signal.SIG_IGN, None)
+
+
+class ModemLinesPoller(object):
+    """Single thread polling the modem lines of every port whose driver
+       doesn't support change notifications"""
+
+    INTERVAL = 0.5
+
+    def __init__(self):
+        self.callbacks = {}
+        self.thread = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    def add(self, watcher):
+        with self._lock:
+            self.callbacks[watcher] = watcher.on_change
+            if not self.thread:
+                self.thread = threading.Thread(target=self.__poll)
+                self.thread.daemon = True
+                self.thread.name = 'modem lines poll'
+                self.thread.start()
+
+    def remove(self, watcher):
+        with self._lock:
+            self.callbacks.pop(watcher, None)
+            if not self.callbacks:
+                self._wakeup.set()
+
+    def __poll(self):
+        logger.debug('modem lines poll thread started')
+        while True:
+            self._wakeup.wait(self.INTERVAL)
+            with self._lock:
+                self._wakeup.clear()
+                if not self.callbacks:
+                    self.thread = None
+                    break
+                watchers = list(self.callbacks.items())
+            for watcher, callback in watchers:
+                if not watcher.alive:
+                    self.remove(watcher)
+                    continue
+                try:
+                    callback()
+                except Exception as e:
+                    logger.warning("Modem lines of '{}' not delivered: {}".format(watcher.serial.port, e))
+        logger.debug('modem lines poll thread terminated')
+
+
+poller = ModemLinesPoller()
+
+
+class ModemLinesWatcher(object):
+    """Calls on_change as soon as a modem line (CTS, DSR, CD, RI) of the
+       serial port changes, blocking on TIOCMIWAIT. Ports whose driver
+       doesn't support it are handed to the shared ModemLinesPoller, and so
+       are all ports with poll=True, which saves the thread per port"""
+
+    STOP_TIMEOUT = 1
+
+    def __init__(self, serial_instance, on_change, poll=False):
+        self.serial = serial_instance
+        self.on_change = on_change
+        self.poll = poll
+        self.alive = False
+        self.polling = False
+        self.thread = None
+
+    def start(self):
+        self.alive = True
+        if self.poll:
+            self.polling = True
+            poller.add(self)
+            return
+        install_wakeup_handler()
+        self.thread = threading.Thread(target=self.__wait_for_changes)
+        self.thread.daemon = True
+        self.thread.name = 'modem lines wait'
+        self.thread.start()
+
+    def stop(self):
+        self.alive = False
+        if self.polling:
+            poller.remove(self)
+        thread = self.thread
+        if not thread or thread is threading.current_thread():
+            return
+        # TIOCMIWAIT only returns on a line change, a hangup or a signal. The
+        # signal is repeated in case it came before the thread entered the ioctl
+        deadline = time.monotonic() + self.STOP_TIMEOUT
+        while thread.is_alive() and can_wake_up() and time.monotonic() < deadline:
+            try:
+                signal.pthread_kill(thread.ident, WAKEUP_SIGNAL)
+            except ProcessLookupError:
+                break
+            thread.join(0.01)
+        if thread.is_alive():
+            logger.debug("Modem lines watcher of '{}' exits on the next line change".format(self.serial.port))
+
+    def __wait_for_changes(self):
+        while self.alive:
+            try:
+                fcntl.ioctl(self.serial.fileno(), TIOCMIWAIT, MODEM_LINES_MASK)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno in UNSUPPORTED_ERRNOS and self.alive:
+                    logger.debug("TIOCMIWAIT not supported on '{}', polling modem lines".format(self.serial.port))
+                    self.polling = True
+                    poller.add(self)
+                break
+            except Exception:
+                # port closed
+                break
+            if not self.alive:
+                break
+            try:
+                self.on_change()
+            except Exception as e:
+                logger.warning("Modem lines of '{}' not delivered: {}".format(self.serial.port, e))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+import logging
+import select
+import socket
+import threading
+
+import serial
+
+logger = logging.getLogger(__name__)
+
+
+class PortSubscription(object):
+    """A probe's share of the port, valid until closed or until the port is
+       handed over to the bridge"""
+
+    def __init__(self, broker, on_data):
+        self.broker = broker
+        self.on_data = on_data
+        self.closed = False
+
+    def write(self, data):
+        self.broker.write(self, data)
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class PortBroker(object):
+    """Owns the only open handle of a device's serial port. Probes borrow
+       the byte stream through subscriptions, then the port is handed over
+       to the bridge for good. A read only happens while a subscription is
+       there to get the data, and is delivered before a subscription can
+       close: every byte goes to the probes or stays in the port for the
+       bridge, never both"""
+
+    HAND_OVER_TIMEOUT = 2  # seconds a running probe delays the bridge before being cancelled
+    READ_TIMEOUT = 0.5  # seconds without data before the subscriptions get an empty chunk
+
+    def __init__(self, serial_instance):
+        self.serial = serial_instance
+        self.subscriptions = []
+        self.saved_settings = None
+        self.closing = False
+        self.handed_over = False
+        self.thread = None
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+
+    def subscribe(self, on_data, settings=None):
+        """on_data(data) is called from the broker thread with every chunk
+           read, and with b'' after READ_TIMEOUT without data, like a serial
+           read timing out. settings, e.g. {"baudrate": 115200}, apply until
+           the last subscription closes"""
+        with self._lock:
+            if self.closing:
+                raise Exception("'{}' is handed over to the bridge".format(self.serial.port))
+            if settings:
+                if self.saved_settings is None:
+                    self.saved_settings = self.serial.get_settings()
+                self.serial.apply_settings(settings)
+            subscription = PortSubscription(self, on_data)
+            self.subscriptions.append(subscription)
+            if not self.thread:
+                self.thread = threading.Thread(target=self.__read)
+                self.thread.daemon = True
+                self.thread.name = 'serial->probes'
+                self.thread.start()
+            self._changed.notify_all()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription.closed:
+                return
+            subscription.closed = True
+            self.subscriptions.remove(subscription)
+            if not self.subscriptions:
+                self.__restore_settings()
+            self._changed.notify_all()
+
+    def write(self, subscription, data):
+        with self._lock:
+            if subscription.closed:
+                raise serial.SerialException("Subscription to '{}' is closed".format(self.serial.port))
+            self.serial.write(data)
+
+    def hand_over(self, timeout=HAND_OVER_TIMEOUT):
+        """wait up to timeout for the probes to complete, cancel those still
+           running and stop reading. The caller owns the port afterwards"""
+        with self._lock:
+            if self.closing:
+                return
+            self.closing = True
+            if self.subscriptions and timeout:
+                self._changed.wait_for(lambda: not self.subscriptions, timeout)
+            if self.subscriptions:
+                logger.warning("{} probes of '{}' still running, cancelling them".format(
+                    len(self.subscriptions), self.serial.port))
+                for subscription in self.subscriptions:
+                    subscription.closed = True
+                self.subscriptions = []
+                self.__restore_settings()
+            self.handed_over = True
+            self._changed.notify_all()
+            thread = self.thread
+        try:
+            self._wakeup_w.send(b'\0')
+        except OSError:
+            pass
+        if thread and thread is not threading.current_thread():
+            thread.join()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+    def close(self):
+        """stop without waiting for the probes, e.g. when the device is removed"""
+        self.hand_over(0)
+
+    def __restore_settings(self):
+        if self.saved_settings is None:
+            return
+        try:
+            self.serial.apply_settings(self.saved_settings)
+        except (OSError, ValueError, serial.SerialException) as e:
+            logger.warning("Can't restore the settings of '{}': {}".format(self.serial.port, e))
+        self.saved_settings = None
+
+    def __read(self):
+        logger.debug("probe reader of '{}' started".format(self.serial.port))
+        try:
+            while True:
+                with self._lock:
+                    self._changed.wait_for(lambda: self.subscriptions or self.handed_over)
+                    if self.handed_over:
+                        break
+                # wait without reading, the subscriptions may be gone when data arrives
+                readable, _, _ = select.select([self.serial.fileno(), self._wakeup_r], [], [], self.READ_TIMEOUT)
+                if self._wakeup_r in readable:
+                    break
+                with self._lock:
+                    if not self.subscriptions:
+                        continue
+                    data = self.serial.read(self.serial.in_waiting or 1) if readable else b""
+                    for subscription in list(self.subscriptions):
+                        subscription.on_data(data)
+        except (OSError, ValueError, serial.SerialException) as e:
+            logger.error("Probe reader of '{}' stopped: {}".format(self.serial.port, e))
+        logger.debug("probe reader of '{}' terminated".format(self.serial.port))
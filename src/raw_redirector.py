@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# plain byte pipe between a TCP connection and a serial port, like ser2net's
+# raw mode: no telnet negotiation, no escaping, fixed serial settings
+
+import errno
+import logging
+import os
+import select
+import socket
+import threading
+
+from metrics import DeviceMetrics
+
+
+class KernelCopy(object):
+    """Copies from one fd to another through a pipe with splice(), the data
+       never reaches user space. Falls back to a preallocated buffer where
+       the kernel can't splice the source, e.g. ttys on Linux 5.10 to 6.4"""
+
+    def __init__(self, source, destination, size, wait_writable):
+        self.source = source
+        self.destination = destination
+        self.size = size
+        self.wait_writable = wait_writable
+        self.pipe = os.pipe() if hasattr(os, "splice") else None
+        self.buffer = None
+
+    def copy(self):
+        """move what the source has ready, returns the byte count, 0 at the
+           end of the stream or None if the source had nothing"""
+        if self.pipe:
+            try:
+                count = os.splice(self.source, self.pipe[1], self.size, flags=os.SPLICE_F_MOVE)
+            except BlockingIOError:
+                return None
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+                self.close()
+                return self.copy()
+            remaining = count
+            while remaining:
+                try:
+                    remaining -= os.splice(self.pipe[0], self.destination, remaining, flags=os.SPLICE_F_MOVE)
+                except BlockingIOError:
+                    self.wait_writable(self.destination)
+            return count
+        if self.buffer is None:
+            self.buffer = bytearray(self.size)
+        try:
+            count = os.readv(self.source, [self.buffer])
+        except BlockingIOError:
+            return None
+        view = memoryview(self.buffer)[:count]
+        while view:
+            try:
+                view = view[os.write(self.destination, view):]
+            except BlockingIOError:
+                self.wait_writable(self.destination)
+        return count
+
+    def close(self):
+        if self.pipe:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+            self.pipe = None
+
+
+class RawRedirector(object):
+    """Copies bytes unchanged between the serial port and the socket. Serial
+       settings are whatever the port was opened with, the client can't
+       change them. A client slower than the serial port holds up the
+       reader, like the block backpressure policy"""
+
+    BUFFER_SIZE = 65536  # the default pipe capacity
+
+    def __init__(self, serial_instance, client_socket, metrics=None, buffer_size=BUFFER_SIZE):
+        self.serial = serial_instance
+        self.socket = client_socket
+        self.metrics = metrics if metrics else DeviceMetrics()
+        self.buffer_size = buffer_size
+        self.alive = True
+        self.thread_read = None
+        self.thread_write = None
+        self.socket.setblocking(True)
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self.log = logging.getLogger('redirector')
+
+    def shortcircuit(self):
+        """connect the serial port to the TCP port by copying everything
+           from one side to the other"""
+        self.thread_write = threading.current_thread()
+        self.thread_read = threading.Thread(target=self.reader)
+        self.thread_read.daemon = True
+        self.thread_read.name = 'serial->socket'
+        self.thread_read.start()
+        self.writer()
+
+    def reader(self):
+        """loop forever and copy serial->socket"""
+        serial_fd = self.serial.fileno()
+        copier = KernelCopy(serial_fd, self.socket.fileno(), self.buffer_size, self.__wait_writable)
+        counters = self.metrics.local()
+        try:
+            while self.alive:
+                readable, _, _ = select.select([serial_fd, self._wakeup_r], [], [])
+                if self._wakeup_r in readable:
+                    break
+                count = copier.copy()
+                counters.serial_reads += 1
+                if count is None:
+                    continue
+                if not count:
+                    raise OSError(errno.EIO, 'serial port readable without data, unplugged?')
+                counters.serial_to_socket_bytes += count
+                counters.serial_to_socket_chunks += 1
+        except OSError as msg:
+            if self.alive:
+                self.log.error('Reader error: {}'.format(msg))
+            # the serial port was probably unplugged, let the writer see the end of the session
+            self.__shutdown_socket()
+        finally:
+            copier.close()
+        self.alive = False
+        self.log.debug('reader thread terminated')
+
+    def handle_serial_data(self, data):
+        """send serial data read elsewhere, e.g. kept while no client was connected"""
+        counters = self.metrics.local()
+        counters.serial_to_socket_bytes += len(data)
+        counters.serial_to_socket_chunks += 1
+        self.socket.sendall(data)
+
+    def writer(self):
+        """loop forever and copy socket->serial"""
+        copier = KernelCopy(self.socket.fileno(), self.serial.fileno(), self.buffer_size, self.__wait_writable)
+        counters = self.metrics.local()
+        try:
+            while self.alive:
+                count = copier.copy()
+                if count == 0:
+                    break
+                if count is None:
+                    continue
+                counters.socket_to_serial_bytes += count
+                counters.socket_to_serial_chunks += 1
+                counters.serial_writes += 1
+        except OSError as msg:
+            if self.alive:
+                self.log.error('Writer error: {}'.format(msg))
+        finally:
+            copier.close()
+        self.stop()
+        self.thread_read.join()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+    def stop(self):
+        """Stop copying"""
+        self.log.debug('stopping')
+        self.__shutdown_socket()
+        if self.alive:
+            self.alive = False
+            try:
+                self._wakeup_w.send(b'\0')
+            except OSError:
+                pass
+            if self.thread_read and threading.current_thread() is not self.thread_read:
+                self.thread_read.join()
+
+    def __wait_writable(self, fd):
+        """wait until a non-blocking fd takes data again, giving up when stopped"""
+        readable, _, _ = select.select([self._wakeup_r], [fd], [])
+        if readable or not self.alive:
+            raise ConnectionAbortedError('redirector stopped')
+
+    def __shutdown_socket(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+#
+# bulk versions of the Telnet IAC escaping and filtering done by
+# serial.rfc2217.PortManager, which works byte by byte
+
+from serial.rfc2217 import IAC, IAC_DOUBLED, M_NORMAL
+
+
+def escape(data):
+    """escape outgoing data (Telnet IAC (0xff) character), same result as
+       b''.join(PortManager.escape(data))"""
+    if IAC not in data:
+        return data
+    return data.replace(IAC, IAC_DOUBLED)
+
+
+def filter(port_manager, data):
+    """handle incoming data, same result as b''.join(PortManager.filter(data)).
+
+       Plain data is copied in slices, only the Telnet command sections are
+       handed to the PortManager state machine"""
+    if port_manager.mode == M_NORMAL and port_manager.suboption is None and IAC not in data:
+        return data
+
+    chunks = []
+    position = 0
+    length = len(data)
+    while position < length:
+        if port_manager.mode == M_NORMAL and port_manager.suboption is None:
+            index = data.find(IAC, position)
+            if index < 0:
+                chunks.append(data[position:])
+                break
+            chunks.append(data[position:index])
+            position = index
+            if data[position + 1:position + 2] == IAC:
+                # doubled IAC -> the character itself
+                chunks.append(IAC)
+                position += 2
+                continue
+        chunks.extend(port_manager.filter(data[position:position + 1]))
+        position += 1
+    return b''.join(chunks)
+
+
+def filter_buffer(port_manager, buffer, length):
+    """filter() for the first length bytes of a bytearray. When there is
+       nothing to filter a memoryview on the buffer is returned, no copy is made"""
+    if port_manager.mode == M_NORMAL and port_manager.suboption is None and buffer.find(IAC, 0, length) < 0:
+        return memoryview(buffer)[:length]
+    return filter(port_manager, bytes(memoryview(buffer)[:length]))
@@ -1,23 +1,158 @@
 #!/usr/bin/env python
 
+import fcntl
 import logging
+import os
+import select
 import serial
 import socket
 import threading
-import time
 
-from rfc2217_redirector import Redirector
+from fan_out import FanOut
+from latency_tuning import SYSFS_ROOT, LatencyTuner
+from metrics import DeviceMetrics
+from modem_lines_monitor import ModemLinesWatcher
+from port_broker import PortBroker
+from raw_redirector import RawRedirector
+from rfc2217_redirector import Redirector, SettingsFilter
+from session import ReplayBuffer, SerialHolder, set_dead_peer_timeout
 
 logger = logging.getLogger(__name__)
 
+
+def accept_client(listening_socket):
+    """accept a connection, returns the client socket and a printable peer name"""
+    client_socket, addr = listening_socket.accept()
+    if client_socket.family == socket.AF_UNIX:
+        return client_socket, "unix:{}".format(listening_socket.getsockname())
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return client_socket, "{}:{}".format(addr[0], addr[1])
+
+
 class RFC2217Device(object):
-    def __init__(self, device_path, tcp_port):
+    # wraps a tty passed by another process
+    SERIAL_CLASS = serial.Serial
+
+    def __init__(self, device_path, tcp_port, engine=None, coalescing_policy=None,
+                 receive_buffer_size=Redirector.RECEIVE_BUFFER_SIZE, metrics=None, do_not_open=False,
+                 max_subscribers=0, subscriber_queue_size=256, backpressure_policy=None, raw_settings=None,
+                 unix_path=None, session_policy=None, warm_sessions=False, latency_profile=None,
+                 sysfs_root=SYSFS_ROOT):
         self.device_path = device_path
+        # clients connect to the TCP port, the unix socket path or both
         self.tcp_port = tcp_port
-        self.s_port = self.connect_serial_port(self.device_path)
-        self.s_socket = self.create_socket(self.tcp_port)
+        self.unix_path = unix_path
+        # raw mode: fixed serial settings, the client gets a plain byte pipe
+        self.raw_settings = raw_settings
+        if raw_settings and (engine or max_subscribers):
+            logger.info("RFCDevice '{}' in raw mode, using threads and a single client".format(device_path))
+            engine = None
+            max_subscribers = 0
+        self.max_subscribers = max_subscribers
+        self.subscriber_queue_size = subscriber_queue_size
+        if engine and max_subscribers:
+            logger.info("RFCDevice '{}' serves subscribers, using threads instead of the IO engine".format(device_path))
+            engine = None
+        self.session_policy = session_policy
+        if engine and session_policy:
+            logger.info("RFCDevice '{}' keeps sessions, using threads instead of the IO engine".format(device_path))
+            engine = None
+        # keep DTR/RTS up between clients, some boards reset on a DTR toggle
+        self.warm_sessions = warm_sessions
+        self.engine = engine
+        self.coalescing_policy = coalescing_policy
+        self.backpressure_policy = backpressure_policy
+        self.receive_buffer_size = receive_buffer_size
+        self.latency_profile = latency_profile
+        self.sysfs_root = sysfs_root
+        self.latency_tuner = None
+        self.metrics = metrics if metrics else DeviceMetrics({"device": device_path, "port": tcp_port})
+        self.thread = None
+        self.session_thread = None
+        self.fan_out = None
+        self.replay_buffer = None
+        self.serial_holder = None
+        self.s_port = None
+        self.port_broker = None
+        self.s_socket = None
+        self.u_socket = None
+        if not do_not_open:
+            self.open_serial_port()
+            self.open_socket()
         self.s_redirector = None
+        self.modem_lines_watcher = None
         self.started = False
+        self._session_lock = threading.Lock()
+        self._wakeup_receiver, self._wakeup_sender = socket.socketpair()
+
+    def open_serial_port(self, s_port=None):
+        """open the port and prepare it for the bridge, or prepare s_port
+           already opened with connect_serial_port()"""
+        self.s_port = s_port if s_port else self.connect_serial_port(self.device_path)
+        if self.raw_settings:
+            self.s_port.apply_settings(self.raw_settings)
+        if self.latency_profile:
+            self.latency_tuner = LatencyTuner(self.s_port, self.latency_profile, self.sysfs_root)
+            self.latency_tuner.apply()
+        # probes share the port until start()
+        self.port_broker = PortBroker(self.s_port)
+
+    def raise_lines(self):
+        """DTR and RTS up for a new client, lines already up are not touched"""
+        lines = SettingsFilter(self.s_port, self.metrics)
+        lines.dtr = True
+        lines.rts = True
+
+    def drop_lines(self):
+        """DTR and RTS down once the client left, unless the device stays warm"""
+        if self.warm_sessions or self.session_policy:
+            return
+        try:
+            self.s_port.rts = False
+            self.s_port.dtr = False
+        except:
+            pass
+
+    def open_socket(self):
+        self.s_socket, self.u_socket = self.bind_sockets()
+
+    def bind_sockets(self):
+        """the TCP and unix listening sockets, None for those not configured"""
+        tcp_socket = self.create_socket(self.tcp_port) if self.tcp_port else None
+        try:
+            unix_socket = self.create_unix_socket(self.unix_path) if self.unix_path else None
+        except Exception:
+            if tcp_socket:
+                tcp_socket.close()
+            raise
+        return tcp_socket, unix_socket
+
+    def set_listening_sockets(self, tcp_socket, unix_socket):
+        """serve sockets bound by another process, e.g. passed to a shard worker"""
+        self.s_socket = tcp_socket
+        self.u_socket = unix_socket
+        for listening_socket in self.get_listening_sockets():
+            listening_socket.setblocking(0)
+
+    def get_listening_sockets(self):
+        return [sock for sock in (self.s_socket, self.u_socket) if sock]
+
+    def wrap_serial_port(self, fd, settings):
+        """serial instance on a tty opened by another process, e.g. passed to
+           a shard worker. Unlike open() it writes nothing to the tty, its
+           settings, lines and buffered data stay as the owner left them"""
+        ser = self.SERIAL_CLASS(None)
+        ser.port = self.device_path
+        ser.apply_settings(settings)
+        ser.dtr = settings["dtr"]
+        ser.rts = settings["rts"]
+        ser.fd = fd
+        ser.pipe_abort_read_r, ser.pipe_abort_read_w = os.pipe()
+        ser.pipe_abort_write_r, ser.pipe_abort_write_w = os.pipe()
+        fcntl.fcntl(ser.pipe_abort_read_r, fcntl.F_SETFL, os.O_NONBLOCK)
+        fcntl.fcntl(ser.pipe_abort_write_r, fcntl.F_SETFL, os.O_NONBLOCK)
+        ser.is_open = True
+        return ser
 
     def connect_serial_port(self, port_path):
         ser = serial.serial_for_url(port_path, do_not_open=True)
@@ -32,52 +167,208 @@ class RFC2217Device(object):
         srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         srv.bind(('', port))
-        srv.listen(1)
+        srv.listen(1 + self.max_subscribers)
+        srv.setblocking(0)
+
+        return srv
+
+    def create_unix_socket(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            # left behind by a gateway that did not stop cleanly
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        srv.bind(path)
+        srv.listen(1 + self.max_subscribers)
         srv.setblocking(0)
 
         return srv
 
     def start(self):
+        if self.port_broker:
+            self.port_broker.hand_over()
         self.started = True
+        if not self.raw_settings:
+            # raw clients have no channel for modem line changes
+            # the IO engine keeps its single thread, its ports share the poller
+            self.modem_lines_watcher = ModemLinesWatcher(self.s_port, self.__on_modem_lines_changed,
+                                                         poll=bool(self.engine))
+            self.modem_lines_watcher.start()
+        if self.engine:
+            self.engine.add_device(self)
+            return
+        if self.session_policy and self.session_policy.replay_buffer_size:
+            self.replay_buffer = ReplayBuffer(self.session_policy.replay_buffer_size,
+                                              self.session_policy.replay_max_age, self.metrics)
+        if self.max_subscribers:
+            # the fan out reads the port all the time, it fills the replay buffer itself
+            self.fan_out = FanOut(self.s_port, self.max_subscribers, self.subscriber_queue_size, self.metrics,
+                                  self.replay_buffer)
+            self.fan_out.start()
+        elif self.replay_buffer:
+            self.serial_holder = SerialHolder(self.s_port, self.replay_buffer)
+            self.serial_holder.start()
         self.thread = threading.Thread(target=self.__start)
         self.thread.daemon = True
         self.thread.start()
 
     def stop(self):
-        self.started = False
-        if self.s_redirector:
-            self.s_redirector.stop()
-        self.thread.join()
-        self.s_port.close()
-        self.s_socket.shutdown(socket.SHUT_RDWR)
-        self.s_socket.close()
+        with self._session_lock:
+            self.started = False
+            redirector = self.s_redirector
+        # wake up the accept loop, a serial write stuck on flow control and
+        # the redirector threads, nothing waits for a timeout
+        try:
+            self._wakeup_sender.send(b'\0')
+        except OSError:
+            pass
+        if self.s_port:
+            try:
+                self.s_port.cancel_write()
+            except (AttributeError, NotImplementedError, OSError, serial.SerialException):
+                pass
+        if self.modem_lines_watcher:
+            self.modem_lines_watcher.stop()
+        if self.engine:
+            self.engine.remove_device(self)
+        if redirector:
+            redirector.stop()
+        if self.fan_out:
+            self.fan_out.stop()
+        if self.thread:
+            self.thread.join()
+        if self.session_thread:
+            self.session_thread.join()
+        if self.serial_holder:
+            self.serial_holder.stop()
+        if self.port_broker:
+            self.port_broker.close()
+        if self.latency_tuner:
+            self.latency_tuner.restore()
+        if self.s_port:
+            self.s_port.close()
+        for listening_socket in self.get_listening_sockets():
+            try:
+                listening_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            listening_socket.close()
+        if self.u_socket:
+            try:
+                os.unlink(self.unix_path)
+            except OSError:
+                pass
+        self._wakeup_receiver.close()
+        self._wakeup_sender.close()
         logger.debug("RFCDevice '{}' completely stopped".format(self.device_path))
 
+    def __on_modem_lines_changed(self):
+        redirector = self.s_redirector
+        if not redirector or not redirector.alive:
+            return
+        if self.engine:
+            self.engine.call_soon(self.engine.check_modem_lines, self)
+            return
+        try:
+            redirector.rfc2217.check_modem_lines()
+        except (OSError, serial.SerialException) as e:
+            # the session is ending, the watcher stays for the next client
+            logger.debug("Modem lines not sent to the client of '{}': {}".format(self.device_path, e))
+
     def __start(self):
         logger.debug("RFCDevice ('{}') main loop started".format(self.device_path))
         while(self.started):
+            readable, _, _ = select.select(self.get_listening_sockets() + [self._wakeup_receiver], [], [])
+            if self._wakeup_receiver in readable:
+                break
             try:
-                client_socket, addr = self.s_socket.accept()
+                client_socket, peer = accept_client(readable[0])
             except BlockingIOError:
-                time.sleep(0.5)
                 continue
-            logger.debug('Connected by {}:{}'.format(addr[0], addr[1]))
-            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            self.s_port.dtr = True
-            self.s_port.rts = True
-            self.s_redirector = Redirector(self.s_port, client_socket)
-            try:
-                self.s_redirector.shortcircuit()
-            finally:
-                self.s_redirector.stop()
-                try:
-                    client_socket.shutdown(socket.SHUT_RDWR)
-                except OSError:
-                    logger.warn("socket shutdown error")
-                client_socket.close()
+            logger.debug('Connected by {}'.format(peer))
+            if self.session_policy:
+                set_dead_peer_timeout(client_socket, self.session_policy.dead_peer_timeout)
+            with self._session_lock:
+                if not self.started:
+                    client_socket.close()
+                    break
+                current = self.s_redirector if self.s_redirector and self.s_redirector.alive else None
+                if self.fan_out and current:
+                    # the primary client is connected, others can only watch
+                    if not self.fan_out.add_subscriber(client_socket, peer):
+                        logger.warning("Too many subscribers on '{}', closing connection from {}".format(
+                            self.device_path, peer))
+                        client_socket.close()
+                    continue
+                if current and not (self.session_policy and self.session_policy.takeover):
+                    logger.warning("'{}' is in use, closing connection from {}".format(self.device_path, peer))
+                    client_socket.close()
+                    continue
+            if current:
+                # most likely a client that went away without closing its connection
+                logger.info("Client {} takes over '{}'".format(peer, self.device_path))
+                self.metrics.local().session_takeovers += 1
+                current.stop()
+            if self.session_thread:
+                self.session_thread.join()
+            with self._session_lock:
+                if not self.started:
+                    client_socket.close()
+                    break
+                self.raise_lines()
+                if self.raw_settings:
+                    self.s_redirector = RawRedirector(self.s_port, client_socket, self.metrics)
+                else:
+                    backpressure_policy = self.backpressure_policy
+                    if self.fan_out:
+                        backpressure_policy = FanOut.get_primary_policy(backpressure_policy)
+                    self.s_redirector = Redirector(self.s_port, client_socket, poll_modem_lines=False,
+                                                   coalescing_policy=self.coalescing_policy,
+                                                   receive_buffer_size=self.receive_buffer_size,
+                                                   metrics=self.metrics, read_serial=not self.fan_out,
+                                                   backpressure_policy=backpressure_policy)
+                if self.fan_out:
+                    self.fan_out.set_primary(self.s_redirector)
+            if self.fan_out or self.session_policy:
+                # keep accepting subscribers or new clients while the session runs
+                self.session_thread = threading.Thread(target=self.__serve,
+                                                       args=(self.s_redirector, client_socket))
+                self.session_thread.daemon = True
+                self.session_thread.name = 'rfc2217 session'
+                self.session_thread.start()
+            else:
+                self.__serve(self.s_redirector, client_socket)
+        logger.debug("RFCDevice ('{}') main loop stopped".format(self.device_path))
+
+    def __serve(self, redirector, client_socket):
+        self.metrics.connection_opened()
+        try:
+            if self.serial_holder:
+                # what is left in the port is read by the redirector
+                self.serial_holder.stop()
                 try:
-                    self.s_port.rts = False
-                    self.s_port.dtr = False
-                except:
-                    pass
-        logger.debug("RFCDevice ('{}') main loop stopped".format(self.device_path))
\ No newline at end of file
+                    for data in self.replay_buffer.take():
+                        redirector.handle_serial_data(data)
+                except OSError as e:
+                    logger.warning("Replay to the new client of '{}' failed: {}".format(self.device_path, e))
+                    return
+            redirector.shortcircuit()
+        finally:
+            redirector.stop()
+            if self.fan_out:
+                self.fan_out.clear_primary(redirector)
+            self.metrics.connection_closed()
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                logger.warn("socket shutdown error")
+            client_socket.close()
+            with self._session_lock:
+                if self.s_redirector is redirector:
+                    self.s_redirector = None
+                # the device keeps running for the next client
+                if self.session_policy and self.serial_holder and self.started:
+                    self.serial_holder.start()
+            self.drop_lines()
\ No newline at end of file
@@ -8,22 +8,88 @@
 # SPDX-License-Identifier:    BSD-3-Clause
 
 import logging
+import os
+import select
 import socket
 import sys
 import time
 import threading
+import serial
 import serial.rfc2217
 
+import rfc2217_codec
+from backpressure import BackpressurePolicy, SendBuffer
+from coalescing_policy import CoalescingPolicy
+from metrics import DeviceMetrics
+
+
+class MeteredPortManager(serial.rfc2217.PortManager):
+    """PortManager counting the control commands it handles"""
+
+    def __init__(self, serial_port, connection, metrics, logger=None):
+        self.metrics = metrics
+        super().__init__(serial_port, connection, logger)
+
+    def _telnet_negotiate_option(self, command, option):
+        self.metrics.local().control_commands += 1
+        super()._telnet_negotiate_option(command, option)
+
+    def _telnet_process_subnegotiation(self, suboption):
+        self.metrics.local().control_commands += 1
+        super()._telnet_process_subnegotiation(suboption)
+
+
+class SettingsFilter(object):
+    """The serial port as the PortManager sees it. pyserial reconfigures the
+       tty on every assignment, settings the port already has are skipped"""
+
+    SETTINGS = ("baudrate", "bytesize", "parity", "stopbits", "xonxoff", "rtscts", "dtr", "rts",
+                "break_condition")
+
+    def __init__(self, serial_instance, metrics):
+        object.__setattr__(self, "serial", serial_instance)
+        object.__setattr__(self, "metrics", metrics)
+
+    def __getattr__(self, name):
+        return getattr(self.serial, name)
+
+    def __setattr__(self, name, value):
+        if name in self.SETTINGS:
+            if getattr(self.serial, name) == value:
+                self.metrics.local().serial_settings_skipped += 1
+                return
+            self.metrics.local().serial_settings_applied += 1
+        setattr(self.serial, name, value)
+
 
 class Redirector(object):
-    def __init__(self, serial_instance, socket, debug=False):
+    RECEIVE_BUFFER_SIZE = 16384
+
+    def __init__(self, serial_instance, socket, debug=False, poll_modem_lines=True, coalescing_policy=None,
+                 receive_buffer_size=RECEIVE_BUFFER_SIZE, metrics=None, read_serial=True,
+                 backpressure_policy=None):
         self.serial = serial_instance
+        self.read_serial = read_serial
         self.socket = socket
+        self.poll_modem_lines = poll_modem_lines
+        self.metrics = metrics if metrics else DeviceMetrics()
+        self.coalescing = coalescing_policy if coalescing_policy else CoalescingPolicy()
+        self.send_buffer = SendBuffer(backpressure_policy if backpressure_policy else BackpressurePolicy(),
+                                      self.metrics)
+        self._rx_buffer = bytearray(receive_buffer_size)
+        self._rx_view = memoryview(self._rx_buffer)
+        self.thread_read = None
+        self.thread_write = None
+        self.thread_send = None
+        self.thread_poll = None
+        self.alive = True
         self.socket.settimeout(1.0)
         self._write_lock = threading.Lock()
-        self.rfc2217 = serial.rfc2217.PortManager(
-            self.serial,
+        self._send_condition = threading.Condition(self._write_lock)
+        self.rfc2217 = MeteredPortManager(
+            SettingsFilter(self.serial, self.metrics),
             self,
+            self.metrics,
             logger=logging.getLogger('rfc2217.server') if debug else None)
         self.log = logging.getLogger('redirector')
 
@@ -40,25 +106,38 @@ class Redirector(object):
     def shortcircuit(self):
         """connect the serial port to the TCP port by copying everything
            from one side to the other"""
-        self.alive = True
-        self.thread_read = threading.Thread(target=self.reader)
-        self.thread_read.daemon = True
-        self.thread_read.name = 'serial->socket'
-        self.thread_read.start()
-        self.thread_poll = threading.Thread(target=self.statusline_poller)
-        self.thread_poll.daemon = True
-        self.thread_poll.name = 'status line poll'
-        self.thread_poll.start()
+        self.thread_write = threading.current_thread()
+        if self.read_serial:
+            self.thread_read = threading.Thread(target=self.reader)
+            self.thread_read.daemon = True
+            self.thread_read.name = 'serial->socket'
+            self.thread_read.start()
+        if self.poll_modem_lines:
+            self.thread_poll = threading.Thread(target=self.statusline_poller)
+            self.thread_poll.daemon = True
+            self.thread_poll.name = 'status line poll'
+            self.thread_poll.start()
         self.writer()
 
     def reader(self):
         """loop forever and copy serial->socket"""
+        counters = self.metrics.local()
         while self.alive:
             try:
                 data = self.serial.read(self.serial.in_waiting or 1)
-                if data:
-                    # escape outgoing data when needed (Telnet IAC (0xff) character)
-                    self.write(b''.join(self.rfc2217.escape(data)))
+                counters.serial_reads += 1
+                if not data:
+                    continue
+                self.coalescing.note_read()
+                if self.coalescing.should_batch():
+                    self.coalesce(data, counters)
+                else:
+                    self.handle_serial_data(data, counters)
+            except serial.SerialException as msg:
+                self.log.error('Serial port error: {}'.format(msg))
+                # probably unplugged, let the writer see the end of the session
+                self.__shutdown_socket()
+                break
             except socket.error as msg:
                 self.log.error('{}'.format(msg))
                 # probably got disconnected
@@ -66,19 +145,161 @@ class Redirector(object):
         self.alive = False
         self.log.debug('reader thread terminated')
 
+    def coalesce(self, data, counters=None):
+        """keep reading the serial port until the coalescing window closes.
+           With TCP_CORK the chunks are handed to the kernel as they arrive
+           and the socket is uncorked at the end of the window, otherwise
+           they are joined and sent at once"""
+        policy = self.coalescing
+        # unix sockets have no cork
+        cork = policy.tcp_cork and self.socket.family != socket.AF_UNIX
+        deadline = time.monotonic() + policy.max_delay
+        if cork:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+            self.handle_serial_data(data, counters)
+        else:
+            buffer = bytearray(data)
+        size = len(data)
+        if counters is None:
+            counters = self.metrics.local()
+        try:
+            while size < policy.max_bytes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if not self.serial.in_waiting:
+                    select.select([self.serial.fileno()], [], [], remaining)
+                    continue
+                data = self.serial.read(min(self.serial.in_waiting, policy.max_bytes - size))
+                counters.serial_reads += 1
+                policy.note_read()
+                size += len(data)
+                if cork:
+                    self.handle_serial_data(data, counters)
+                else:
+                    buffer += data
+        finally:
+            if cork:
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+        if not cork:
+            self.handle_serial_data(bytes(buffer), counters)
+
+    def handle_serial_data(self, data, counters=None):
+        """forward data read from the serial port to the socket"""
+        # escape outgoing data when needed (Telnet IAC (0xff) character)
+        self.send_serial_data(rfc2217_codec.escape(data), len(data), counters)
+
+    def send_serial_data(self, escaped, length, counters=None):
+        """send serial data already escaped, length is its size before
+           escaping. counters are those of the calling thread, loops pass
+           them to save the lookup on every chunk"""
+        if counters is None:
+            counters = self.metrics.local()
+        counters.serial_to_socket_bytes += length
+        counters.serial_to_socket_chunks += 1
+        self.queue(escaped, length)
+
+    def receive(self):
+        """receive from the socket into the preallocated buffer. Data that
+           arrived while the serial port was draining the previous write is
+           coalesced into the same buffer. Returns the number of bytes received"""
+        received = self.socket.recv_into(self._rx_buffer)
+        while received and received < len(self._rx_buffer):
+            if not select.select([self.socket], [], [], 0)[0]:
+                break
+            try:
+                count = self.socket.recv_into(self._rx_view[received:])
+            except (BlockingIOError, InterruptedError):
+                break
+            if not count:
+                # end of stream, reported by the next receive
+                break
+            received += count
+        return received
+
+    def handle_socket_data(self, length, counters=None):
+        """forward the first length bytes of the receive buffer to the serial port"""
+        if counters is None:
+            counters = self.metrics.local()
+        counters.socket_to_serial_bytes += length
+        counters.socket_to_serial_chunks += 1
+        data = rfc2217_codec.filter_buffer(self.rfc2217, self._rx_buffer, length)
+        if len(data):
+            counters.serial_writes += 1
+            self.serial.write(data)
+
     def write(self, data):
         """thread safe socket write with no data escaping. used to send telnet stuff"""
-        with self._write_lock:
-            self.socket.sendall(data)
+        self.queue(data)
+
+    def queue(self, data, length=None):
+        """send data right away if the socket takes it, what is left waits in
+           the send buffer for the sender thread. length is the number of
+           serial bytes in data, serial data is subject to the backpressure
+           policy, telnet replies (None) are not"""
+        with self._send_condition:
+            if not self.send_buffer:
+                try:
+                    # sockets with a timeout are non-blocking underneath,
+                    # socket.send would wait for the timeout first
+                    sent = os.write(self.socket.fileno(), data)
+                except (BlockingIOError, InterruptedError):
+                    sent = 0
+                if sent == len(data):
+                    return
+                self.metrics.local().socket_send_stalls += 1
+                if sent:
+                    # the client got part of it, the rest can't be dropped
+                    data = memoryview(data)[sent:]
+                    length = None
+            if not self.send_buffer.append(data, length):
+                self.log.warning('Client too slow, {} bytes waiting, disconnecting'.format(
+                    self.send_buffer.policy.high_water))
+                self.__shutdown_socket()
+                raise ConnectionAbortedError('send buffer overflow')
+            if not self.thread_send:
+                self.thread_send = threading.Thread(target=self.sender)
+                self.thread_send.daemon = True
+                self.thread_send.name = 'buffer->socket'
+                self.thread_send.start()
+            self._send_condition.notify_all()
+            if length is not None:
+                # block policy, the serial reader waits for the client
+                while self.alive and self.send_buffer.is_full():
+                    self._send_condition.wait()
+
+    def sender(self):
+        """loop forever and copy the send buffer to the socket, started the
+           first time the socket doesn't take everything at once"""
+        while True:
+            with self._send_condition:
+                while self.alive and not self.send_buffer:
+                    self._send_condition.wait()
+                if not self.alive:
+                    break
+                data = self.send_buffer.peek()
+            try:
+                sent = self.socket.send(data)
+            except socket.timeout:
+                continue
+            except socket.error as msg:
+                self.log.error('Sender error: {}'.format(msg))
+                self.__shutdown_socket()
+                break
+            with self._send_condition:
+                self.send_buffer.consume(sent)
+                self._send_condition.notify_all()
+        self.log.debug('sender thread terminated')
 
     def writer(self):
         """loop forever and copy socket->serial"""
+        counters = self.metrics.local()
         while self.alive:
             try:
-                data = self.socket.recv(1024)
-                if not data:
+                received = self.receive()
+                if not received:
                     break
-                self.serial.write(b''.join(self.rfc2217.filter(data)))
+                self.handle_socket_data(received, counters)
             except socket.timeout:
                 pass
             except socket.error as msg:
@@ -90,7 +311,37 @@ class Redirector(object):
     def stop(self):
         """Stop copying"""
         self.log.debug('stopping')
+        # wake up the threads blocked on the serial port and the socket
+        # instead of waiting for their timeouts
+        if threading.current_thread() is not self.thread_write:
+            self.__shutdown_socket()
         if self.alive:
-            self.alive = False
-            self.thread_read.join()
-            self.thread_poll.join()
\ No newline at end of file
+            with self._send_condition:
+                self.alive = False
+                self._send_condition.notify_all()
+            if self.thread_send and threading.current_thread() is not self.thread_send:
+                # a send blocked on a client that stopped reading fails right away
+                try:
+                    self.socket.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+                self.thread_send.join()
+            if self.read_serial:
+                self.__cancel_read()
+            if self.thread_read:
+                self.thread_read.join()
+            if self.thread_poll:
+                self.thread_poll.join()
+
+    def __cancel_read(self):
+        try:
+            self.serial.cancel_read()
+        except (AttributeError, NotImplementedError, OSError, serial.SerialException):
+            # not every port type can cancel, the reader exits on its read timeout
+            pass
+
+    def __shutdown_socket(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
\ No newline at end of file
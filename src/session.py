@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+import collections
+import logging
+import socket
+import threading
+import time
+
+import serial
+
+logger = logging.getLogger(__name__)
+
+
+class SessionPolicy(object):
+    """Keeps a device's serial data across client reconnections.
+
+       replay_buffer_size: serial bytes kept while no client is connected
+       replay_max_age: seconds after which kept data is not replayed anymore
+       dead_peer_timeout: seconds before a client that vanished without
+                          closing its connection is dropped, 0 leaves it to TCP
+       takeover: a new client replaces the connected one instead of waiting
+    """
+
+    def __init__(self, replay_buffer_size=65536, replay_max_age=30, dead_peer_timeout=10, takeover=True):
+        self.replay_buffer_size = replay_buffer_size
+        self.replay_max_age = replay_max_age
+        self.dead_peer_timeout = dead_peer_timeout
+        self.takeover = takeover
+
+
+def set_dead_peer_timeout(client_socket, timeout):
+    """keepalive probes on an idle connection and a limit on unacknowledged
+       data, so a peer that is gone is noticed after about timeout seconds"""
+    if not timeout or client_socket.family == socket.AF_UNIX:
+        return
+    interval = max(1, int(timeout) // 6)
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(timeout) - 3 * interval))
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, int(timeout * 1000))
+
+
+class ReplayBuffer(object):
+    """Serial data read while no client is connected. The oldest data is
+       dropped beyond size bytes, data older than max_age isn't replayed"""
+
+    def __init__(self, size, max_age, metrics):
+        self.size = size
+        self.max_age = max_age
+        self.metrics = metrics
+        self.chunks = collections.deque()
+        self.length = 0
+        self._lock = threading.Lock()
+
+    def append(self, data):
+        with self._lock:
+            self.chunks.append((time.monotonic(), data))
+            self.length += len(data)
+            while self.length > self.size:
+                stamp, oldest = self.chunks.popleft()
+                self.length -= len(oldest)
+                self.metrics.local().session_dropped_bytes += len(oldest)
+
+    def take(self):
+        """empty the buffer, returns the data recent enough to be replayed"""
+        with self._lock:
+            chunks, self.chunks = self.chunks, collections.deque()
+            self.length = 0
+        oldest = time.monotonic() - self.max_age
+        fresh = []
+        for stamp, data in chunks:
+            if stamp < oldest:
+                self.metrics.local().session_dropped_bytes += len(data)
+            else:
+                fresh.append(data)
+                self.metrics.local().session_replayed_bytes += len(data)
+        return fresh
+
+
+class SerialHolder(object):
+    """Reads the serial port into a ReplayBuffer while no client is connected"""
+
+    def __init__(self, serial_instance, replay_buffer):
+        self.serial = serial_instance
+        self.replay_buffer = replay_buffer
+        self.alive = False
+        self.thread = None
+
+    def start(self):
+        self.alive = True
+        self.thread = threading.Thread(target=self.__read)
+        self.thread.daemon = True
+        self.thread.name = 'serial->replay buffer'
+        self.thread.start()
+
+    def stop(self):
+        """stop reading, what isn't read yet stays in the serial port"""
+        if not self.alive:
+            return
+        self.alive = False
+        try:
+            self.serial.cancel_read()
+        except (AttributeError, NotImplementedError, OSError, serial.SerialException):
+            pass
+        self.thread.join()
+
+    def __read(self):
+        while self.alive:
+            try:
+                data = self.serial.read(self.serial.in_waiting or 1)
+            except serial.SerialException as e:
+                logger.error("Serial port error: {}".format(e))
+                break
+            if data:
+                self.replay_buffer.append(data)
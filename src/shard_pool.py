@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+#
+# devices spread over worker processes, so a busy device only competes for
+# the GIL with the devices of its own shard. The parent keeps the serial
+# port and the listening sockets open and passes their descriptors to the
+# worker, a crashed worker is restarted with the same ones and clients queue
+# on the sockets meanwhile
+
+import collections
+import logging
+import multiprocessing
+import os
+import pickle
+import socket
+import threading
+import time
+
+from metrics import DeviceMetrics
+from rfc2217_device import RFC2217Device
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_SIZE = 65536
+
+
+def send_message(control, message, fds=()):
+    socket.send_fds(control, [pickle.dumps(message)], list(fds))
+
+
+def receive_message(control):
+    """returns the message and the file descriptors passed with it, None once the peer is gone"""
+    data, fds, flags, address = socket.recv_fds(control, MAX_MESSAGE_SIZE, 2)
+    if not data:
+        return None, []
+    return pickle.loads(data), fds
+
+
+class ShardedDevice(RFC2217Device):
+    """RFC2217Device whose data path runs in a worker of a ShardPool. The
+       port is opened here for the probes and stays open, so the tty keeps
+       its buffered data and line state when a worker crashes. The worker
+       serves it on this same handle"""
+
+    def __init__(self, shard_pool, device_path, tcp_port, engine=None, *args, **kwargs):
+        # the worker runs the device on the pool's engine
+        super().__init__(device_path, tcp_port, None, *args, **kwargs)
+        self.shard_pool = shard_pool
+        self.device_id = None
+        # written by the shard's receiver only
+        self.worker_counters = self.metrics.add_counters()
+
+    def get_worker_config(self):
+        """arguments of the RFC2217Device created by the worker. The latency
+           profile isn't among them: it belongs to the tty, which the worker
+           shares, so it is applied here only and restored when stopped"""
+        return {
+            "device_path": self.device_path,
+            "tcp_port": self.tcp_port,
+            "coalescing_policy": self.coalescing_policy,
+            "receive_buffer_size": self.receive_buffer_size,
+            "max_subscribers": self.max_subscribers,
+            "subscriber_queue_size": self.subscriber_queue_size,
+            "backpressure_policy": self.backpressure_policy,
+            "raw_settings": self.raw_settings,
+            "unix_path": self.unix_path,
+            "session_policy": self.session_policy,
+            "warm_sessions": self.warm_sessions,
+        }
+
+    def get_serial_settings(self):
+        """settings and lines of the port, for the worker's wrap_serial_port()"""
+        return dict(self.s_port.get_settings(), dtr=self.s_port.dtr, rts=self.s_port.rts)
+
+    def start(self):
+        if self.port_broker:
+            self.port_broker.hand_over()
+        self.started = True
+        self.shard_pool.add(self)
+
+    def stop(self):
+        self.shard_pool.remove(self)
+        super().stop()
+
+    def update_metrics(self, counters):
+        """counters of the worker's device, added to those of previous workers"""
+        for name, description in DeviceMetrics.COUNTERS:
+            setattr(self.worker_counters, name, counters.get(name, 0))
+        self.metrics.connected = counters.get("connected", 0)
+
+    def rebase_metrics(self):
+        """the worker is gone, what it counted is kept and a new one counts from zero"""
+        self.worker_counters = self.metrics.add_counters()
+        self.metrics.connected = 0
+
+
+class Shard(object):
+    """One worker process and the devices it runs, restarted when it dies"""
+
+    def __init__(self, index, pool):
+        self.index = index
+        self.pool = pool
+        self.devices = {}
+        self.process = None
+        self.control = None
+        self.alive = False
+        self.thread = None
+        self.pending = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.alive = True
+        self.__spawn()
+        self.thread = threading.Thread(target=self.__receive)
+        self.thread.daemon = True
+        self.thread.name = 'shard {}'.format(self.index)
+        self.thread.start()
+
+    def stop(self):
+        self.alive = False
+        with self._lock:
+            try:
+                send_message(self.control, ("stop",))
+            except OSError:
+                pass
+        self.process.join(self.pool.REQUEST_TIMEOUT)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        # the receiver sees the end of the control socket once the worker is gone
+        self.thread.join()
+        self.control.close()
+
+    def add(self, device):
+        with self._lock:
+            self.devices[device.device_id] = device
+        listening_sockets = (device.s_socket, device.u_socket)
+        # the worker gets the port's descriptor first, then those of the sockets
+        error = self.__request(("add", device.device_id, device.get_worker_config(), device.get_serial_settings(),
+                                [bool(sock) for sock in listening_sockets]),
+                               [device.s_port.fileno()] + [sock.fileno() for sock in listening_sockets if sock])
+        if error:
+            with self._lock:
+                self.devices.pop(device.device_id, None)
+            raise Exception("Shard {} could not start '{}': {}".format(self.index, device.device_path, error))
+
+    def remove(self, device):
+        with self._lock:
+            if self.devices.pop(device.device_id, None) is None:
+                return
+        error = self.__request(("remove", device.device_id))
+        if error:
+            logger.warning("Shard {} could not stop '{}': {}".format(self.index, device.device_path, error))
+
+    def __request(self, message, fds=()):
+        """send a command and wait for the worker's answer, None when it went fine"""
+        done = threading.Event()
+        with self._lock:
+            self.requests += 1
+            request = self.requests
+            result = self.pending[request] = {"done": done}
+            try:
+                send_message(self.control, (message[0], request) + message[1:], fds)
+            except OSError as e:
+                self.pending.pop(request)
+                return "{}".format(e)
+        if not done.wait(self.pool.REQUEST_TIMEOUT):
+            with self._lock:
+                self.pending.pop(request, None)
+            return "no answer in {} s".format(self.pool.REQUEST_TIMEOUT)
+        return result.get("error")
+
+    def __spawn(self):
+        self.control, worker_control = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        context = multiprocessing.get_context("spawn")
+        self.process = context.Process(target=run_worker,
+                                       args=(worker_control, self.pool.io_engine, self.pool.device_class))
+        self.process.daemon = True
+        self.process.name = 'shard {}'.format(self.index)
+        self.process.start()
+        worker_control.close()
+
+    def __receive(self):
+        while self.alive:
+            try:
+                message, fds = receive_message(self.control)
+            except OSError:
+                message = None
+            if message is None:
+                if not self.alive:
+                    break
+                self.__restart()
+                continue
+            if message[0] == "stats":
+                with self._lock:
+                    devices = dict(self.devices)
+                for device_id, counters in message[1].items():
+                    if device_id in devices:
+                        devices[device_id].update_metrics(counters)
+            elif message[0] == "done":
+                with self._lock:
+                    result = self.pending.pop(message[1], None)
+                if result:
+                    result["error"] = message[2]
+                    result["done"].set()
+
+    def __restart(self):
+        self.process.join(self.pool.REQUEST_TIMEOUT)
+        logger.error("Shard {} worker died (exit code {}), restarting it".format(self.index, self.process.exitcode))
+        self.pool.count_restart()
+        with self._lock:
+            for result in self.pending.values():
+                result["error"] = "worker died"
+                result["done"].set()
+            self.pending = {}
+            devices = list(self.devices.values())
+        self.control.close()
+        time.sleep(self.pool.RESTART_DELAY)
+        if not self.alive:
+            return
+        self.__spawn()
+        for device in devices:
+            device.rebase_metrics()
+            # the answer is read by this thread, the request can't wait here
+            thread = threading.Thread(target=self.__readd, args=(device,))
+            thread.daemon = True
+            thread.name = 'shard {} restart'.format(self.index)
+            thread.start()
+
+    def __readd(self, device):
+        with self._lock:
+            if device.device_id not in self.devices:
+                return
+        try:
+            self.add(device)
+        except Exception as e:
+            logger.error("{}".format(e))
+
+
+class ShardPool(object):
+    """Fixed set of worker processes running the RFC2217Device stack of
+       the devices assigned to them, each device goes to the shard with the
+       fewest devices"""
+
+    REQUEST_TIMEOUT = 10
+    RESTART_DELAY = 1
+    STATS_INTERVAL = 1
+
+    def __init__(self, workers, io_engine="threaded", device_class=RFC2217Device):
+        if workers < 1:
+            raise Exception("A shard pool needs at least one worker, not {}".format(workers))
+        self.io_engine = io_engine
+        self.device_class = device_class
+        self.shards = [Shard(i, self) for i in range(workers)]
+        self.assignments = {}
+        self.devices = 0
+        self.restarts = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+
+    def stop(self):
+        for shard in self.shards:
+            shard.stop()
+
+    def add(self, device):
+        with self._lock:
+            self.devices += 1
+            device.device_id = self.devices
+            # the shards learn about their devices later, concurrent adds go by the assignments
+            load = collections.Counter(self.assignments.values())
+            shard = min(self.shards, key=lambda s: load[s])
+            self.assignments[device.device_id] = shard
+        logger.info("Device '{}' runs in shard {}".format(device.device_path, shard.index))
+        try:
+            shard.add(device)
+        except Exception:
+            with self._lock:
+                self.assignments.pop(device.device_id, None)
+            raise
+
+    def remove(self, device):
+        with self._lock:
+            shard = self.assignments.pop(device.device_id, None)
+        if shard:
+            shard.remove(device)
+
+    def count_restart(self):
+        """called by the receivers of the shards"""
+        with self._lock:
+            self.restarts += 1
+
+    def get_worker_pids(self):
+        return [shard.process.pid for shard in self.shards]
+
+
+class ShardWorker(object):
+    """Runs in a worker process: serves the devices the parent adds until
+       the parent says stop or goes away"""
+
+    def __init__(self, control, io_engine, device_class):
+        self.control = control
+        self.io_engine = io_engine
+        self.device_class = device_class
+        self.engine = None
+        self.devices = {}
+        self.alive = True
+        self._send_lock = threading.Lock()
+
+    def run(self):
+        if self.io_engine == "eventloop":
+            from io_engine import IOEngine
+            self.engine = IOEngine()
+            self.engine.start()
+        stats_thread = threading.Thread(target=self.__send_stats)
+        stats_thread.daemon = True
+        stats_thread.name = 'shard stats'
+        stats_thread.start()
+        while self.alive:
+            try:
+                message, fds = receive_message(self.control)
+            except OSError:
+                message = None
+            if message is None or message[0] == "stop":
+                break
+            command, request, device_id = message[:3]
+            # the worker owns the passed descriptors from here on, the serial
+            # port's comes first
+            serial_fd = fds.pop(0) if command == "add" else None
+            listening_sockets = [socket.socket(fileno=fd) for fd in fds]
+            error = None
+            try:
+                if command == "add":
+                    self.__add(device_id, message[3], message[4], message[5], serial_fd, listening_sockets)
+                elif command == "remove":
+                    self.__remove(device_id)
+            except Exception as e:
+                error = "{}".format(e)
+                for listening_socket in listening_sockets:
+                    listening_socket.close()
+            self.__send(("done", request, error))
+        self.alive = False
+        for device_id in list(self.devices):
+            self.__remove(device_id)
+        if self.engine:
+            self.engine.stop()
+
+    def __add(self, device_id, config, serial_settings, has_sockets, serial_fd, listening_sockets):
+        listening_sockets = iter(listening_sockets)
+        tcp_socket = next(listening_sockets) if has_sockets[0] else None
+        unix_socket = next(listening_sockets) if has_sockets[1] else None
+        try:
+            device = self.device_class(engine=self.engine, do_not_open=True, **config)
+            # the parent's handle, reopening the tty would compete with it
+            s_port = device.wrap_serial_port(serial_fd, serial_settings)
+        except Exception:
+            os.close(serial_fd)
+            raise
+        try:
+            device.open_serial_port(s_port)
+            device.set_listening_sockets(tcp_socket, unix_socket)
+            device.start()
+        except Exception:
+            device.stop()
+            raise
+        self.devices[device_id] = device
+
+    def __remove(self, device_id):
+        device = self.devices.pop(device_id, None)
+        if device:
+            device.stop()
+
+    def __send(self, message):
+        with self._send_lock:
+            send_message(self.control, message)
+
+    def __send_stats(self):
+        while self.alive:
+            time.sleep(ShardPool.STATS_INTERVAL)
+            stats = {}
+            for device_id, device in list(self.devices.items()):
+                counters = device.metrics.totals()
+                counters["connected"] = device.metrics.connected
+                stats[device_id] = counters
+            try:
+                self.__send(("stats", stats))
+            except OSError:
+                break
+
+
+def run_worker(control, io_engine, device_class):
+    logging.basicConfig(format='%(asctime)s %(levelname)-6s - %(name)-16s - %(message)s', level=logging.INFO)
+    ShardWorker(control, io_engine, device_class).run()
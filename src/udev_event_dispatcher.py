@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class UdevEventDispatcher(object):
+    """Queues udev add and remove events and applies them on worker threads
+       once the device has been quiet for settle_time. The events received
+       meanwhile are reduced to their net effect: add then remove cancel out,
+       several adds or removes count once and remove then add replaces the
+       device. Events of one device are applied in order, one batch at a time"""
+
+    ADD = "add"
+    REMOVE = "remove"
+
+    def __init__(self, on_add, on_remove, settle_time=0.5, workers=2):
+        self.on_add = on_add
+        self.on_remove = on_remove
+        self.settle_time = settle_time
+        self.pending = {}
+        self.running = set()
+        self.received = 0
+        self.applied = 0
+        self.thread = None
+        self.alive = None
+        self._condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='udev worker')
+
+    def start(self):
+        self.alive = True
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.name = 'udev dispatcher'
+        self.thread.start()
+
+    def stop(self):
+        """stop dispatching, events not applied yet are dropped"""
+        with self._condition:
+            self.alive = False
+            self._condition.notify()
+        if self.thread:
+            self.thread.join()
+        self.executor.shutdown(wait=True)
+        logger.debug("udev dispatcher stopped, {} events received, {} applied".format(self.received, self.applied))
+
+    def post(self, action, device):
+        if action not in (self.ADD, self.REMOVE):
+            return
+        key = device.get("DEVNAME")
+        with self._condition:
+            self.received += 1
+            entry = self.pending.get(key)
+            if entry is None:
+                entry = self.pending[key] = {"first": action}
+            entry["last"] = action
+            entry["device"] = device
+            entry["due"] = time.monotonic() + self.settle_time
+            self._condition.notify()
+
+    @classmethod
+    def reduce(cls, first, last):
+        """net actions of a sequence of events starting and ending with those"""
+        if first == cls.ADD:
+            return [cls.ADD] if last == cls.ADD else []
+        return [cls.REMOVE, cls.ADD] if last == cls.ADD else [cls.REMOVE]
+
+    def __run(self):
+        with self._condition:
+            while self.alive:
+                now = time.monotonic()
+                timeout = None
+                for key, entry in list(self.pending.items()):
+                    if key in self.running:
+                        continue
+                    if entry["due"] > now:
+                        timeout = min(timeout, entry["due"] - now) if timeout is not None else entry["due"] - now
+                        continue
+                    del self.pending[key]
+                    self.running.add(key)
+                    self.executor.submit(self.__apply, key, entry)
+                self._condition.wait(timeout)
+
+    def __apply(self, key, entry):
+        actions = self.reduce(entry["first"], entry["last"])
+        if not actions:
+            logger.debug("Events of '{}' cancel out".format(key))
+        for action in actions:
+            try:
+                if action == self.ADD:
+                    self.on_add(entry["device"])
+                else:
+                    self.on_remove(entry["device"])
+            except Exception:
+                logger.exception("Error handling udev '{}' event of '{}'".format(action, key))
+        with self._condition:
+            self.applied += len(actions)
+            self.running.discard(key)
+            self._condition.notify()
@@ -1,100 +1,400 @@
 #!/usr/bin/env python3
 
-import hashlib
+import functools
 import logging
+import select
+import threading
+import time
 import gateway_devices
 
-from mdns_advertiser import MDNSAdvertiser
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from device_matcher import DeviceMatcher
+from latency_tuning import SYSFS_ROOT
+from metrics import DeviceMetrics
 from rfc2217_device import RFC2217Device
 
 logger = logging.getLogger(__name__)
 
 
+class BringUpTimeout(Exception):
+    pass
+
+
+class BringUpCancelled(Exception):
+    pass
+
+
+CANCEL_CHECK_INTERVAL = 0.1
+
+
+def run_phase(name, timeout, function, *args, cancelled=None, release=None):
+    """run function in its own thread and give up after timeout seconds, or
+       as soon as the cancelled event is set. The thread is abandoned then,
+       blocking calls can't be cancelled: release is called with what an
+       abandoned function returns once it completes, e.g. to close a port
+       nobody will use"""
+    result = {}
+    lock = threading.Lock()
+
+    def target():
+        try:
+            value = function(*args)
+        except Exception as e:
+            result["error"] = e
+            return
+        with lock:
+            if not result.get("abandoned"):
+                result["value"] = value
+                return
+        logger.warning("'{}' completed after it was given up".format(name))
+        release_result(value)
+
+    def release_result(value):
+        if release is None or value is None:
+            return
+        try:
+            release(value)
+        except Exception as e:
+            logger.warning("Can't release the result of '{}': {}".format(name, e))
+
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.name = name
+    thread.start()
+    deadline = time.monotonic() + timeout
+    try:
+        while thread.is_alive() and time.monotonic() < deadline:
+            if cancelled is not None and cancelled.is_set():
+                raise BringUpCancelled("'{}' cancelled".format(name))
+            thread.join(min(CANCEL_CHECK_INTERVAL, max(0, deadline - time.monotonic())))
+        if thread.is_alive():
+            raise BringUpTimeout("'{}' did not complete in {} s".format(name, timeout))
+    except (BringUpCancelled, BringUpTimeout):
+        with lock:
+            result["abandoned"] = True
+            # completed while giving up
+            value = result.pop("value", None)
+        release_result(value)
+        raise
+    if "error" in result:
+        raise result["error"]
+    return result.get("value")
+
+
+def close_sockets(sockets):
+    for sock in sockets:
+        if sock:
+            sock.close()
+
+
 class UsbDevicesHandler(object):
-    def __init__(self, network_interface):
+
+    THREADED_ENGINE = "threaded"
+    EVENT_LOOP_ENGINE = "eventloop"
+    BRING_UP_WORKERS = 4
+    SHUTDOWN_TIMEOUT = 5
+
+    def __init__(self, network_interface, io_engine=THREADED_ENGINE, metrics_registry=None, metadata_cache=None,
+                 sysfs_root=SYSFS_ROOT, shards=0):
         self.network_interface = network_interface
-        self.valid_gateways = gateway_devices.__all__
+        self.sysfs_root = sysfs_root
+        self.metrics_registry = metrics_registry
+        self.metadata_cache = metadata_cache
+        self.matcher = DeviceMatcher(gateway_devices.load_device_definitions())
         self.handled_devices = {}
+        self.tear_downs = {}
+        self._lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=self.BRING_UP_WORKERS, thread_name_prefix='bring up')
+        self.mdns_service = None
+        self.address_monitor = None
+        self.io_engine = None
+        self.shard_pool = None
+        if io_engine not in (self.THREADED_ENGINE, self.EVENT_LOOP_ENGINE):
+            raise Exception("Unknown IO engine '{}'".format(io_engine))
+        if shards:
+            # the devices run in the workers, on their own IO engines
+            from shard_pool import ShardPool
+            self.shard_pool = ShardPool(shards, io_engine)
+            self.shard_pool.start()
+        elif io_engine == self.EVENT_LOOP_ENGINE:
+            from io_engine import IOEngine
+            self.io_engine = IOEngine()
+            self.io_engine.start()
 
     def is_valid_device(self, device):
-        device_identifier = self.__get_device_identifier(device)
-        if device_identifier in self.valid_gateways:
-            return True
-        return False
+        return self.matcher.match(device) is not None
 
     def create_usb_device(self, device):
         ident = device.get("DEVNAME")
-        if ident in self.handled_devices:
-            logger.warn("Device at '{}' already handled".format(ident))
-            return
-
-        constructor = self.__get_gateway_constructor(device)
+        constructor = self.matcher.match(device)
         if not constructor:
             return
-        gateway_device = constructor(device)
-
-        usb_device = UsbDevice(gateway_device, self.network_interface)
-        usb_device.start()
-
-        self.handled_devices[usb_device.get_serial_port()] = usb_device
+        try:
+            gateway_device = constructor(device)
+        except Exception as e:
+            logger.error("Device at '{}' could not be created: {}".format(ident, e))
+            return
 
+        with self._lock:
+            if ident in self.handled_devices:
+                logger.warn("Device at '{}' already handled".format(ident))
+                return
+            self.__start_advertising_services()
+            usb_device = UsbDevice(gateway_device, self.network_interface, self.io_engine, self.metrics_registry,
+                                   self.metadata_cache, self.mdns_service, self.address_monitor, self.sysfs_root,
+                                   self.shard_pool)
+            self.handled_devices[ident] = usb_device
+            # a device replugged at the same node reuses its serial and TCP ports
+            previous_tear_down = self.tear_downs.pop(ident, None)
+            usb_device.start_future = self.executor.submit(self.__bring_up, usb_device, previous_tear_down)
 
     def delete_usb_device(self, device):
         ident = device.get("DEVNAME")
 
-        device = self.handled_devices.get(ident, None)
+        with self._lock:
+            device = self.handled_devices.pop(ident, None)
         if not device:
             logger.warn("Device at '{}' not handled".format(ident))
             return
 
-        device.stop()
-        del self.handled_devices[ident]
+        with self._lock:
+            if device.start_future.cancel():
+                logger.debug("Bring-up of '{}' cancelled".format(ident))
+                return
+            self.tear_downs[ident] = self.executor.submit(self.__tear_down, device)
 
-    def stop_all_devices(self):
-        for device in self.handled_devices.values():
-            device.stop()
+    def stop_all_devices(self, timeout=SHUTDOWN_TIMEOUT):
+        """stop every device concurrently, giving up on those still stopping
+           after timeout seconds"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            devices = list(self.handled_devices.values())
+            self.handled_devices = {}
+            tear_downs = list(self.tear_downs.values())
+            self.tear_downs = {}
+        threads = []
+        for device in devices:
+            if device.start_future.cancel():
+                continue
+            thread = threading.Thread(target=self.__tear_down, args=(device,))
+            thread.daemon = True
+            thread.name = 'tear down'
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        _, not_done = wait(tear_downs, max(0, deadline - time.monotonic()))
+        stuck = len(not_done) + len([thread for thread in threads if thread.is_alive()])
+        if stuck:
+            logger.warning("{} devices still stopping after {} s, giving up on them".format(stuck, timeout))
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.mdns_service:
+            self.address_monitor.stop()
+            self.mdns_service.stop()
+        if self.io_engine:
+            self.io_engine.stop()
+        if self.shard_pool:
+            self.shard_pool.stop()
 
-        self.handled_devices = {}
+    def __start_advertising_services(self):
+        # zeroconf and netifaces are only imported once there is something to advertise
+        if self.mdns_service:
+            return
+        from address_monitor import AddressMonitor
+        from mdns_service import MDNSService
+        self.mdns_service = MDNSService()
+        self.mdns_service.start()
+        self.address_monitor = AddressMonitor()
+        self.address_monitor.start()
 
-    def __get_device_identifier(self, device):
-        id_model = device.get("ID_MODEL_ID")
-        id_vendor = device.get("ID_VENDOR_ID")
-        enc_vendor = device.get("ID_VENDOR_ENC")
-        if not id_model or not id_vendor or not enc_vendor:
-            return None
-        identifier_string = id_model + id_vendor + enc_vendor
-        return hashlib.sha224(identifier_string.encode('utf-8')).hexdigest()
+    def __bring_up(self, usb_device, previous_tear_down=None):
+        if previous_tear_down:
+            wait([previous_tear_down])
+        try:
+            usb_device.start()
+        except BringUpCancelled as e:
+            logger.debug("Bring-up of '{}' stopped: {}".format(usb_device.get_serial_port(), e))
+            usb_device.stop()
+        except Exception as e:
+            logger.error("Device '{}' ('{}') could not be started: {}".format(
+                usb_device.gateway_device.get_name(), usb_device.get_serial_port(), e))
+            usb_device.stop()
+            with self._lock:
+                if self.handled_devices.get(usb_device.get_serial_port()) is usb_device:
+                    del self.handled_devices[usb_device.get_serial_port()]
 
-    def __get_gateway_constructor(self, device):
-        device_identifier = self.__get_device_identifier(device)
-        if not device_identifier:
-            return None
-        return self.valid_gateways.get(device_identifier, None)
+    def __tear_down(self, usb_device):
+        # a running bring-up gives up at its next cancellation check
+        usb_device.cancel()
+        wait([usb_device.start_future])
+        usb_device.stop()
 
 
 class UsbDevice(object):
-    def __init__(self, gateway_device, network_interface):
+
+    PHASE_TIMEOUTS = {
+        "probe start": 5,
+        "serial open": 5,
+        "socket bind": 5,
+        "probe": 10,
+        "mdns registration": 10,
+    }
+
+    def __init__(self, gateway_device, network_interface, io_engine=None, metrics_registry=None, metadata_cache=None,
+                 mdns_service=None, address_monitor=None, sysfs_root=SYSFS_ROOT, shard_pool=None):
         self.gateway_device = gateway_device
+        self.sysfs_root = sysfs_root
+        self.shard_pool = shard_pool
         self.network_interface = network_interface
+        self.io_engine = io_engine
+        self.metrics_registry = metrics_registry
+        self.metadata_cache = metadata_cache
+        self.mdns_service = mdns_service
+        self.address_monitor = address_monitor
+        self.metrics = DeviceMetrics({"device": gateway_device.get_serial_port(), "name": gateway_device.get_name(),
+                                      "port": gateway_device.get_tcp_port() or gateway_device.get_unix_socket_path()})
         self.rfc2217_connection = None
         self.mdns_advertiser = None
+        self.start_future = None
+        self.timings = {}
+        self.cancelled = threading.Event()
+        self.stopped = False
+        self._stop_lock = threading.Lock()
 
     def start(self):
         logger.info("Device '{}' ('{}') has been created".format(self.gateway_device.get_name(), self.gateway_device.get_serial_port()))
-        self.mdns_advertiser = MDNSAdvertiser(
-                                "_rfc2217", "RFC2217 ({}:{})".format(self.gateway_device.get_id_vendor(), self.gateway_device.get_id_model()),
-                                self.gateway_device.get_tcp_port(), self.gateway_device.get_properties(),
-                                None, self.network_interface)
-        self.rfc2217_connection = RFC2217Device(self.gateway_device.get_serial_port(), self.gateway_device.get_tcp_port())
+        started = time.monotonic()
+        cached_properties = self.__get_cached_properties()
+        if cached_properties:
+            self.gateway_device.set_cached_properties(cached_properties)
+        self.gateway_device.add_properties_listener(self.__on_properties_changed)
+
+        if self.shard_pool:
+            from shard_pool import ShardedDevice
+            device_class = functools.partial(ShardedDevice, self.shard_pool)
+        else:
+            device_class = RFC2217Device
+        self.rfc2217_connection = device_class(self.gateway_device.get_serial_port(), self.gateway_device.get_tcp_port(),
+                                               self.io_engine, self.gateway_device.get_coalescing_policy(),
+                                               self.gateway_device.get_receive_buffer_size(), self.metrics,
+                                               do_not_open=True,
+                                               max_subscribers=self.gateway_device.get_max_subscribers(),
+                                               subscriber_queue_size=self.gateway_device.get_subscriber_queue_size(),
+                                               backpressure_policy=self.gateway_device.get_backpressure_policy(),
+                                               raw_settings=self.gateway_device.get_raw_settings(),
+                                               unix_path=self.gateway_device.get_unix_socket_path(),
+                                               session_policy=self.gateway_device.get_session_policy(),
+                                               warm_sessions=self.gateway_device.get_warm_sessions(),
+                                               latency_profile=self.gateway_device.get_latency_profile(),
+                                               sysfs_root=self.sysfs_root)
+        # a port opened or a socket bound after its phase was given up is
+        # closed, nothing owns it
+        s_port = self.__run_phase("serial open", self.rfc2217_connection.connect_serial_port,
+                                  self.rfc2217_connection.device_path, release=lambda s_port: s_port.close())
+        self.rfc2217_connection.open_serial_port(s_port)
+        # the probe borrows the port opened for the bridge
+        self.__run_phase("probe start", lambda: self.gateway_device.start_probe(self.rfc2217_connection.port_broker))
+        listening_sockets = self.__run_phase("socket bind", self.rfc2217_connection.bind_sockets,
+                                             release=close_sockets)
+        self.rfc2217_connection.set_listening_sockets(*listening_sockets)
+        self.__check_cancelled()
+        if self.metrics_registry:
+            self.metrics_registry.add(self.metrics)
+
+        # the probe has the port until it completes or times out, or right
+        # away with cached properties, or as soon as a client queues on the
+        # bound socket: the port is then handed over and a probe still
+        # running gets PortBroker.HAND_OVER_TIMEOUT, all a client waits for
+        phase_started = time.monotonic()
+        probe_timeout = 0 if cached_properties else self.PHASE_TIMEOUTS["probe"]
+        if not self.__wait(self.__wait_for_probe, probe_timeout) and not cached_properties:
+            logger.warning("Device '{}' ('{}') probe did not complete in {} s, serving without it".format(
+                self.gateway_device.get_name(), self.get_serial_port(), self.PHASE_TIMEOUTS["probe"]))
+        elif not cached_properties and not self.gateway_device.wait_for_properties(0):
+            logger.info("Device '{}' ('{}') has a client waiting, serving it before the probe completed".format(
+                self.gateway_device.get_name(), self.get_serial_port()))
+        self.timings["probe"] = time.monotonic() - phase_started
+        self.__check_cancelled()
         self.rfc2217_connection.start()
-        self.mdns_advertiser.start()
+
+        if self.gateway_device.get_tcp_port():
+            # unix socket only devices are not visible on the network
+            from mdns_advertiser import MDNSAdvertiser
+            self.mdns_advertiser = MDNSAdvertiser(
+                                    self.gateway_device.get_service_type(), self.gateway_device.get_service_name(),
+                                    self.gateway_device.get_tcp_port(), self.gateway_device.get_properties(),
+                                    None, self.network_interface, self.mdns_service,
+                                    self.address_monitor)
+            phase_started = time.monotonic()
+            self.mdns_advertiser.start()
+            if not self.__wait(self.mdns_advertiser.registered.wait, self.PHASE_TIMEOUTS["mdns registration"]):
+                logger.warning("Device '{}' ('{}') mDNS registration did not complete in {} s, still trying".format(
+                    self.gateway_device.get_name(), self.get_serial_port(), self.PHASE_TIMEOUTS["mdns registration"]))
+            self.timings["mdns registration"] = time.monotonic() - phase_started
+        self.timings["total"] = time.monotonic() - started
+        logger.info("Device '{}' ('{}') bring-up{}: {}".format(
+            self.gateway_device.get_name(), self.get_serial_port(), " (cached properties)" if cached_properties else "",
+            ", ".join("{} {:.1f} ms".format(phase, seconds * 1e3) for phase, seconds in self.timings.items())))
+
+    def cancel(self):
+        """make a running start() give up"""
+        self.cancelled.set()
 
     def stop(self):
+        with self._stop_lock:
+            if self.stopped:
+                return
+            self.stopped = True
+        self.gateway_device.stop_probe()
         if self.rfc2217_connection:
             self.rfc2217_connection.stop()
         if self.mdns_advertiser:
             self.mdns_advertiser.stop()
+        if self.metrics_registry:
+            self.metrics_registry.remove(self.metrics)
         logger.info("Device '{}' ('{}') has been deleted".format(self.gateway_device.get_name(), self.gateway_device.get_serial_port()))
 
     def get_serial_port(self):
-        return self.gateway_device.get_serial_port()
\ No newline at end of file
+        return self.gateway_device.get_serial_port()
+
+    def __run_phase(self, name, function, *args, release=None):
+        phase_started = time.monotonic()
+        self.__check_cancelled()
+        result = run_phase(name, self.PHASE_TIMEOUTS[name], function, *args, cancelled=self.cancelled,
+                           release=release)
+        self.timings[name] = time.monotonic() - phase_started
+        return result
+
+    def __check_cancelled(self):
+        if self.cancelled.is_set():
+            raise BringUpCancelled("device removed")
+
+    def __wait(self, wait, timeout):
+        """wait(timeout) in short steps, stopping early when cancelled"""
+        deadline = time.monotonic() + timeout
+        while True:
+            if wait(min(CANCEL_CHECK_INTERVAL, max(0, deadline - time.monotonic()))):
+                return True
+            if self.cancelled.is_set() or time.monotonic() >= deadline:
+                return False
+
+    def __wait_for_probe(self, timeout):
+        """True once the probe completed or a client waits to be accepted"""
+        if self.gateway_device.wait_for_properties(timeout):
+            return True
+        listening_sockets = self.rfc2217_connection.get_listening_sockets()
+        return bool(listening_sockets) and bool(select.select(listening_sockets, [], [], 0)[0])
+
+    def __get_cached_properties(self):
+        key = self.gateway_device.get_cache_key()
+        if not self.metadata_cache or not key:
+            return None
+        return self.metadata_cache.get(key)
+
+    def __on_properties_changed(self, properties):
+        key = self.gateway_device.get_cache_key()
+        if self.metadata_cache and key:
+            self.metadata_cache.put(key, self.gateway_device.get_probed_properties())
+        if self.mdns_advertiser:
+            self.mdns_advertiser.update_properties(properties)